@@ -0,0 +1,113 @@
+# admission.py
+"""/callback 的准入控制：每位使用者的 token bucket 與全程序的進行中事件上限。
+
+一位使用者一次貼上幾十筆點單、或群組裡的機器人互相回應形成迴圈時，每則訊息都會跑一次
+build_reply 並佔住一條 gunicorn 執行緒，其他使用者只能排隊。驗簽後先做准入判斷，
+超量的事件直接回覆固定訊息（或直接略過），不解析、不計算。
+
+- TokenBucketLimiter：每個鍵（userId，沒有時為群組／聊天室）一個 token bucket，每秒補 rate 個、
+  最多存 burst 個；每則事件取一個。狀態存在有上限的 OrderedDict（依最後使用時間排列），
+  閒置到 bucket 已補滿的鍵與它不存在沒有差別，每次取用時順便從最舊的一端清掉；
+  超過 maxsize 時淘汰最久沒出現的鍵（被淘汰的使用者下次以滿的 bucket 重新開始）
+- ConcurrencyLimiter：進行中（已准入、尚未回覆完成）的事件數上限，不等待，超過即拒絕
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate=1.0, burst=5, maxsize=10000, clock=time.monotonic):
+        """rate <= 0 表示停用（一律放行）。"""
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.maxsize = maxsize
+        self._clock = clock
+        self._buckets = OrderedDict()  # 鍵 -> [剩餘 token, 上次更新時間, 本輪是否已通知]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.throttled = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def acquire(self, key):
+        """取一個 token：有 token 時回傳 True；沒有時回傳 False（不等待）。"""
+        if not self.enabled or key is None:
+            return True
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, False]
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = False
+                self.allowed += 1
+                return True
+            self.throttled += 1
+            return False
+
+    def notify_once(self, key):
+        """被限流後是否該通知使用者：每次被限流期間（直到再次取得 token）只回傳一次 True。"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or bucket[2]:
+                return False
+            bucket[2] = True
+            return True
+
+    def _expire(self, now):
+        # 依最後使用時間排列，最舊的在最前面：只需從頭清到第一個還沒補滿的鍵
+        idle = self.burst / self.rate
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < idle:
+                break
+            del buckets[key]
+
+    def stats(self):
+        with self._lock:
+            size = len(self._buckets)
+        return {"rate": self.rate, "burst": self.burst, "tracked": size, "maxsize": self.maxsize,
+                "allowed": self.allowed, "throttled": self.throttled, "evicted": self.evicted}
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit=0):
+        """limit <= 0 表示不設上限（仍會計數）。"""
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def try_acquire(self):
+        """還有空位時佔用一個並回傳 True；已達上限時回傳 False。佔用後須呼叫 release()。"""
+        with self._lock:
+            if 0 < self.limit <= self.in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in_flight": self.in_flight, "peak": self.peak,
+                    "rejected": self.rejected}
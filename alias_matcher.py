@@ -0,0 +1,81 @@
+# alias_matcher.py
+"""把別名表（尺寸、冰量、甜度）預先編成字典樹，解析時只需由左到右掃描一次。
+
+舊做法每則訊息都要把別名表依長度排序，再逐一做 `alias in text`，
+成本是「別名數 × 文字長度」；別名表在 DataLoader.build 時編譯一次後，
+比對成本只與文字長度（乘上最長別名長度這個常數）有關，與別名數量無關。
+
+比對規則：長的別名優先；同長時取文字中最左邊出現的那一個。舊版同長時取別名表（dict／排序後）
+順序中較前的別名，與在文字中的位置無關；改為取最左是刻意的調整，結果只取決於使用者輸入。
+
+longest_prefix() 則只比對從指定位置開始的最長別名，供沒有空白的點單
+（「50嵐珍奶微糖」）由左到右依序切出品牌與品名。
+"""
+
+# 字典樹節點中存放「此處結束的別名對應值」的鍵；單一字元不可能是空字串，不會與子節點衝突
+_VALUE = ""
+
+
+class AliasMatcher:
+    __slots__ = ("_root", "_max_len")
+
+    def __init__(self, mapping):
+        """mapping：別名 -> 標準值。空字串別名會被略過。"""
+        root = {}
+        max_len = 0
+        for alias, value in mapping.items():
+            if not alias:
+                continue
+            node = root
+            for ch in alias:
+                node = node.setdefault(ch, {})
+            node[_VALUE] = value
+            max_len = max(max_len, len(alias))
+        self._root = root
+        self._max_len = max_len
+
+    def __bool__(self):
+        return bool(self._root)
+
+    def find(self, text):
+        """回傳 (起點, 終點, 標準值)：最長的別名，同長取最左；找不到回傳 None。"""
+        root = self._root
+        if not root:
+            return None
+        best = None
+        best_len = 0
+        n = len(text)
+        for start in range(n):
+            # 剩餘長度已不可能比目前找到的更長，或已達最長別名長度，提早結束
+            if n - start <= best_len or best_len == self._max_len:
+                break
+            node = root.get(text[start])
+            pos = start
+            while node is not None:
+                pos += 1
+                if _VALUE in node and pos - start > best_len:
+                    best, best_len = (start, pos, node[_VALUE]), pos - start
+                if pos >= n:
+                    break
+                node = node.get(text[pos])
+        return best
+
+    def longest_prefix(self, text, start=0):
+        """回傳 (終點, 標準值)：從 start 開始的最長別名；找不到回傳 None。"""
+        node = self._root
+        best = None
+        for pos in range(start, len(text)):
+            node = node.get(text[pos])
+            if node is None:
+                break
+            if _VALUE in node:
+                best = (pos + 1, node[_VALUE])
+        return best
+
+    def consume(self, text):
+        """找到別名後從文字移除（以空白取代）。回傳 (標準值, 剩餘文字)；找不到回傳 (None, 原文字)。"""
+        match = self.find(text)
+        if match is None:
+            return None, text
+        start, end, value = match
+        return value, f"{text[:start]} {text[end:]}"
@@ -4,47 +4,258 @@
 設計重點：
 - 資料層初始化失敗時 app 仍可啟動（回覆維護訊息、/healthz 回報 degraded），
   之後每次收到訊息會自動重試初始化。
-- 「更新資料」隱藏指令：重新從 Google Sheets 載入（需搭配單一 gunicorn worker，
-  否則只會更新到其中一個 worker 的記憶體）。
+- STARTUP_MODE=cache_first（預設）：啟動時先同步載入本機快取（索引快照檔或 JSON）即可服務，
+  Google Sheets 更新改在背景進行；沒有本機快取時才同步連 Sheets。
+  blocking：與舊版相同，啟動時先連 Sheets、失敗才用快取。
+- DATA_SOURCE：資料來源也可以是本機的 CSV／TSV 目錄或 SQLite 資料庫（離線部署、負載測試，見 data_sources.py）；
+  DRINKS_LOOKUP=sqlite 時營養表、排行與品名建議改查本機 SQLite 檔，不在每個 worker 的記憶體各放一份（見 sqlite_lookup.py）。
+- 背景排程更新（REFRESH_INTERVAL）：更新在背景執行緒進行，期間照常用目前的快照回覆；
+  同時間只會有一個更新在跑，「更新資料」與排程共用同一次更新。
+- 「更新資料」隱藏指令：觸發（並最多等待 REFRESH_AWAIT_TIMEOUT 秒）上述更新，完成後寫入共用索引快照檔
+  （SHARED_SNAPSHOT_PATH）；其他 gunicorn worker 收到請求時發現新版本即自動載入，
+  多 worker 部署也能一次更新全部。
+- LINE 回覆共用同一個連線池（LINE_POOL_SIZE，應與 gunicorn --threads 相同）。
+- REPLY_MODE=async：/callback 驗簽後把事件放進有上限的佇列並立即回 200，
+  由背景工作池計算並回覆（含重試）；佇列滿時丟棄並計數。預設 sync 於請求執行緒內完成。
+- 資料來源斷路器：初始化或更新連續失敗時斷開，以指數退避加抖動決定下次重試時間；斷開期間訊息立即回覆
+  維護中，不再每則訊息都重新連 Sheets。初始化同一時間只跑一次，其他等待者共用結果（見 circuit_breaker.py）。
+- 一個 webhook 帶多個事件時依 userId 分組：不同使用者並行回覆（sync 模式最多 EVENT_WORKERS 條
+  執行緒），同一使用者的事件依原順序逐一回覆。
+- 重送去重：webhookEventId 在 WEBHOOK_DEDUP_TTL 秒內已處理過就略過（LINE 在我們回應太慢時會重送），
+  預設記在程序內記憶體；設定 WEBHOOK_DEDUP_PATH 時改用本機 SQLite 檔，多個 worker 共用。
+- 准入控制：驗簽後先依 userId 的 token bucket（USER_RATE_LIMIT / USER_BURST）與每個 worker 的進行中事件
+  上限（MAX_INFLIGHT_EVENTS）判斷，超量的事件回覆固定訊息或直接略過（THROTTLE_ACTION），不跑 build_reply。
+- /api/calculate：批次計算 JSON API（網頁版共用同一套解析與計算），大批次以 NDJSON 串流回傳。
+- 排行查詢：「低卡/高卡/低糖/高糖 品牌 [尺寸] [冰量] [範圍]」聊天指令與 GET /api/rank，
+  由建置時排好序的 RankingIndex 以 bisect 回答。
+- 回覆快取：相同輸入在同一資料世代下直接回傳上次的回覆（REPLY_CACHE_SIZE / REPLY_CACHE_TTL）。
+- /metrics：Prometheus 文字格式的指標（見 metrics.py）——驗簽、解析、計算、組字、LINE API、
+  資料更新的延遲直方圖，解析／計算錯誤依類別計數，快取、佇列、資料世代與列數等量表。
+  記錄端不加鎖，可常態開啟；指標為各 worker 各自累計。
+- /admin/profile（需 ADMIN_TOKEN）：剖析接下來 N 次或一段時間內的 build_reply / callback，
+  取回合併後的 pstats 與 collapsed stack（火焰圖）；沒有進行中的剖析時掛勾沒有額外成本（見 profiler.py）。
 """
+import startup_clock  # 必須是第一個 import：之後的 import 與初始化耗時都以此為起點
+
+import atexit
+import hmac
+import json
 import logging
+import math
 import os
-import threading
+import time
 
 from dotenv import load_dotenv
-from flask import Flask, abort, jsonify, request
+from flask import Flask, Response, abort, jsonify, request
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    ApiClient,
-    Configuration,
-    MessagingApi,
-    ReplyMessageRequest,
-    TextMessage,
-)
+from linebot.v3.messaging import Configuration
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+import metrics
+from admission import ConcurrencyLimiter, TokenBucketLimiter
+from batch_calculator import calculate_batch
 from calorie_calculator import CalorieCalculator
-from data_loader import DataLoader
-from input_parser import UserInputParser
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, SingleFlight
+from data_loader import DataLoader, RefreshScheduler
+from data_sources import open_source
+from event_dedup import EventDeduper, SqliteEventDeduper
+from input_parser import RANKING_COMMANDS, UserInputParser
+from line_client import LineReplyClient
+from profiler import DEFAULT_INTERVAL, Profiler, parse_spec
+from reply_cache import ReplyCache, normalize_text
+from reply_worker import EventFanout, ReplyDispatcher, group_by_source, source_key
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 logger = logging.getLogger("cal_cal")
+_IMPORT_SECONDS = time.perf_counter() - startup_clock.STARTED
+logger.info("模組載入耗時 %.0f ms", _IMPORT_SECONDS * 1000)
 
 app = Flask(__name__)
 
 GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME", "Nutrition_Facts").strip()
 CACHE_PATH = os.getenv("SHEET_CACHE_PATH", "cache/sheet_cache.json").strip()
+# 多 worker 共用的索引快照檔；設為空字串停用（單 worker 部署可不用）
+SHARED_SNAPSHOT_PATH = os.getenv("SHARED_SNAPSHOT_PATH", "cache/index_snapshot.bin").strip() or None
+SHARED_SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SHARED_SNAPSHOT_CHECK_INTERVAL", "1"))
+STARTUP_MODE = os.getenv("STARTUP_MODE", "cache_first").strip().lower()
+# 每次 build 以 NumPy 預先算好所有 飲品 × 甜度 的結果（需另外安裝 numpy）
+PRECOMPUTE_MATRIX = os.getenv("PRECOMPUTE_MATRIX", "").strip().lower() in {"1", "true", "yes"}
+# 資料來源：sheets（預設）、csv（DATA_SOURCE_PATH 為 CSV／TSV 目錄）、sqlite（DATA_SOURCE_PATH 為資料庫檔）
+DATA_SOURCE = os.getenv("DATA_SOURCE", "sheets").strip().lower()
+DATA_SOURCE_PATH = os.getenv("DATA_SOURCE_PATH", "").strip()
+# 查表方式：memory（預設，每個 worker 一份索引）或 sqlite（營養表、排行、建議查 DRINKS_LOOKUP_DIR 下的 SQLite 檔）
+DRINKS_LOOKUP = os.getenv("DRINKS_LOOKUP", "memory").strip().lower()
+DRINKS_LOOKUP_DIR = os.getenv("DRINKS_LOOKUP_DIR", "cache/lookup").strip()
 
 # LINE SDK 一律先建立：缺憑證時驗簽會失敗回 400，但 app 本身能啟動，
 # 不會像舊版一樣因 handler=None 導致整個模組 import 失敗。
 configuration = Configuration(
     access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "").strip() or "not-set")
 handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET", "").strip() or "not-set")
+line_client = LineReplyClient(configuration,
+                              pool_size=int(os.getenv("LINE_POOL_SIZE", os.getenv("GUNICORN_THREADS", "8"))),
+                              timeout=float(os.getenv("LINE_API_TIMEOUT", "10")))
+atexit.register(line_client.close)
+
+REPLY_MODE = os.getenv("REPLY_MODE", "sync").strip().lower()
+# reply token 的有效期限（秒，自事件時間起算）；背景重試不會超過此期限
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+REPLY_RETRIES = int(os.getenv("REPLY_RETRIES", "3"))
+
+# 批次 API：單次最多幾項、超過幾項自動改用串流、允許跨來源呼叫的網域（空字串表示不開放）
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "5000"))
+BULK_STREAM_THRESHOLD = int(os.getenv("BULK_STREAM_THRESHOLD", "500"))
+API_ALLOW_ORIGIN = os.getenv("API_ALLOW_ORIGIN", "").strip()
+
+# 排行查詢：聊天回覆列出的筆數、/api/rank 的預設與最大 limit
+RANK_REPLY_LIMIT = 10
+RANK_DEFAULT_LIMIT = 10
+RANK_MAX_LIMIT = 100
 
 _services = {}
-_lock = threading.Lock()
+_startup = {"import_ms": round(_IMPORT_SECONDS * 1000), "ready_ms": None}
+
+# 設為 0 停用快取；TTL 單位為秒，0 表示只靠 LRU 淘汰
+_reply_cache = ReplyCache(maxsize=int(os.getenv("REPLY_CACHE_SIZE", "1024")),
+                          ttl=float(os.getenv("REPLY_CACHE_TTL", "600")))
+
+# webhook 重送去重：記住處理過的 webhookEventId 的秒數與筆數（0 筆停用）；
+# 設定 WEBHOOK_DEDUP_PATH 時改用該 SQLite 檔，同一台機器上的 worker 共用
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", "3600"))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+WEBHOOK_DEDUP_PATH = os.getenv("WEBHOOK_DEDUP_PATH", "").strip()
+
+
+def _make_deduper():
+    if WEBHOOK_DEDUP_PATH and WEBHOOK_DEDUP_SIZE > 0:
+        try:
+            return SqliteEventDeduper(WEBHOOK_DEDUP_PATH, ttl=WEBHOOK_DEDUP_TTL)
+        except Exception:  # noqa: BLE001 - 去重只是最佳化，檔案開不了就退回記憶體
+            logger.exception("無法開啟去重記錄 %s，改用程序內記憶體", WEBHOOK_DEDUP_PATH)
+    return EventDeduper(maxsize=WEBHOOK_DEDUP_SIZE, ttl=WEBHOOK_DEDUP_TTL)
+
+
+_dedup = _make_deduper()
+
+# 准入控制：每位使用者每秒補 USER_RATE_LIMIT 則、最多連續 USER_BURST 則（0 停用），最多記住
+# USER_LIMITER_SIZE 位使用者；每個 worker 同時處理中的事件最多 MAX_INFLIGHT_EVENTS 則（0 不限）。
+# 超量的事件依 THROTTLE_ACTION 回覆固定訊息（reply，同一位使用者每次被限流只回一次）或直接略過（drop）
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", "1"))
+USER_BURST = int(os.getenv("USER_BURST", "5"))
+USER_LIMITER_SIZE = int(os.getenv("USER_LIMITER_SIZE", "10000"))
+MAX_INFLIGHT_EVENTS = int(os.getenv("MAX_INFLIGHT_EVENTS", "50"))
+THROTTLE_ACTION = os.getenv("THROTTLE_ACTION", "reply").strip().lower()
+THROTTLED_REPLY = "⏳ 訊息有點多，請等幾秒再傳下一筆"
+OVERLOADED_REPLY = "⏳ 目前查詢的人太多，請稍後再試一次"
+
+_user_limiter = TokenBucketLimiter(rate=USER_RATE_LIMIT, burst=USER_BURST, maxsize=USER_LIMITER_SIZE)
+_inflight = ConcurrencyLimiter(MAX_INFLIGHT_EVENTS)
+
+
+# 管理端點（/admin/*）的 Bearer token；未設定時管理端點一律回 404
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+# 啟動後立即開始剖析：「200」剖析接下來 200 次呼叫、「60s」剖析 60 秒；結果以 /admin/profile 取回
+PROFILE_ON_START = os.getenv("PROFILE_ON_START", "").strip()
+PROFILE_DEFAULT_COUNT = 100
+
+_profiler = Profiler()
+if PROFILE_ON_START:
+    try:
+        _profiler.start(**parse_spec(PROFILE_ON_START))
+        logger.info("已開始剖析（PROFILE_ON_START=%s）", PROFILE_ON_START)
+    except ValueError:
+        logger.warning("PROFILE_ON_START 格式錯誤（%s），應為正的次數（如 200）或秒數（如 60s），忽略此設定",
+                       PROFILE_ON_START)
+
+
+# 背景排程更新間隔秒數（0 停用，只靠「更新資料」），每輪加上 ±REFRESH_JITTER 比例的抖動
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", "0"))
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", "0.1"))
+# 「更新資料」最多等待更新完成的秒數；逾時先回覆「更新中」，更新仍在背景完成
+REFRESH_AWAIT_TIMEOUT = float(os.getenv("REFRESH_AWAIT_TIMEOUT", "20"))
+
+
+# 資料來源斷路器：連續失敗 BREAKER_THRESHOLD 次後斷開，等待 BREAKER_BASE_DELAY × 2^(n-1) 秒
+# （上限 BREAKER_MAX_DELAY，±BREAKER_JITTER 比例抖動）才再試一次
+_breaker = CircuitBreaker(threshold=int(os.getenv("BREAKER_THRESHOLD", "1")),
+                          base_delay=float(os.getenv("BREAKER_BASE_DELAY", "2")),
+                          max_delay=float(os.getenv("BREAKER_MAX_DELAY", "300")),
+                          jitter=float(os.getenv("BREAKER_JITTER", "0.2")))
+_init_flight = SingleFlight()
+
+
+def _refresh_data():
+    """由 RefreshScheduler 在背景執行緒呼叫；有變動時清空回覆快取。"""
+    changed = _breaker.call(_services["loader"].refresh)
+    if changed:
+        _reply_cache.clear()
+    return changed
+
+
+def _refreshed_elsewhere():
+    """其他 worker 剛抓過 Sheets（且已透過共用快照同步）時，跳過本 worker 這一輪排程。"""
+    age = _services["loader"].seconds_since_shared_refresh()
+    return age is not None and age < REFRESH_INTERVAL / 2
+
+
+def _skip_scheduled_refresh():
+    if _breaker.state == OPEN and _breaker.retry_in() > 0:
+        logger.debug("資料來源斷路器斷開中，跳過本輪排程更新")
+        return True
+    return _refreshed_elsewhere()
+
+
+_scheduler = RefreshScheduler(_refresh_data, interval=REFRESH_INTERVAL, jitter=REFRESH_JITTER,
+                              should_skip=_skip_scheduled_refresh)
+atexit.register(_scheduler.stop)
+
+_STAGE_SECONDS = metrics.Histogram(
+    "calcal_stage_seconds",
+    "回覆各階段耗時：verify（驗簽與解析 webhook）、parse、calculate、format、ranking、reply（build_reply 整體）",
+    ("stage",))
+_VERIFY, _PARSE, _CALCULATE, _FORMAT, _RANKING, _REPLY = (
+    _STAGE_SECONDS.labels(stage) for stage in ("verify", "parse", "calculate", "format", "ranking", "reply"))
+_PARSE_ERRORS = metrics.Counter("calcal_parse_errors_total", "解析失敗次數，依錯誤類別", ("code",))
+_CALCULATE_ERRORS = metrics.Counter("calcal_calculate_errors_total", "計算失敗次數，依錯誤類別", ("code",))
+_INTERNAL_ERRORS = metrics.Counter("calcal_internal_errors_total", "回覆時發生未預期例外的次數")
+_INVALID_SIGNATURES = metrics.Counter("calcal_webhook_invalid_signature_total", "驗簽失敗的 webhook 請求數")
+_DUPLICATE_EVENTS = metrics.Counter("calcal_webhook_duplicates_total",
+                                    "已處理過而略過的 webhook 事件數（依 LINE 是否標示為重送）", ("redelivery",))
+_THROTTLED_EVENTS = metrics.Counter("calcal_webhook_throttled_total",
+                                    "未准入的 webhook 事件數：user（使用者超過速率）、overload（進行中事件已達上限）",
+                                    ("reason",))
+
+
+def _snapshot_gauge(read):
+    """資料相關量表：尚未載入資料時不輸出。"""
+    def callback():
+        loader = _services.get("loader")
+        return read(loader.snapshot) if loader and loader.snapshot else None
+    return callback
+
+
+metrics.Gauge("calcal_data_generation", "目前資料快照的世代號",
+              callback=_snapshot_gauge(lambda data: data.generation))
+metrics.Gauge("calcal_data_rows", "目前資料快照各表格的筆數", ("table",),
+              callback=_snapshot_gauge(lambda data: {
+                  ("drinks",): len(data.drinks_index), ("toppings",): len(data.toppings_map),
+                  ("brands",): len(data.known_brands), ("brand_aliases",): len(data.brands_alias_map),
+                  ("drink_aliases",): len(data.drinks_alias_map)}))
+metrics.Gauge("calcal_snapshot_age_seconds", "目前資料快照建置至今的秒數",
+              callback=_snapshot_gauge(lambda data: time.time() - data.built_at if data.built_at else None))
+metrics.Gauge("calcal_refresh_last_success_timestamp_seconds", "最近一次背景更新成功的時間（Unix 秒）",
+              callback=lambda: _scheduler.last_success)
+metrics.Gauge("calcal_refresh_failure_streak", "背景更新連續失敗次數",
+              callback=lambda: _scheduler.failure_streak)
+metrics.Gauge("calcal_breaker_open", "資料來源斷路器是否斷開（半開試探中也算 1）",
+              callback=lambda: _breaker.state != CLOSED)
+metrics.Gauge("calcal_breaker_consecutive_failures", "資料來源連續失敗次數", callback=lambda: _breaker.failures)
+metrics.Counter("calcal_reply_cache_events_total", "回覆快取事件（hit、miss、eviction、expiration）", ("event",),
+                callback=lambda: {(event,): _reply_cache.stats()[key] for event, key in (
+                    ("hit", "hits"), ("miss", "misses"), ("eviction", "evictions"), ("expiration", "expirations"))})
+metrics.Gauge("calcal_reply_cache_size", "回覆快取目前筆數", callback=lambda: _reply_cache.stats()["size"])
 
 
 def _google_key() -> str:
@@ -59,29 +270,119 @@ def _google_key() -> str:
 
 
 def init_services(force: bool = False) -> bool:
-    """初始化資料層。失敗時回傳 False，app 仍可運作並於下次訊息再重試。"""
-    with _lock:
-        if _services.get("loader") and not force:
-            return True
-        try:
-            key = _google_key()
-            if not key:
+    """初始化資料層。失敗時回傳 False，app 仍可運作，斷路器到了重試時間後由下一則訊息再試。
+
+    斷路器斷開期間立即回傳 False（不等待、不連 Sheets）；同一時間只會有一次初始化，
+    其他呼叫者等待並共用它的結果。force=True 略過斷路器，重新初始化。
+    """
+    if _services.get("loader") and not force:
+        return True
+    if not force and _breaker.state == OPEN and _breaker.retry_in() > 0:
+        return False
+    return _init_flight.do(lambda: _initialize(force))
+
+
+def _initialize(force):
+    if _services.get("loader") and not force:
+        return True  # 等待期間前一次初始化已經成功
+    if not force and not _breaker.allow():
+        return False
+    try:
+        key = _google_key() if DATA_SOURCE == "sheets" else ""
+        source = open_source(DATA_SOURCE, DATA_SOURCE_PATH, key, GOOGLE_SHEET_NAME)
+        loader = DataLoader(key, GOOGLE_SHEET_NAME, cache_path=CACHE_PATH,
+                            snapshot_path=SHARED_SNAPSHOT_PATH,
+                            sync_interval=SHARED_SNAPSHOT_CHECK_INTERVAL,
+                            precompute=PRECOMPUTE_MATRIX, source=source,
+                            lookup_dir=DRINKS_LOOKUP_DIR if DRINKS_LOOKUP == "sqlite" else None)
+        # cache_first：有本機快取就先上線，Sheets 更新交給背景執行緒；本機來源直接讀取即可
+        background_refresh = STARTUP_MODE == "cache_first" and source.remote and loader.load_local()
+        if not background_refresh:
+            if source.remote and not key:
                 raise ValueError("未設定 GOOGLE_SERVICE_ACCOUNT_FILE 或 GOOGLE_SHEETS_API_KEY")
-            loader = DataLoader(key, GOOGLE_SHEET_NAME, cache_path=CACHE_PATH)
             loader.load()
-            _services["loader"] = loader
-            _services["parser"] = UserInputParser(loader)
-            _services["calculator"] = CalorieCalculator(loader)
+        _services["loader"] = loader
+        _services["parser"] = UserInputParser(loader)
+        _services["calculator"] = CalorieCalculator(loader)
+        _breaker.record_success()
+        if _startup["ready_ms"] is None:
+            _startup["ready_ms"] = round((time.perf_counter() - startup_clock.STARTED) * 1000)
+            logger.info("資料層就緒（來源：%s），自程序啟動 %d ms", loader.source, _startup["ready_ms"])
+        else:
             logger.info("資料層初始化完成（來源：%s）", loader.source)
-            return True
-        except Exception:  # noqa: BLE001 - 啟動失敗需容忍，於 /healthz 回報
-            logger.exception("資料層初始化失敗")
-            return False
+        if background_refresh:
+            if key:
+                _scheduler.trigger()
+            else:
+                logger.warning("未設定 Google 金鑰，只使用本機快取資料，不會從 Sheets 更新")
+        _scheduler.start()
+    except Exception as exc:  # noqa: BLE001 - 啟動失敗需容忍，於 /healthz 回報
+        _breaker.record_failure(exc)
+        logger.exception("資料層初始化失敗，%.0f 秒後才會再試", _breaker.retry_in())
+        return False
+    return True
 
 
 init_services()
 
 
+def _reply_event(event):
+    """計算回覆並送出；背景模式下 LINE API 暫時性錯誤會在 reply token 到期前重試。"""
+    start = time.perf_counter()
+    reply_text = build_reply(event.message.text)
+    compute = time.perf_counter() - start
+    if REPLY_MODE == "async":
+        deadline = event.timestamp / 1000 + REPLY_TOKEN_TTL
+        api = line_client.reply_with_retry(event.reply_token, reply_text, deadline,
+                                           retries=REPLY_RETRIES)
+    else:
+        api = line_client.reply(event.reply_token, reply_text)
+    logger.info("回覆完成：計算 %.1f ms，LINE API %.1f ms", compute * 1000, api * 1000)
+
+
+def _reply_events(items):
+    """依序回覆同一使用者的 (事件, 固定回覆) 組；其中一則失敗仍繼續回覆後面的事件，最後再拋出第一個錯誤。
+
+    固定回覆為 None 的事件已准入，計算回覆後釋放進行中名額；其餘是未准入的事件，只送出固定回覆。
+    """
+    error = None
+    for event, canned in items:
+        try:
+            if canned is None:
+                try:
+                    _reply_event(event)
+                finally:
+                    _inflight.release()
+            else:
+                line_client.reply(event.reply_token, canned)
+        except Exception as exc:  # noqa: BLE001 - 後面的事件有各自的 reply token，仍要回覆
+            _dedup.forget(event.webhook_event_id)  # 沒有回覆成功：LINE 重送時要能再處理
+            if error is None:
+                error = exc
+            else:
+                logger.exception("回覆事件 %s 失敗", event.webhook_event_id)
+    if error is not None:
+        raise error
+
+
+# async 模式：每個工作是同一使用者的一組 (事件, 固定回覆)
+_dispatcher = ReplyDispatcher(_reply_events,
+                              workers=int(os.getenv("REPLY_WORKERS", "4")),
+                              maxsize=int(os.getenv("REPLY_QUEUE_SIZE", "100")))
+atexit.register(_dispatcher.stop)
+# sync 模式：同一個 webhook 內不同使用者的事件並行回覆的執行緒數（1 表示逐一處理）
+_fanout = EventFanout(_reply_events, workers=int(os.getenv("EVENT_WORKERS", "4")))
+atexit.register(_fanout.stop)
+
+metrics.Gauge("calcal_reply_queue_depth", "背景回覆佇列目前深度",
+              callback=lambda: _dispatcher.stats()["depth"] if REPLY_MODE == "async" else None)
+metrics.Counter("calcal_reply_queue_dropped_total", "背景回覆佇列已滿而丟棄的事件數",
+                callback=lambda: _dispatcher.stats()["dropped"] if REPLY_MODE == "async" else None)
+metrics.Gauge("calcal_inflight_events", "已准入、尚未回覆完成的事件數", callback=lambda: _inflight.in_flight)
+metrics.Gauge("calcal_rate_limiter_tracked_sources", "token bucket 目前記住的使用者數",
+              callback=lambda: _user_limiter.stats()["tracked"])
+
+
 @app.route("/")
 def index():
     return "cal_cal LINE Bot is running."
@@ -89,38 +390,232 @@ def index():
 
 @app.route("/healthz")
 def healthz():
+    """服務狀態。加上 ?memory=1 時附上目前快照各表格的記憶體用量（位元組；每個資料世代第一次要花約 1 秒計算）。"""
     loader = _services.get("loader")
     if loader:
-        return jsonify(status="ok", data_source=loader.source, drinks=len(loader.drinks_index))
-    return jsonify(status="degraded", data_source=None), 503
+        data = loader.snapshot
+        memory = loader.memory_report() if request.args.get("memory") == "1" else None
+        return jsonify(status="ok", data_source=data.source, generation=data.generation, memory=memory,
+                       shared_version=loader.shared_version,
+                       drinks=len(data.drinks_index), reply_cache=_reply_cache.stats(),
+                       refresh=_scheduler.stats(), startup=_startup,
+                       line_api=line_client.stats(), reply_mode=REPLY_MODE, webhook_dedup=_dedup.stats(),
+                       reply_queue=_dispatcher.stats() if REPLY_MODE == "async" else None,
+                       breaker=_breaker.stats(),
+                       admission={"users": _user_limiter.stats(), "in_flight": _inflight.stats(),
+                                  "action": THROTTLE_ACTION})
+    return jsonify(status="degraded", data_source=None, breaker=_breaker.stats()), 503
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus 文字格式；只應供內部抓取（Caddyfile 已擋下對外的 /metrics）。"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/api/calculate", methods=["POST"])
+def api_calculate():
+    """批次計算：{"items": ["50嵐 珍奶 微糖", {"brand": "清心", "drink": "高山", ...}, ...]}。
+
+    回傳 {"generation": N, "results": [...]}；加上 ?stream=1、Accept: application/x-ndjson
+    或項目數超過 BULK_STREAM_THRESHOLD 時，改以 NDJSON 每行一項逐筆串流（?stream=0 強制不串流）。
+    """
+    body = request.get_json(silent=True)
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return jsonify(error="請以 JSON 傳入 {\"items\": [...]}"), 400
+    if len(items) > BULK_MAX_ITEMS:
+        return jsonify(error=f"單次最多 {BULK_MAX_ITEMS} 項"), 413
+    if not _services.get("loader") and not init_services():
+        return jsonify(error="資料層維護中，請稍後再試"), 503
+
+    loader = _services["loader"]
+    loader.sync()
+    data = loader.snapshot  # 整批共用同一份快照
+    results = calculate_batch(items, _services["parser"], _services["calculator"], data)
+    stream_arg = request.args.get("stream")
+    if stream_arg in ("0", "1"):
+        stream = stream_arg == "1"
+    else:
+        stream = ("application/x-ndjson" in request.headers.get("Accept", "")
+                  or len(items) > BULK_STREAM_THRESHOLD)
+    if not stream:
+        return jsonify(generation=data.generation, results=list(results))
+
+    def generate():
+        try:
+            for result in results:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except Exception:
+            # 回應標頭已送出，只能以最後一行告知用戶端串流沒有完整結束
+            logger.exception("串流批次計算結果失敗")
+            yield json.dumps({"ok": False, "error": "計算中斷，其餘項目未回傳", "code": "internal"},
+                             ensure_ascii=False) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson",
+                    headers={"X-Data-Generation": str(data.generation)})
+
+
+@app.route("/api/rank")
+def api_rank():
+    """排行查詢：?brand=50嵐&metric=calories|sugar&order=asc|desc&min=&max=&size=&ice=&limit=10。
+
+    回傳 {"generation", "brand", "metric", "order", "total", "results": [...]}，total 為符合條件的總數。
+    """
+    try:
+        limit = int(request.args.get("limit", RANK_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify(error="limit 必須是整數"), 400
+    if not 1 <= limit <= RANK_MAX_LIMIT:
+        return jsonify(error=f"limit 需介於 1 到 {RANK_MAX_LIMIT}"), 400
+    if not _services.get("loader") and not init_services():
+        return jsonify(error="資料層維護中，請稍後再試"), 503
+
+    loader = _services["loader"]
+    loader.sync()
+    data = loader.snapshot
+    query = _services["parser"].normalize_ranking(request.args, data)
+    if query.get("error"):
+        return jsonify(error=query["error"]), 400
+    total, entries = _rank(query, data, limit)
+    return jsonify(generation=data.generation, brand=query["brand"], metric=query["metric"],
+                   order="desc" if query["descending"] else "asc", total=total,
+                   results=[entry._asdict() for entry in entries])
+
+
+def _rank(query, data, limit):
+    """回傳 (符合條件總數, 前 limit 筆 RankEntry)。"""
+    span = dict(brand=query["brand"], metric=query["metric"], low=query["low"], high=query["high"],
+                size=query["size"], ice=query["ice"])
+    return (data.ranking.count(**span),
+            data.ranking.query(**span, limit=limit, descending=query["descending"]))
+
+
+def _admin_denied():
+    """未設定 ADMIN_TOKEN 時回 404（不透露端點存在），token 不符回 401；通過時回傳 None。"""
+    if not ADMIN_TOKEN:
+        return jsonify(error="not found"), 404
+    supplied = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(supplied.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        return jsonify(error="unauthorized"), 401
+    return None
+
+
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def admin_profile():
+    """剖析線上流量（只剖析收到此請求的 worker）。
+
+    POST ?target=build_reply,callback&count=100 | seconds=30 [&interval_ms=5&cprofile=0]：開始剖析，回 202
+    GET [?format=json|pstats|collapsed|text]：最近一次剖析的摘要或結果（進行中也可取目前為止的結果）
+    DELETE：提前結束進行中的剖析
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    if request.method == "POST":
+        args = request.args
+        try:
+            targets = [t.strip() for t in args.get("target", ",".join(Profiler.TARGETS)).split(",") if t.strip()]
+            count = int(args["count"]) if args.get("count") else None
+            seconds = float(args["seconds"]) if args.get("seconds") else None
+            interval = float(args.get("interval_ms", DEFAULT_INTERVAL * 1000)) / 1000
+            if not 0.001 <= interval <= 1:
+                raise ValueError("interval_ms 需介於 1 到 1000")
+            if count is None and seconds is None:
+                count = PROFILE_DEFAULT_COUNT
+            session = _profiler.start(targets, count=count, seconds=seconds, interval=interval,
+                                      cprofile=args.get("cprofile", "1") != "0")
+        except ValueError as exc:
+            return jsonify(error=str(exc)), 400
+        if session is None:
+            return jsonify(error="已有進行中的剖析", profile=_profiler.session.summary()), 409
+        logger.info("開始剖析：%s", session.summary())
+        return jsonify(session.summary()), 202
+    if request.method == "DELETE":
+        session = _profiler.stop()
+        return jsonify(session.summary() if session else None)
+
+    session = _profiler.last
+    if session is None:
+        return jsonify(error="尚未剖析過"), 404
+    fmt = request.args.get("format", "json")
+    if fmt == "pstats":
+        return Response(session.pstats_bytes(), mimetype="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=cal_cal.prof"})
+    if fmt == "collapsed":
+        return Response(session.collapsed(), mimetype="text/plain")
+    if fmt == "text":
+        return Response(session.text(), mimetype="text/plain")
+    return jsonify(session.summary())
+
+
+@app.after_request
+def _cors(response):
+    if API_ALLOW_ORIGIN and request.path.startswith("/api/"):
+        response.headers["Access-Control-Allow-Origin"] = API_ALLOW_ORIGIN
+        response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+        response.headers["Access-Control-Expose-Headers"] = "X-Data-Generation"
+    return response
 
 
 @app.route("/callback", methods=["POST"])
+@_profiler.hook("callback")
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
+    started = time.perf_counter()
     try:
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
+        _INVALID_SIGNATURES.inc()
         abort(400)
+    _VERIFY.observe(time.perf_counter() - started)
+    items = [(event, _admission(event)) for event in payload.events
+             if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent)
+             and _first_delivery(event)]
+    groups = group_by_source((item for item in items if item[1] != ""), key=lambda item: source_key(item[0]))
+    if REPLY_MODE != "async":
+        _fanout.run(groups)
+        return "OK"
+    for group in groups:
+        if not _dispatcher.submit(group):
+            logger.warning("回覆佇列已滿，丟棄事件 %s", "、".join(event.webhook_event_id for event, _ in group))
+            for _, canned in group:
+                if canned is None:
+                    _inflight.release()
     return "OK"
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
-    reply_text = build_reply(event.message.text)
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_text)],
-            )
-        )
+def _admission(event):
+    """准入判斷。准入時回傳 None（已佔用一個進行中名額，回覆完成後釋放）；
+    未准入時回傳要送出的固定訊息，不回覆（THROTTLE_ACTION=drop，或此使用者這次限流已通知過）時回傳空字串。
+    """
+    key = source_key(event)
+    if not _user_limiter.acquire(key):
+        reason, text = "user", THROTTLED_REPLY if _user_limiter.notify_once(key) else ""
+    elif not _inflight.try_acquire():
+        reason, text = "overload", OVERLOADED_REPLY
+    else:
+        return None
+    _THROTTLED_EVENTS.labels(reason).inc()
+    logger.info("未准入事件 %s（%s）", event.webhook_event_id, reason)
+    return text if THROTTLE_ACTION == "reply" else ""
+
+
+def _first_delivery(event):
+    """第一次收到此事件時回傳 True；已處理過（重送或重複）則計數並略過。"""
+    if _dedup.first_seen(event.webhook_event_id):
+        return True
+    redelivery = bool(event.delivery_context and event.delivery_context.is_redelivery)
+    _DUPLICATE_EVENTS.labels("true" if redelivery else "false").inc()
+    logger.info("略過已處理過的事件 %s（重送：%s）", event.webhook_event_id, redelivery)
+    return False
 
 
 ICE_DISPLAY = {"H": "熱", "I": "冰"}
 
 
+@_profiler.hook("build_reply")
 def build_reply(user_input: str) -> str:
     """把使用者輸入轉成回覆文字（純函式，方便離線測試）。"""
     user_input = user_input.strip()
@@ -129,25 +624,59 @@ def build_reply(user_input: str) -> str:
         loader = _services.get("loader")
         if not loader:
             return "✅ 資料已載入" if init_services() else "❌ 資料載入失敗，請檢查伺服器日誌"
-        try:
-            with _lock:
-                loader.refresh()
-            return "✅ 資料已成功更新，新的飲品資料可以查詢了"
-        except Exception:  # noqa: BLE001
-            logger.exception("手動更新資料失敗")
+        # 斷開中，或其他請求正在半開試探：這時觸發更新只會被斷路器擋下
+        state = _breaker.state
+        if state == HALF_OPEN or (state == OPEN and _breaker.retry_in() > 0):
+            return f"⏳ 資料來源暫時無法連線，約 {max(1, math.ceil(_breaker.retry_in()))} 秒後再試，暫時沿用原有資料"
+        # 與排程或其他人觸發的更新共用同一次抓取
+        flight = _scheduler.trigger()
+        if not flight.wait(REFRESH_AWAIT_TIMEOUT):
+            return "⏳ 資料更新中，完成後會自動套用新資料"
+        if flight.error is not None:
             return "❌ 資料更新失敗，暫時沿用原有資料"
+        if not flight.result:
+            return "✅ 試算表內容沒有變動，沿用目前資料"
+        return "✅ 資料已成功更新，新的飲品資料可以查詢了"
 
     if not _services.get("loader") and not init_services():
         return "抱歉，機器人目前正在維護中，暫時無法提供服務"
 
+    started = time.perf_counter()
+    loader = _services["loader"]
+    if loader.sync():  # 其他 worker 已更新共用快照：舊世代的快取不會再命中，直接清掉
+        _reply_cache.clear()
+    # 整個請求只取一次快照，refresh 中途替換也不會讀到新舊混雜的資料
+    data = loader.snapshot
+    key = (data.generation, normalize_text(user_input))
+    reply = _reply_cache.get(key)
+    if reply is None:
+        reply, cacheable = _compose_reply(user_input, data)
+        if cacheable:
+            _reply_cache.put(key, reply)
+    _REPLY.observe(time.perf_counter() - started)
+    return reply
+
+
+def _compose_reply(user_input, data):
+    """解析並計算，回傳 (回覆文字, 可否快取)。內部錯誤的回覆不可快取，下次要重算。"""
     try:
-        parsed = _services["parser"].parse(user_input)
+        if (user_input.split() or [""])[0] in RANKING_COMMANDS:
+            with _RANKING.time():
+                return _compose_ranking(user_input, data), True
+        started = time.perf_counter()
+        parsed = _services["parser"].parse(user_input, data)
+        parsed_at = time.perf_counter()
+        _PARSE.observe(parsed_at - started)
         if parsed.get("error"):
-            return f"❌ {parsed['error']}"
+            _PARSE_ERRORS.labels(parsed["code"]).inc()
+            return f"❌ {parsed['error']}", True
 
-        result = _services["calculator"].calculate(parsed)
+        result = _services["calculator"].calculate(parsed, data)
+        calculated_at = time.perf_counter()
+        _CALCULATE.observe(calculated_at - parsed_at)
         if not result["ok"]:
-            return f"❌ {result['error']}"
+            _CALCULATE_ERRORS.labels(result["code"]).inc()
+            return f"❌ {result['error']}", True
 
         header = (f"🧋 {parsed['brand']} {parsed['drink']}｜{parsed['size']}｜"
                   f"{ICE_DISPLAY.get(parsed['ice'], parsed['ice'])}｜{parsed['sweetness'] or '全糖'}")
@@ -159,10 +688,48 @@ def build_reply(user_input: str) -> str:
         lines.append(f"熱量約 {result['calories']} 大卡，糖量約 {result['sugar']} 克")
         if result["ice_fallback"]:
             lines.append("（此品項無熱飲資料，以冰飲數值估算）")
-        return "\n".join(lines)
+        reply = "\n".join(lines)
+        _FORMAT.observe(time.perf_counter() - calculated_at)
+        return reply, True
     except Exception:  # noqa: BLE001 - 任何未預期錯誤都不能讓 webhook 掛掉
+        _INTERNAL_ERRORS.inc()
         logger.exception("處理訊息「%s」時發生錯誤", user_input)
-        return "抱歉，處理您的請求時發生了內部錯誤"
+        return "抱歉，處理您的請求時發生了內部錯誤", False
+
+
+_METRIC_TITLES = {("calories", False): "熱量最低", ("calories", True): "熱量最高",
+                  ("sugar", False): "糖量最低", ("sugar", True): "糖量最高"}
+
+
+def _compose_ranking(user_input, data):
+    """「低卡 50嵐 L 冰 300以下」-> 排行清單文字。"""
+    query = _services["parser"].parse_ranking(user_input, data)
+    if query.get("error"):
+        _PARSE_ERRORS.labels(query["code"]).inc()
+        return f"❌ {query['error']}"
+    total, entries = _rank(query, data, RANK_REPLY_LIMIT)
+    unit = "大卡" if query["metric"] == "calories" else "克"
+    conditions = []
+    if query["low"] is not None and query["high"] is not None:
+        conditions.append(f"{query['low']:g}~{query['high']:g} {unit}")
+    elif query["high"] is not None:
+        conditions.append(f"{query['high']:g} {unit}以下")
+    elif query["low"] is not None:
+        conditions.append(f"{query['low']:g} {unit}以上")
+    if query["size"]:
+        conditions.append(query["size"])
+    if query["ice"]:
+        conditions.append(ICE_DISPLAY.get(query["ice"], query["ice"]))
+    title = f"🏆 {query['brand']} {_METRIC_TITLES[query['metric'], query['descending']]}"
+    if conditions:
+        title += f"（{'｜'.join(conditions)}）"
+    if not entries:
+        return f"{title}\n沒有符合條件的飲品"
+    lines = [title + (f"，共 {total} 款，列出前 {len(entries)} 款" if total > len(entries) else "")]
+    for rank, entry in enumerate(entries, start=1):
+        lines.append(f"{rank}. {entry.drink}｜{entry.size}｜{ICE_DISPLAY.get(entry.ice, entry.ice)}｜"
+                     f"{entry.sweetness or '全糖'}：{entry.calories} 大卡／{entry.sugar} 克")
+    return "\n".join(lines)
 
 
 if __name__ == "__main__":
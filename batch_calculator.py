@@ -0,0 +1,61 @@
+# batch_calculator.py
+"""批次計算：一次處理多筆點單（給網頁版 boba-cal.com 等外部前端使用）。
+
+每一項可以是自然語言文字（與 LINE 相同格式），或結構化物件
+{brand, drink, size, ice, sweetness, toppings, removed_toppings}。
+整批共用同一份資料快照；相同文字只解析一次，相同的 (品牌, 品名, 尺寸, 冰量)
+查表與配料查表也只做一次（CalorieCalculator 的 memo）。
+
+失敗的項目為 {"index", "ok": False, "error": 訊息, "code": 錯誤類別}；
+計算時發生例外的項目記錄日誌後以 code "internal" 回傳，不會中斷整批。
+
+calculate_batch 是 generator：結果逐項產生，大批次可以邊算邊串流回傳。
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def calculate_batch(items, parser, calculator, data):
+    """逐項產生 {"index", "ok", ...} 結果；順序與輸入相同。"""
+    memo = {}
+    parsed_texts = {}
+    for index, item in enumerate(items):
+        try:
+            yield _calculate_item(index, item, parser, calculator, data, memo, parsed_texts)
+        except Exception:
+            # generator 一旦拋出例外就無法繼續，串流回應會被截斷：單項失敗只回報該項
+            logger.exception("批次計算第 %d 項失敗", index)
+            yield {"index": index, "ok": False, "error": "計算時發生錯誤", "code": "internal"}
+
+
+def _calculate_item(index, item, parser, calculator, data, memo, parsed_texts):
+    if isinstance(item, str):
+        text = item.strip()
+        parsed = parsed_texts.get(text)
+        if parsed is None:
+            parsed = parsed_texts[text] = parser.parse(text, data)
+    elif isinstance(item, dict):
+        parsed = parser.normalize(item, data)
+    else:
+        parsed = {"error": "每一項必須是文字或物件", "code": "bad_item"}
+
+    if parsed.get("error"):
+        return {"index": index, "ok": False, "error": parsed["error"], "code": parsed["code"]}
+    result = calculator.calculate(parsed, data, memo=memo)
+    if not result["ok"]:
+        return {"index": index, "ok": False, "error": result["error"], "code": result["code"]}
+    return {
+        "index": index,
+        "ok": True,
+        "brand": parsed["brand"],
+        "drink": parsed["drink"],
+        "size": parsed["size"],
+        "ice": parsed["ice"],
+        "sweetness": parsed["sweetness"],
+        "toppings": parsed["toppings"],
+        "removed_toppings": parsed["removed_toppings"],
+        "calories": result["calories"],
+        "sugar": result["sugar"],
+        "ice_fallback": result["ice_fallback"],
+    }
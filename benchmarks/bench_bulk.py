@@ -0,0 +1,70 @@
+"""批次計算 API 效能測試：合成目錄上一次送出數千項點單。
+
+用法：
+  python benchmarks/bench_bulk.py                       # 預設 20 品牌 × 500 品名、每批 5000 項
+  python benchmarks/bench_bulk.py --items 2000 --rounds 5
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from batch_calculator import calculate_batch  # noqa: E402
+from calorie_calculator import CalorieCalculator  # noqa: E402
+from data_loader import DataLoader  # noqa: E402
+from input_parser import UserInputParser  # noqa: E402
+from synthetic import generate_raw, sample_messages  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--brands", type=int, default=20)
+    ap.add_argument("--drinks", type=int, default=500, help="每個品牌的品名數")
+    ap.add_argument("--items", type=int, default=5000, help="每批項目數")
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+
+    raw, catalog = generate_raw(args.brands, args.drinks)
+    loader = DataLoader()
+    loader.build(raw)
+    parser, calculator = UserInputParser(loader), CalorieCalculator(loader)
+    items = sample_messages(catalog, args.items)
+    print(f"目錄：{len(raw['drinks'])} 列，每批 {len(items)} 項")
+
+    best = float("inf")
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        results = list(calculate_batch(items, parser, calculator, loader.snapshot))
+        best = min(best, time.perf_counter() - start)
+    ok = sum(r["ok"] for r in results)
+    print(f"calculate_batch：{best * 1000:.1f} ms/批，{len(items) / best:,.0f} 項/秒（成功 {ok} 項）")
+
+    # 經過 Flask（含 JSON 解碼與串流編碼）的端到端時間；app import 時會初始化服務：
+    # 不讀寫工作目錄裡的真實快取，並清空 Google 金鑰（.env 不會覆寫已存在的環境變數），量測途中不會連到 Sheets
+    os.environ.update(SHEET_CACHE_PATH=os.devnull, SHARED_SNAPSHOT_PATH="", DATA_SOURCE="sheets",
+                      GOOGLE_SERVICE_ACCOUNT_FILE="", GOOGLE_SHEETS_API_KEY="")
+    logging.disable(logging.CRITICAL)
+    import app  # noqa: E402 - 延後 import，避免上面的純計算量測包含 app 初始化
+
+    app._services.update(loader=loader, parser=parser, calculator=calculator)
+    client = app.app.test_client()
+    body = json.dumps({"items": items}, ensure_ascii=False)
+    for stream in ("0", "1"):
+        best = float("inf")
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            resp = client.post(f"/api/calculate?stream={stream}", data=body,
+                               content_type="application/json")
+            resp.get_data()
+            best = min(best, time.perf_counter() - start)
+        label = "NDJSON 串流" if stream == "1" else "JSON"
+        print(f"/api/calculate（{label}）：{best * 1000:.1f} ms/批，{len(items) / best:,.0f} 項/秒")
+
+
+if __name__ == "__main__":
+    main()
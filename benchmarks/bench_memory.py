@@ -0,0 +1,104 @@
+"""飲品營養表的記憶體與查表速度：整數編碼的 DrinkTable 對照原本的 dict／set 表示。
+
+原本的表示（每個展開後的品名一個字串 tuple 鍵與 (熱量, 糖量) tuple 值，brand_drinks、
+drink_variants 再各存一份）在這裡以 legacy_tables() 重現，兩者吃同一份合成目錄。
+
+用法：
+  python benchmarks/bench_memory.py                              # 預設 100 品牌 × 70 品名、一成合併品名
+  python benchmarks/bench_memory.py --brands 200 --drinks 200 --merged-ratio 0.3
+"""
+import argparse
+import os
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from compact_index import DrinkTable, deep_sizeof  # noqa: E402
+from data_loader import _drink_items  # noqa: E402
+from synthetic import generate_raw  # noqa: E402
+
+
+def legacy_tables(rows):
+    """原本 _build_drinks 的 dict／set 表示。"""
+    drinks_index, brand_drinks, drink_variants = {}, {}, {}
+    for (brand, name, size, ice), values in _drink_items(rows):
+        drinks_index[(brand, name, size, ice)] = values
+        brand_drinks.setdefault(brand, set()).add(name)
+        drink_variants.setdefault((brand, name), set()).add((size, ice))
+    return drinks_index, brand_drinks, drink_variants
+
+
+def compact_tables(rows):
+    table = DrinkTable.from_items(_drink_items(rows))
+    return table, table.brand_drinks, table.drink_variants
+
+
+def measure_build(build, rows):
+    """回傳 (三張表, 建置秒數, tracemalloc 量到的常駐位元組)。"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    tables = build(rows)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tables, elapsed, current
+
+
+def per_op(func, items, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--brands", type=int, default=100)
+    ap.add_argument("--drinks", type=int, default=70, help="每個品牌的品名數")
+    ap.add_argument("--merged-ratio", type=float, default=0.1, help="合併品名（A/B/C）的比例")
+    ap.add_argument("--lookups", type=int, default=20000)
+    args = ap.parse_args()
+
+    raw, _ = generate_raw(args.brands, args.drinks, merged_ratio=args.merged_ratio)
+    rows = raw["drinks"]
+    results = {}
+    for name, build in (("dict／set", legacy_tables), ("DrinkTable", compact_tables)):
+        tables, elapsed, traced = measure_build(build, rows)
+        results[name] = (tables, elapsed, traced)
+
+    legacy, compact = results["dict／set"][0], results["DrinkTable"][0]
+    if dict(legacy[0]) != dict(compact[0].items()):
+        sys.exit("兩種表示的內容不同")
+
+    rng = random.Random(0)
+    keys = rng.choices(list(legacy[0]), k=args.lookups)
+    misses = [(brand, name, "XL", ice) for brand, name, _, ice in keys]
+    pairs = [key[:2] for key in keys]
+    print(f"Drinks {len(rows)} 列，展開後 {len(legacy[0])} 個鍵、{len(legacy[2])} 個 (品牌, 品名)")
+    print(f"{'':<14}{'deep_sizeof':>14}{'tracemalloc':>14}{'pickle':>12}{'建置':>10}"
+          f"{'查表命中':>10}{'查表未命中':>10}{'品名集合':>10}{'尺寸冰量':>10}")
+    for name, (tables, elapsed, traced) in results.items():
+        drinks_index, brand_drinks, drink_variants = tables
+        size = deep_sizeof(tables)
+        pickled = len(pickle.dumps(tables, protocol=pickle.HIGHEST_PROTOCOL))
+        hit = per_op(drinks_index.get, keys)
+        miss = per_op(drinks_index.get, misses)
+        names = per_op(lambda pair: pair[1] in brand_drinks.get(pair[0], ()), pairs)
+        variants = per_op(drink_variants.get, pairs)
+        print(f"{name:<14}{size / 2**20:>11.1f} MB{traced / 2**20:>11.1f} MB{pickled / 2**20:>9.1f} MB"
+              f"{elapsed * 1000:>7.0f} ms{hit * 1e9:>7.0f} ns{miss * 1e9:>7.0f} ns{names * 1e9:>7.0f} ns"
+              f"{variants * 1e9:>7.0f} ns")
+    ratio = deep_sizeof(legacy) / deep_sizeof(compact)
+    print(f"DrinkTable 佔用約為 dict／set 的 1/{ratio:.1f}")
+
+
+if __name__ == "__main__":
+    main()
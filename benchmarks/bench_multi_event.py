@@ -0,0 +1,150 @@
+"""多事件 webhook 效能測試：一個請求本文帶多個事件時，逐一回覆與依使用者分組並行回覆的比較。
+
+以本機的假 LINE reply API（每次回覆固定延遲，模擬實際的網路往返）取代真正的 API，
+產生已簽章的 webhook 本文，經 Flask test client 送進 /callback（同步模式），量測每個請求的總耗時，
+並檢查同一使用者的回覆順序與事件順序相同。
+
+用法：
+  python benchmarks/bench_multi_event.py                          # 預設每個 webhook 10 個事件、5 位使用者
+  python benchmarks/bench_multi_event.py --events 20 --users 3 --latency 0.08 --workers 1,4,8
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import generate_raw, sample_messages  # noqa: E402
+
+CHANNEL_SECRET = "bench-secret"
+
+
+class FakeLineAPI(BaseHTTPRequestHandler):
+    """本機假 LINE reply API：每次回覆延遲 latency 秒，依收到順序記錄 reply token。"""
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    replies = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        type(self).replies.append(body["replyToken"])
+        payload = b'{"sentMessages": [{"id": "1", "quoteToken": "q"}]}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_payloads(messages, count, events, users, seed=0):
+    """產生 count 個 webhook 本文，各帶 events 個文字訊息事件，來自 users 位使用者；回傳 [(本文, 簽章)]。"""
+    rng = random.Random(seed)
+    texts = iter(messages * (count * events // len(messages) + 1))
+    payloads = []
+    for n in range(count):
+        batch = []
+        for i in range(events):
+            user = f"U{rng.randrange(users):04d}"
+            batch.append({
+                "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+                "source": {"type": "user", "userId": user}, "webhookEventId": f"W{n}-{i}",
+                "deliveryContext": {"isRedelivery": False}, "replyToken": f"{user}:{n}:{i}",
+                "message": {"type": "text", "id": str(i), "quoteToken": "q", "text": next(texts)},
+            })
+        body = json.dumps({"destination": "D", "events": batch}, ensure_ascii=False)
+        digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+        payloads.append((body, base64.b64encode(digest).decode()))
+    return payloads
+
+
+def in_user_order(tokens):
+    """回覆順序中，同一使用者同一請求的事件編號是否遞增。"""
+    last = {}
+    for token in tokens:
+        user, request, index = token.split(":")
+        if int(index) < last.get((user, request), -1):
+            return False
+        last[(user, request)] = int(index)
+    return True
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--events", type=int, default=10, help="每個 webhook 的事件數")
+    ap.add_argument("--users", type=int, default=5, help="事件來自幾位使用者")
+    ap.add_argument("--requests", type=int, default=20, help="webhook 請求數")
+    ap.add_argument("--latency", type=float, default=0.05, help="假 LINE API 每次回覆的延遲（秒）")
+    ap.add_argument("--workers", default="1,4,8", help="要比較的 EVENT_WORKERS（逗號分隔，1 為逐一處理）")
+    args = ap.parse_args()
+
+    # app import 時會初始化服務：使用固定的簽章金鑰，並避免讀寫工作目錄裡的真實快取；
+    # 清空 Google 金鑰（.env 不會覆寫已存在的環境變數），量測途中不會連到 Sheets；
+    # 少數使用者連續送出大量事件，停用准入控制以免被限流
+    os.environ.update(LINE_CHANNEL_SECRET=CHANNEL_SECRET, SHEET_CACHE_PATH=os.devnull,
+                      SHARED_SNAPSHOT_PATH="", DATA_SOURCE="sheets", GOOGLE_SERVICE_ACCOUNT_FILE="",
+                      GOOGLE_SHEETS_API_KEY="", REPLY_MODE="sync", USER_RATE_LIMIT="0", MAX_INFLIGHT_EVENTS="0")
+    logging.disable(logging.CRITICAL)
+    import app
+    from calorie_calculator import CalorieCalculator
+    from data_loader import DataLoader
+    from input_parser import UserInputParser
+    from line_client import LineReplyClient
+    from linebot.v3.messaging import Configuration
+    from reply_worker import EventFanout
+
+    raw, catalog = generate_raw(10, 100)
+    loader = DataLoader(cache_path=os.devnull)
+    loader.build(raw)
+    app._services.update(loader=loader, parser=UserInputParser(loader), calculator=CalorieCalculator(loader))
+
+    FakeLineAPI.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLineAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.line_client = LineReplyClient(Configuration(host=f"http://127.0.0.1:{server.server_address[1]}",
+                                                    access_token="bench"), pool_size=16)
+    payloads = make_payloads(sample_messages(catalog, 500), args.requests, args.events, args.users)
+    client = app.app.test_client()
+    print(f"每個 webhook {args.events} 個事件、{args.users} 位使用者，LINE API 延遲 {args.latency * 1000:.0f} ms，"
+          f"共 {args.requests} 個請求")
+
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        app._fanout.stop()
+        app._fanout = EventFanout(app._reply_events, workers=workers)
+        FakeLineAPI.replies.clear()
+        app._dedup.clear()  # 每一輪送的是同一批事件 id，不清掉會被當成重送略過
+        latencies = []
+        for body, signature in payloads:
+            start = time.perf_counter()
+            resp = client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+            latencies.append(time.perf_counter() - start)
+            assert resp.status_code == 200, resp.status_code
+        latencies.sort()
+        avg = sum(latencies) / len(latencies)
+        baseline = baseline or avg
+        ordered = in_user_order(FakeLineAPI.replies)
+        complete = len(FakeLineAPI.replies) == args.requests * args.events
+        print(f"  workers={workers:<3} 平均 {avg * 1000:7.1f} ms  p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:7.1f} ms"
+              f"  {baseline / avg:4.1f}x  順序{'正確' if ordered else '錯誤'}"
+              f"{'' if complete else '（回覆數不足）'}")
+    app._fanout.stop()
+    app.line_client.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
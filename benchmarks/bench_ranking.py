@@ -0,0 +1,53 @@
+"""排行索引效能測試：合成目錄上的建置時間與各種查詢延遲。
+
+用法：
+  python benchmarks/bench_ranking.py                    # 預設 20 品牌 × 1000 品名
+  python benchmarks/bench_ranking.py --brands 50 --drinks 500 --queries 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from data_loader import DataLoader  # noqa: E402
+from ranking_index import RankingIndex  # noqa: E402
+from synthetic import generate_raw  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--brands", type=int, default=20)
+    ap.add_argument("--drinks", type=int, default=1000, help="每個品牌的品名數")
+    ap.add_argument("--queries", type=int, default=10000, help="每種查詢的次數")
+    args = ap.parse_args()
+
+    raw, _ = generate_raw(args.brands, args.drinks)
+    data = DataLoader(cache_path=os.devnull).build(raw)
+    start = time.perf_counter()
+    ranking = RankingIndex.build(data.drinks_index, data.sweet_map)
+    print(f"目錄：{len(raw['drinks'])} 列，排行索引 {ranking.rows} 列，"
+          f"建置 {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    rng = random.Random(0)
+    brands = sorted(data.brand_drinks)
+    scenarios = {
+        "前 10 低卡（全部）": {},
+        "300 大卡以下前 10": {"high": 300},
+        "L／冰 200~500 大卡": {"low": 200, "high": 500, "size": "L", "ice": "I"},
+        "糖量最高前 10": {"metric": "sugar", "descending": True},
+    }
+    for label, kwargs in scenarios.items():
+        picks = [rng.choice(brands) for _ in range(args.queries)]
+        start = time.perf_counter()
+        for brand in picks:
+            ranking.query(brand, limit=10, **kwargs)
+        elapsed = (time.perf_counter() - start) / args.queries
+        print(f"{label}：{elapsed * 1e6:.1f} µs/次")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""品名建議效能測試：大型合成目錄上，n-gram 索引與逐一計算編輯距離的延遲比較。
+
+以目錄中的品名製造錯字（替換、刪除、插入、相鄰對調一個字）當作查詢，量測：
+- SuggestionIndex.suggest 的建置時間、p50／p99／最大延遲
+- 逐一對品牌所有品名算編輯距離（naive）的平均延遲（只跑少量查詢）
+- 兩者的前 3 名是否包含原本的品名（建議品質）
+
+用法：
+  python benchmarks/bench_suggest.py                    # 預設 20 品牌 × 5000 品名
+  python benchmarks/bench_suggest.py --drinks 20000 --queries 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from data_loader import DataLoader  # noqa: E402
+from fuzzy_index import SuggestionIndex  # noqa: E402
+from synthetic import generate_raw  # noqa: E402
+
+_NOISE = "茶奶綠紅烏龍珍珠波霸果香檸"
+
+
+def typo(name, rng):
+    """隨機替換、刪除、插入或對調一個字。"""
+    i = rng.randrange(len(name))
+    kind = rng.randrange(4)
+    if kind == 0:
+        return name[:i] + rng.choice(_NOISE) + name[i + 1:]
+    if kind == 1 and len(name) > 2:
+        return name[:i] + name[i + 1:]
+    if kind == 2:
+        return name[:i] + rng.choice(_NOISE) + name[i:]
+    i = min(i, len(name) - 2)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def naive_suggest(names, text, limit=3):
+    return sorted(names, key=lambda name: (edit_distance(text, name), name))[:limit]
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--brands", type=int, default=20)
+    ap.add_argument("--drinks", type=int, default=5000, help="每個品牌的品名數")
+    ap.add_argument("--queries", type=int, default=2000)
+    ap.add_argument("--naive-queries", type=int, default=20, help="naive 掃描的查詢數（很慢）")
+    args = ap.parse_args()
+
+    raw, catalog = generate_raw(args.brands, args.drinks)
+    data = DataLoader(cache_path=os.devnull).build(raw)
+    start = time.perf_counter()
+    index = SuggestionIndex.build(data.brand_drinks, data.drinks_alias_map)
+    print(f"目錄：{args.brands} 品牌 × {args.drinks} 品名，建置 {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    rng = random.Random(0)
+    queries = []
+    for _ in range(args.queries):
+        brand, names = rng.choice(catalog)
+        name = rng.choice(names)
+        queries.append((brand, name, typo(name, rng)))
+
+    latencies, hits = [], 0
+    for brand, name, text in queries:
+        start = time.perf_counter()
+        suggestions = index.suggest(brand, text)
+        latencies.append(time.perf_counter() - start)
+        hits += name in suggestions
+    latencies.sort()
+    print(f"n-gram 索引：p50 {percentile(latencies, 0.5) * 1e6:.0f} µs，p99 {percentile(latencies, 0.99) * 1e6:.0f} µs，"
+          f"最大 {latencies[-1] * 1e6:.0f} µs；前 3 名命中 {hits / len(queries):.1%}")
+
+    names_by_brand = {brand: sorted(names) for brand, names in catalog}
+    naive = queries[:args.naive_queries]
+    hits = 0
+    start = time.perf_counter()
+    for brand, name, text in naive:
+        hits += name in naive_suggest(names_by_brand[brand], text)
+    elapsed = (time.perf_counter() - start) / len(naive)
+    print(f"naive 編輯距離掃描：平均 {elapsed * 1000:.1f} ms；前 3 名命中 {hits / len(naive):.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""效能測試套件：以合成目錄量測各階段的單次耗時與整體吞吐量，輸出 JSON，並可與基準比較。
+
+各項目（數值都是「每次操作秒數」，越小越好）：
+  build            DataLoader.build 全部重建一次
+  snapshot_load    從索引快照檔載入（重啟時的快速路徑）
+  parse            UserInputParser.parse 每則訊息
+  calculate        CalorieCalculator.calculate 每筆（已解析的點單）
+  build_reply      app.build_reply 每則訊息（停用回覆快取，量測實際計算）
+  build_reply_cached  同上但啟用回覆快取（熱門訊息重複出現時）
+  ranking_query    RankingIndex.query 每次
+  suggest          SuggestionIndex.suggest 每次
+  throughput       依 message_mix 的實際訊息組合跑 build_reply，另外回報 p50/p95/p99
+
+用法：
+  python benchmarks/suite.py                                  # 預設 100 品牌、約 2 萬列
+  python benchmarks/suite.py --quick                          # 小目錄快速檢查
+  python benchmarks/suite.py --output bench.json              # 寫出結果
+  python benchmarks/suite.py --compare baseline.json --threshold 0.2
+      # 與基準比較，任一項目慢超過 20% 即以結束碼 1 結束（適合放進 CI）
+  python benchmarks/suite.py --only parse,calculate
+
+比較時只比對兩邊都有的項目；目錄參數不同時會提出警告（數字不可直接比較）。
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from calorie_calculator import CalorieCalculator  # noqa: E402
+from data_loader import SNAPSHOT_SCHEMA, DataLoader  # noqa: E402
+from index_snapshot import read_snapshot, write_snapshot  # noqa: E402
+from input_parser import UserInputParser  # noqa: E402
+from synthetic import generate_raw, message_mix, sample_messages  # noqa: E402
+
+# 各 bench_ 方法；有些方法一次記錄多個項目（見 _RECORDED_BY）
+STAGES = ("build", "snapshot_load", "parse", "calculate", "build_reply", "ranking_query", "suggest", "throughput")
+_RECORDED_BY = {"build_reply_cached": "build_reply"}
+ITEMS = STAGES[:5] + tuple(_RECORDED_BY) + STAGES[5:]
+
+CATALOG_OPTIONS = ("brands", "drinks", "toppings", "merged_ratio", "alias_ratio", "aliases_per_drink",
+                   "brand_aliases", "sweetness_levels", "seed")
+
+
+def timed(func, repeat):
+    """執行 func() repeat 次，回傳最快一次的秒數（減少背景雜訊的影響）。"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def per_op(func, items, repeat):
+    """對每個 item 呼叫 func，回傳每次操作的秒數（取 repeat 輪中最快的一輪）。"""
+    def run():
+        for item in items:
+            func(item)
+    return timed(run, repeat) / len(items)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class Suite:
+    def __init__(self, args):
+        self.args = args
+        self.raw, self.catalog = generate_raw(
+            args.brands, args.drinks, args.toppings, args.seed, merged_ratio=args.merged_ratio,
+            alias_ratio=args.alias_ratio, aliases_per_drink=args.aliases_per_drink,
+            brand_aliases=args.brand_aliases, sweetness_levels=args.sweetness_levels)
+        self.loader = DataLoader(cache_path=os.devnull)
+        self.data = self.loader.build(self.raw)
+        self.parser = UserInputParser(self.loader)
+        self.calculator = CalorieCalculator(self.loader)
+        self.orders = sample_messages(self.catalog, args.messages, args.seed, args.toppings)
+        self.mix = message_mix(self.catalog, args.messages, args.seed, args.toppings)
+        self.results = {}
+
+    def record(self, name, seconds, **extra):
+        self.results[name] = {"seconds": seconds, **extra}
+        details = "".join(f"，{key} {value}" for key, value in extra.items())
+        print(f"  {name:<20} {_format_seconds(seconds)}/次{details}")
+
+    # --- 各階段 ---
+    def bench_build(self):
+        self.record("build", timed(lambda: DataLoader(cache_path=os.devnull).build(self.raw),
+                                   max(1, self.args.repeat // 2)),
+                    rows=len(self.raw["drinks"]))
+
+    def bench_snapshot_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index_snapshot.bin")
+            write_snapshot(path, self.data, SNAPSHOT_SCHEMA)
+            self.record("snapshot_load", timed(lambda: read_snapshot(path, SNAPSHOT_SCHEMA), self.args.repeat),
+                        bytes=os.path.getsize(path))
+
+    def bench_parse(self):
+        self.record("parse", per_op(lambda text: self.parser.parse(text, self.data), self.orders,
+                                    self.args.repeat))
+
+    def bench_calculate(self):
+        parsed = [p for p in (self.parser.parse(text, self.data) for text in self.orders) if "error" not in p]
+        self.record("calculate", per_op(lambda order: self.calculator.calculate(order, self.data), parsed,
+                                        self.args.repeat))
+
+    def bench_build_reply(self):
+        app = self._app()
+        texts = [text for _, text in self.mix]
+        app._reply_cache = app.ReplyCache(maxsize=0)
+        self.record("build_reply", per_op(app.build_reply, texts, self.args.repeat))
+        app._reply_cache = app.ReplyCache(maxsize=1024, ttl=0)
+        self.record("build_reply_cached", per_op(app.build_reply, texts, self.args.repeat))
+
+    def bench_ranking_query(self):
+        brands = [brand for brand, _ in self.catalog]
+        queries = [(brands[i % len(brands)], 100 + i % 500) for i in range(self.args.messages)]
+        self.record("ranking_query", per_op(lambda q: self.data.ranking.query(q[0], high=q[1]), queries,
+                                            self.args.repeat))
+
+    def bench_suggest(self):
+        # typo 訊息為「品牌 錯字品名 甜度」
+        typos = [tuple(text.split()[:2]) for kind, text in self.mix if kind == "typo"]
+        if typos:
+            self.record("suggest", per_op(lambda q: self.data.suggestions.suggest(*q), typos, self.args.repeat))
+
+    def bench_throughput(self):
+        app = self._app()
+        app._reply_cache = app.ReplyCache(maxsize=1024, ttl=0)
+        latencies = []
+        start = time.perf_counter()
+        for _, text in self.mix:
+            t0 = time.perf_counter()
+            app.build_reply(text)
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        self.record("throughput", elapsed / len(latencies),
+                    messages_per_second=round(len(latencies) / elapsed),
+                    p50_us=round(percentile(latencies, 0.50) * 1e6, 1),
+                    p95_us=round(percentile(latencies, 0.95) * 1e6, 1),
+                    p99_us=round(percentile(latencies, 0.99) * 1e6, 1))
+
+    def _app(self):
+        # app import 時會初始化服務：指向不存在的快取，避免讀寫工作目錄裡的真實快取；
+        # 清空 Google 金鑰（.env 不會覆寫已存在的環境變數），量測途中不會連到 Sheets
+        os.environ.update(SHEET_CACHE_PATH=os.devnull, SHARED_SNAPSHOT_PATH="", DATA_SOURCE="sheets",
+                          GOOGLE_SERVICE_ACCOUNT_FILE="", GOOGLE_SHEETS_API_KEY="")
+        logging.disable(logging.CRITICAL)
+        import app
+        app._services.update(loader=self.loader, parser=self.parser, calculator=self.calculator)
+        return app
+
+    def run(self, only=None):
+        if only:
+            only = {_RECORDED_BY.get(item, item) for item in only}
+        for stage in STAGES:
+            if only and stage not in only:
+                continue
+            getattr(self, f"bench_{stage}")()
+        return self.results
+
+
+def _format_seconds(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} µs"
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, catalog, baseline_path, threshold):
+    """印出與基準的比較，回傳變慢超過門檻的項目。"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("catalog") != catalog:
+        print(f"⚠️  基準的目錄參數不同，數字不可直接比較：{baseline.get('catalog')}")
+    regressions = []
+    print(f"\n與基準比較（{baseline_path}，門檻 +{threshold:.0%}）：")
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        change = result["seconds"] / before["seconds"] - 1
+        flag = "❌" if change > threshold else "✅"
+        print(f"  {flag} {name:<20} {_format_seconds(before['seconds'])} -> "
+              f"{_format_seconds(result['seconds'])}（{change:+.1%}）")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--brands", type=int, default=100)
+    ap.add_argument("--drinks", type=int, default=70, help="每個品牌的品名數（預設約 2 萬列 Drinks）")
+    ap.add_argument("--toppings", type=int, default=30, help="配料數（Toppings 表的品牌欄位數 = 品牌數）")
+    ap.add_argument("--merged-ratio", type=float, default=0.1, help="合併品名（A/B/C）的比例")
+    ap.add_argument("--alias-ratio", type=float, default=0.3, help="有品名別名的比例")
+    ap.add_argument("--aliases-per-drink", type=int, default=2)
+    ap.add_argument("--brand-aliases", type=int, default=1, help="每個品牌的別名數")
+    ap.add_argument("--sweetness-levels", type=int, default=5, help="甜度表列數（最多 14）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--messages", type=int, default=5000, help="訊息數（parse、build_reply、throughput）")
+    ap.add_argument("--repeat", type=int, default=5, help="每項重複輪數，取最快一輪")
+    ap.add_argument("--quick", action="store_true", help="小目錄、少量訊息，快速檢查")
+    ap.add_argument("--only", help=f"只跑指定項目（逗號分隔）：{'、'.join(ITEMS)}")
+    ap.add_argument("--output", help="把結果寫成 JSON 檔（可作為之後 --compare 的基準）")
+    ap.add_argument("--compare", metavar="BASELINE", help="與基準 JSON 比較")
+    ap.add_argument("--threshold", type=float, default=0.2, help="變慢超過此比例視為退步，預設 0.2")
+    args = ap.parse_args()
+    only = set(args.only.split(",")) if args.only else None
+    if only and only - set(ITEMS):
+        ap.error(f"未知的項目：{'、'.join(sorted(only - set(ITEMS)))}（可用：{'、'.join(ITEMS)}）")
+    if args.quick:
+        args.brands, args.drinks, args.messages, args.repeat = 10, 50, 500, 2
+
+    catalog = {name: getattr(args, name) for name in CATALOG_OPTIONS}
+    suite = Suite(args)
+    print(f"目錄：{args.brands} 品牌、{len(suite.raw['drinks'])} 列 Drinks、{args.messages} 則訊息")
+    results = suite.run(only)
+
+    report = {
+        "catalog": catalog,
+        "messages": args.messages,
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "commit": _git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+    if args.compare:
+        regressions = compare(results, catalog, args.compare, args.threshold)
+        if regressions:
+            print(f"退步超過 {args.threshold:.0%}：{'、'.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
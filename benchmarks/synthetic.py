@@ -0,0 +1,138 @@
+"""產生合成的工作表原始資料（與 DataLoader.build 吃的格式相同），供效能測試使用。
+
+資料以固定 seed 產生，同樣的參數每次結果都一樣，方便前後比較。
+"""
+import random
+
+SIZES = ("L", "M")
+ICES = ("I", "H")
+SWEETNESS = ("正常", "少糖", "半糖", "微糖", "無糖")
+# sweetness_levels 超過 5 時依序加入的甜度（名稱, 剩餘糖量 %）
+_EXTRA_SWEETNESS = (("九分糖", 90), ("八分糖", 80), ("七分糖", 70), ("六分糖", 60), ("四分糖", 40),
+                    ("三分糖", 30), ("二分糖", 20), ("一分糖", 10), ("微微糖", 5))
+_TEA = ("紅茶", "綠茶", "青茶", "烏龍", "鐵觀音", "普洱", "高山", "四季春", "金萱", "翡翠")
+_MILK = ("奶茶", "奶綠", "奶青", "拿鐵", "歐蕾", "", "", "")
+_PREFIX = ("珍珠", "波霸", "椰果", "仙草", "布丁", "冰淇淋", "黑糖", "檸檬", "百香", "")
+
+
+def generate_raw(brands=10, drinks_per_brand=200, toppings=20, seed=0, *, merged_ratio=0.0,
+                 alias_ratio=0.3, aliases_per_drink=2, brand_aliases=1, sweetness_levels=5):
+    """回傳 (raw, catalog)；catalog 為 [(品牌, [品名...])]，方便產生測試訊息。
+
+    merged_ratio：品名寫成「品名N/奶綠合N/奶青合N」合併格式的比例（50嵐 的資料慣例）
+    alias_ratio / aliases_per_drink：有品名別名的比例與每個品名的別名數
+    brand_aliases：每個品牌的別名數（B000、B000-1、…）
+    sweetness_levels：甜度表的列數（5 為 正常～無糖，最多 14）
+    預設值產生的資料與加入這些參數之前完全相同。
+    """
+    rng = random.Random(seed)
+    brand_names = [f"品牌{i:03d}" for i in range(brands)]
+    drinks, drinks_alias, catalog = [], [], []
+    for brand in brand_names:
+        names = []
+        while len(names) < drinks_per_brand:
+            name = rng.choice(_PREFIX) + rng.choice(_TEA) + rng.choice(_MILK) + str(len(names))
+            names.append(name)
+        catalog.append((brand, names))
+        for name in names:
+            base_cal = rng.randint(80, 700)
+            base_sugar = rng.randint(0, 60)
+            sheet_name = name
+            if merged_ratio and rng.random() < merged_ratio:
+                # 後段比第一段短，展開時取代第一段結尾；帶編號，不與其他品名重複
+                suffix = name[len(name.rstrip("0123456789")):]
+                sheet_name = "/".join([name] + [f"{other}合{suffix}" for other in ("奶綠", "奶青")])
+            for size in SIZES:
+                scale = 1.0 if size == "L" else 0.75
+                for ice in ICES[:rng.choice((1, 2))]:
+                    drinks.append({"Brand_Standard_Name": brand, "Standard_Drinks_Name": sheet_name,
+                                   "Size": size, "冰量": ice, "熱量": round(base_cal * scale),
+                                   "糖量": round(base_sugar * scale, 1)})
+            if rng.random() < alias_ratio:
+                aliases = [f"{name}別名", f"{name[:2]}{name[-2:]}"]
+                aliases += [f"{name}別名{k}" for k in range(2, aliases_per_drink)]
+                drinks_alias.append({"Brand_Standard_Name": brand, "Standard_Drinks_Name": name,
+                                     "Alias_Drinks_Name": ", ".join(aliases[:aliases_per_drink])})
+
+    topping_rows = []
+    for i in range(toppings):
+        row = {"Topping_Name": f"配料{i}", "熱量": rng.randint(10, 200), "糖量": rng.randint(0, 20)}
+        row.update({brand: "V" if rng.random() < 0.7 else "" for brand in brand_names})
+        topping_rows.append(row)
+
+    levels = list(zip(SWEETNESS, (100, 70, 50, 30, 0))) + list(_EXTRA_SWEETNESS)
+    brand_sweet = [["Brand-sweet_setting", *brand_names]]
+    for level, ratio in levels[:sweetness_levels]:
+        brand_sweet.append([level, *[f"{ratio}%" if rng.random() < 0.9 else "" for _ in brand_names]])
+
+    brands_alias = []
+    for i, brand in enumerate(brand_names):
+        brands_alias += [{"Brand_Alias_Name": f"B{i:03d}" + (f"-{k}" if k else ""),
+                          "Brand_Standard_Name": brand} for k in range(brand_aliases)]
+
+    raw = {
+        "drinks": drinks,
+        "toppings": topping_rows,
+        "brand_sweet": brand_sweet,
+        "brands_alias": brands_alias,
+        "size_alias": [{"Size_Alias": "大杯", "Size": "L"}, {"Size_Alias": "大", "Size": "L"},
+                       {"Size_Alias": "中杯", "Size": "M"}, {"Size_Alias": "中", "Size": "M"}],
+        "drinks_alias": drinks_alias,
+    }
+    return raw, catalog
+
+
+def sample_messages(catalog, count, seed=0, toppings=20):
+    """產生使用者訊息：品牌（有時用別名）+ 品名 + 隨機尺寸/冰量/甜度/配料。"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        index = rng.randrange(len(catalog))
+        brand, names = catalog[index]
+        parts = [brand if rng.random() < 0.7 else f"B{index:03d}", rng.choice(names)]
+        if rng.random() < 0.5:
+            parts.append(rng.choice(("大杯", "中杯", "大", "中")))
+        if rng.random() < 0.4:
+            parts.append(rng.choice(("熱", "去冰", "少冰")))
+        if rng.random() < 0.6:
+            parts.append(rng.choice(SWEETNESS))
+        if rng.random() < 0.3:
+            parts.append(f"+配料{rng.randrange(toppings)}")
+        messages.append(" ".join(parts))
+    return messages
+
+
+# message_mix 預設的訊息組成（比例）：大部分是正常點單，其餘為常見的「非標準」輸入
+DEFAULT_MIX = {"order": 0.70, "unspaced": 0.10, "typo": 0.08, "unknown_brand": 0.04,
+               "ranking": 0.05, "too_short": 0.03}
+
+
+def message_mix(catalog, count, seed=0, toppings=20, mix=None):
+    """產生接近實際流量的訊息組合，回傳 [(種類, 訊息)]。
+
+    order：sample_messages 的正常點單；unspaced：同樣的點單去掉空白；typo：品名錯一個字；
+    unknown_brand：不存在的品牌；ranking：低卡／高糖等排行指令；too_short：只打品牌。
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    orders = iter(sample_messages(catalog, count, seed, toppings))
+    messages = []
+    for kind in kinds:
+        brand, names = rng.choice(catalog)
+        if kind == "order":
+            text = next(orders)
+        elif kind == "unspaced":
+            text = "".join(next(orders).split())
+        elif kind == "typo":
+            name = rng.choice(names)
+            i = rng.randrange(len(name))
+            text = f"{brand} {name[:i]}{rng.choice('茶奶綠紅珍')}{name[i + 1:]} {rng.choice(SWEETNESS)}"
+        elif kind == "unknown_brand":
+            text = f"不存在{rng.randrange(1000)} {rng.choice(names)}"
+        elif kind == "ranking":
+            text = f"{rng.choice(('低卡', '高卡', '低糖', '高糖'))} {brand} {rng.randrange(100, 600)}以下"
+        else:
+            text = brand
+        messages.append((kind, text))
+    return messages
@@ -7,62 +7,61 @@
 
 配料：需在 Toppings 表中該品牌欄位打 "V" 才可加減；熱飲查無資料時退回冰飲數值。
 回傳格式：{"ok": True, "calories": int, "sugar": float, "ice_fallback": bool}
-或 {"ok": False, "error": 錯誤訊息}
+或 {"ok": False, "error": 錯誤訊息, "code": 錯誤類別}（unknown_sweetness、unknown_size 等固定代碼）
+
+每次計算只取一次 loader.snapshot（或由呼叫端傳入與解析時相同的 data），
+refresh 進行中也不會讀到新舊混雜的資料。
+
+批次計算時可傳入 memo（dict）：同一批中相同的 (品牌, 品名, 尺寸, 冰量) 查表
+與配料查表只做一次。memo 只能在同一份 data 內共用。
+
+快照帶有預先算好的結果矩陣（data.matrix，見 nutrition_matrix）時，飲品加甜度
+直接查表，只剩配料需要逐項加減；矩陣查不到（尺寸不存在、品牌無此甜度等）
+才走下面的逐步計算，錯誤訊息維持一致。
 """
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def _error(message):
-    return {"ok": False, "error": message}
+def _error(failure):
+    return {"ok": False, "error": failure["error"], "code": failure["code"]}
+
+
+def _failure(code, message):
+    return {"error": message, "code": code}
 
 
 class CalorieCalculator:
     def __init__(self, data_loader):
         self.loader = data_loader
 
-    def calculate(self, parsed: dict) -> dict:
+    def calculate(self, parsed: dict, data=None, memo=None) -> dict:
+        data = data or self.loader.snapshot
         brand, drink = parsed["brand"], parsed["drink"]
         size, ice = parsed["size"], parsed["ice"]
-
-        row = self.loader.drinks_index.get((brand, drink, size, ice))
-        fallback = False
-        if row is None and ice == "H":
-            row = self.loader.drinks_index.get((brand, drink, size, "I"))
-            fallback = row is not None
-        if row is None:
-            variants = self.loader.drink_variants.get((brand, drink))
-            if variants:
-                sizes = "、".join(sorted({s for s, _ in variants}))
-                return _error(f"「{drink}」沒有 {size} 尺寸的資料，可選尺寸：{sizes}")
-            return _error(f"資料表中查無「{brand} {drink}」，請檢查 Drinks 工作表")
-
-        calories, sugar = row
-        if calories is None or sugar is None:
-            return _error(f"「{brand} {drink}」的熱量或糖量欄位不是有效數字，請檢查 Google Sheets")
-
         sweetness = parsed.get("sweetness")
-        if sweetness:
-            brand_sweets = self.loader.sweet_map.get(brand, {})
-            ratio = brand_sweets.get(sweetness)
-            if ratio is None:
-                available = "、".join(s for s in self.loader.sweetness_order if s in brand_sweets)
-                return _error(f"{brand} 沒有提供「{sweetness}」，可選甜度：{available or '（無資料）'}")
-            calories -= sugar * (1 - ratio) * 4
-            sugar *= ratio
+
+        hit = data.matrix.lookup(brand, drink, size, ice, sweetness) if data.matrix is not None else None
+        if hit is not None:
+            calories, sugar, fallback = hit
+        else:
+            base = self._sweetened_values(data, brand, drink, size, ice, sweetness, memo)
+            if "error" in base:
+                return _error(base)
+            calories, sugar, fallback = base["calories"], base["sugar"], base["fallback"]
 
         for name, count in parsed.get("toppings", []):
-            delta = self._topping_values(brand, name)
+            delta = self._cached_topping(data, brand, name, memo)
             if "error" in delta:
-                return _error(delta["error"])
+                return _error(delta)
             calories += delta["calories"] * count
             sugar += delta["sugar"] * count
 
         for name, count in parsed.get("removed_toppings", []):
-            delta = self._topping_values(brand, name)
+            delta = self._cached_topping(data, brand, name, memo)
             if "error" in delta:
-                return _error(delta["error"])
+                return _error(delta)
             calories -= delta["calories"] * count
             sugar -= delta["sugar"] * count
 
@@ -74,15 +73,70 @@ class CalorieCalculator:
             "ice_fallback": fallback,
         }
 
-    def _topping_values(self, brand, name):
-        values = self.loader.toppings_map.get(name)
+    def _sweetened_values(self, data, brand, drink, size, ice, sweetness, memo):
+        """逐步計算：查飲品基礎值後套用甜度比例（與 NutritionMatrix 的公式與運算順序相同）。"""
+        base = self._cached_base(data, brand, drink, size, ice, memo)
+        if "error" in base or not sweetness:
+            return base
+        brand_sweets = data.sweet_map.get(brand, {})
+        ratio = brand_sweets.get(sweetness)
+        if ratio is None:
+            available = "、".join(s for s in data.sweetness_order if s in brand_sweets)
+            return _failure("unknown_sweetness",
+                            f"{brand} 沒有提供「{sweetness}」，可選甜度：{available or '（無資料）'}")
+        calories, sugar = base["calories"], base["sugar"]
+        calories -= sugar * (1 - ratio) * 4
+        sugar *= ratio
+        return {"calories": calories, "sugar": sugar, "fallback": base["fallback"]}
+
+    @staticmethod
+    def _base_values(data, brand, drink, size, ice):
+        """查飲品基礎熱量與糖量；熱飲查無資料時退回冰飲。"""
+        row = data.drinks_index.get((brand, drink, size, ice))
+        fallback = False
+        if row is None and ice == "H":
+            row = data.drinks_index.get((brand, drink, size, "I"))
+            fallback = row is not None
+        if row is None:
+            variants = data.drink_variants.get((brand, drink))
+            if variants:
+                sizes = "、".join(sorted({s for s, _ in variants}))
+                return _failure("unknown_size", f"「{drink}」沒有 {size} 尺寸的資料，可選尺寸：{sizes}")
+            return _failure("missing_row", f"資料表中查無「{brand} {drink}」，請檢查 Drinks 工作表")
+
+        calories, sugar = row
+        if calories is None or sugar is None:
+            return _failure("invalid_value", f"「{brand} {drink}」的熱量或糖量欄位不是有效數字，請檢查 Google Sheets")
+        return {"calories": calories, "sugar": sugar, "fallback": fallback}
+
+    def _cached_base(self, data, brand, drink, size, ice, memo):
+        if memo is None:
+            return self._base_values(data, brand, drink, size, ice)
+        key = ("drink", brand, drink, size, ice)
+        base = memo.get(key)
+        if base is None:
+            base = memo[key] = self._base_values(data, brand, drink, size, ice)
+        return base
+
+    def _cached_topping(self, data, brand, name, memo):
+        if memo is None:
+            return self._topping_values(data, brand, name)
+        key = ("topping", brand, name)
+        delta = memo.get(key)
+        if delta is None:
+            delta = memo[key] = self._topping_values(data, brand, name)
+        return delta
+
+    @staticmethod
+    def _topping_values(data, brand, name):
+        values = data.toppings_map.get(name)
         if values is None:
-            return {"error": f"找不到配料「{name}」，請確認名稱"}
-        if name not in self.loader.brand_toppings.get(brand, set()):
-            available = "、".join(sorted(self.loader.brand_toppings.get(brand, set())))
+            return _failure("unknown_topping", f"找不到配料「{name}」，請確認名稱")
+        if name not in data.brand_toppings.get(brand, set()):
+            available = "、".join(sorted(data.brand_toppings.get(brand, set())))
             suffix = f"，可選配料：{available}" if available else ""
-            return {"error": f"{brand} 沒有提供配料「{name}」{suffix}"}
+            return _failure("topping_unavailable", f"{brand} 沒有提供配料「{name}」{suffix}")
         calories, sugar = values
         if calories is None or sugar is None:
-            return {"error": f"配料「{name}」的熱量或糖量欄位不是有效數字，請檢查 Google Sheets"}
+            return _failure("invalid_value", f"配料「{name}」的熱量或糖量欄位不是有效數字，請檢查 Google Sheets")
         return {"calories": calories, "sugar": sugar}
@@ -0,0 +1,154 @@
+# circuit_breaker.py
+"""資料來源（Google Sheets）故障時的斷路器與單一進行中（single-flight）呼叫。
+
+Sheets 掛掉又沒有本機快取時，舊做法每則訊息都會呼叫 init_services()：所有執行緒排隊等 _lock，
+輪到後各自重新驗證金鑰、抓一次 Sheets。訊息一多就變成大量卡住的執行緒與 API 呼叫。
+
+- CircuitBreaker：連續失敗達 threshold 次即「斷開」，之後 retry_in() 秒內 allow() 一律回傳 False，
+  呼叫端立即回覆維護訊息；等待時間以指數退避（base_delay × 2^(n-1)，上限 max_delay）加上 ±jitter 比例的抖動，
+  多個 worker 不會同時重試。到期後「半開」只放行一次試探，成功即恢復、失敗則以更長的等待再次斷開。
+- SingleFlight：同一時間只執行一次，期間其他呼叫者等待並共用同一個結果。
+"""
+import random
+import threading
+import time
+
+from metrics import isoformat
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """斷路器斷開中，未實際呼叫。"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"斷路器斷開中，{retry_in:.0f} 秒後重試")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=1, base_delay=2.0, max_delay=300.0, jitter=0.2, clock=time.monotonic,
+                 rng=random.random):
+        self.threshold = max(1, threshold)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._clock = clock
+        self._rng = rng
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0          # 連續失敗次數
+        self.opened = 0            # 累計斷開次數
+        self.last_error = None
+        self._retry_at = None      # clock() 時間；斷開中才有值
+        self._retry_wall = None    # 同一時刻的 time.time()，供 /healthz 顯示
+
+    def allow(self):
+        """是否可以呼叫。斷開且未到重試時間時回傳 False；到期後只放行第一個呼叫者（半開）。"""
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN and self._clock() >= self._retry_at:
+                self.state = HALF_OPEN
+                return True
+            return self.state == CLOSED
+
+    def retry_in(self):
+        """距離下次重試的秒數；沒有斷開時為 0。"""
+        retry_at = self._retry_at
+        if self.state == CLOSED or retry_at is None:
+            return 0.0
+        return max(0.0, retry_at - self._clock())
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.last_error = None
+            self._retry_at = self._retry_wall = None
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failures += 1
+            if error is not None:
+                self.last_error = f"{type(error).__name__}: {error}"
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                delay = self._delay(self.failures - self.threshold + 1)
+                self.state = OPEN
+                self.opened += 1
+                self._retry_at = self._clock() + delay
+                self._retry_wall = time.time() + delay
+            return self.state
+
+    def _delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** min(attempt - 1, 32))
+        return delay * (1 + self.jitter * (2 * self._rng() - 1))
+
+    def call(self, func, *args, **kwargs):
+        """透過斷路器呼叫 func；斷開中拋出 CircuitOpenError，func 的例外照常拋出並記錄失敗。"""
+        if not self.allow():
+            raise CircuitOpenError(self.retry_in())
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            self.record_failure(exc)
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "opened": self.opened,
+                "next_retry": isoformat(self._retry_wall),
+                "retry_in_s": round(self.retry_in(), 1) if self.state == OPEN else None,
+                "last_error": self.last_error,
+            }
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """do(func)：沒有進行中的呼叫時執行 func；已有時等待它完成並取得同一個結果（或例外）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = None
+
+    @property
+    def in_flight(self):
+        return self._call is not None
+
+    def do(self, func):
+        with self._lock:
+            call = self._call
+            leader = call is None
+            if leader:
+                call = self._call = _Call()
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as exc:  # noqa: BLE001 - 交給所有等待者各自拋出
+                call.error = exc
+            finally:
+                with self._lock:
+                    self._call = None
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
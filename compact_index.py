@@ -0,0 +1,297 @@
+# compact_index.py
+"""飲品營養表的緊湊記憶體表示：字串只存一份、以整數編碼，數值放在 array 欄位裡。
+
+舊做法每個展開後的品名各有一個 (品牌, 品名, Size, 冰量) 字串 tuple 當鍵、一個 (熱量, 糖量) tuple 當值，
+brand_drinks 與 drink_variants 又各自重複存一份同樣的字串；合併品名（A/B/C）展開後列數倍增，
+gunicorn 每個 worker 還各有一份。DrinkTable 改成：
+
+- 品牌、品名、尺寸、冰量各自一張字串表（sys.intern），列只存整數編號
+- 每列的尺寸／冰量編號與熱量／糖量分別放在 array('H') / array('d') 欄位；無效數字以 NaN 表示，讀取時還原成 None
+- (品牌, 品名) 組合以整數組合碼（品牌編號 << 32 | 品名編號）為鍵查組合編號（int -> int 的 dict，
+  比字串 tuple 鍵小得多，查找一樣是一次雜湊）；組合碼另外排序存在 array('Q')，
+  同一品牌的品名在排序後相鄰，列舉 brand_drinks[品牌] 時以 bisect 取這一段
+- 列依 (組合, 尺寸, 冰量) 排序存放，同一組合的列相鄰；每個組合另有一個位元遮罩記錄有哪些尺寸冰量，
+  查表時列位置 = 組合起點 + 遮罩中較低位元的個數（int.bit_count），之後只讀 array 欄位；
+  drink_variants 只讀該組合相鄰的幾列
+
+查詢語意與舊的 dict／set 相同：DrinkTable 本身就是 drinks_index（Mapping），
+brand_drinks、drink_variants 是建立在同一張表上的唯讀檢視，既有的呼叫端不需修改。
+
+另提供 deep_sizeof()，估算物件（含其參照的所有物件）佔用的位元組數，供 /healthz 的記憶體報告使用。
+"""
+import math
+import sys
+import types
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping, Set
+
+_NAME_BITS = 32
+_NAME_MASK = (1 << _NAME_BITS) - 1
+_NOT_FOUND = object()
+
+
+class DrinkTable(Mapping):
+    """(品牌, 品名, Size, 冰量) -> (熱量, 糖量)。以 from_items() 建立，建好後不再修改。"""
+    __slots__ = ("brands", "names", "sizes", "ices", "_brand_ids", "_name_ids", "_size_ids", "_ice_ids",
+                 "_row_pair", "_row_size", "_row_ice", "_calories", "_sugar", "_order",
+                 "_pairs", "_pair_code", "_pair_keys", "_pair_start", "_pair_mask",
+                 "brand_drinks", "drink_variants")
+
+    @classmethod
+    def from_items(cls, items):
+        """items 為 ((品牌, 品名, Size, 冰量), (熱量, 糖量)) 序列；與 dict 相同，重複的鍵保留第一次的位置、最後一次的值。"""
+        self = cls.__new__(cls)
+        self.brands, self.names, self.sizes, self.ices = [], [], [], []
+        self._brand_ids, self._name_ids, self._size_ids, self._ice_ids = {}, {}, {}, {}
+        rows = {}                 # 建置期間暫用：(組合編號, 尺寸編號, 冰量編號) -> (熱量, 糖量)，依第一次出現的順序
+        pairs = self._pairs = {}  # 組合碼 -> 組合編號（依第一次出現的順序）
+        for (brand, name, size, ice), (calories, sugar) in items:
+            code = _code(self._brand_ids, self.brands, brand) << _NAME_BITS | _code(self._name_ids, self.names, name)
+            pair = pairs.get(code)
+            if pair is None:
+                pair = pairs[code] = len(pairs)
+            rows[pair, _code(self._size_ids, self.sizes, size), _code(self._ice_ids, self.ices, ice)] = (
+                math.nan if calories is None else calories, math.nan if sugar is None else sugar)
+
+        # 列依 (組合, 尺寸, 冰量) 排序存放：同一組合的列相鄰，_pair_start[p] 起算；
+        # _pair_mask[p] 的第 (尺寸編號 × 冰量種類數 + 冰量編號) 位元表示該組合有這個尺寸冰量，
+        # 查表時該組合內的列位置 = 遮罩中比它低的位元數，不需 bisect 或逐列比對
+        width = len(self.ices)
+        keys = list(rows)
+        physical = sorted(range(len(keys)), key=keys.__getitem__)
+        self._row_pair = array("I", (keys[r][0] for r in physical))
+        self._row_size = array("H", (keys[r][1] for r in physical))
+        self._row_ice = array("H", (keys[r][2] for r in physical))
+        values = list(rows.values())
+        self._calories = array("d", (values[r][0] for r in physical))
+        self._sugar = array("d", (values[r][1] for r in physical))
+        # 原本的列順序（插入順序）-> 實際存放位置；items() 等依此維持與 dict 相同的順序
+        order = [0] * len(rows)
+        for position, r in enumerate(physical):
+            order[r] = position
+        self._order = array("I", order)
+        start, masks = [0] * (len(pairs) + 1), [0] * len(pairs)
+        for pair, s, i in keys:
+            start[pair + 1] += 1
+            masks[pair] |= 1 << (s * width + i)
+        for p in range(len(pairs)):
+            start[p + 1] += start[p]
+        self._pair_start = array("I", start)
+        # 尺寸 × 冰量超過 64 種時遮罩放不進 64 位元，改存 Python 整數
+        self._pair_mask = array("Q", masks) if len(self.sizes) * width <= 64 else masks
+        self._pair_code = array("Q", pairs)  # 組合編號 -> 組合碼
+        self._pair_keys = array("Q", sorted(pairs))
+        self.brand_drinks = BrandDrinks(self)
+        self.drink_variants = DrinkVariants(self)
+        return self
+
+    # --- pickle（索引快照檔）：只存字串表與 array 欄位，查找用的 dict 載入時再由欄位重建 ---
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in _STATE}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        for strings in (self.brands, self.names, self.sizes, self.ices):
+            strings[:] = map(sys.intern, strings)
+        self._brand_ids, self._name_ids, self._size_ids, self._ice_ids = (
+            {value: code for code, value in enumerate(strings)}
+            for strings in (self.brands, self.names, self.sizes, self.ices))
+        self._pairs = dict(zip(self._pair_code, range(len(self._pair_code))))
+
+    # --- Mapping ---
+    def get(self, key, default=None):
+        try:
+            brand, name, size, ice = key
+            pair = self._pairs[self._brand_ids[brand] << _NAME_BITS | self._name_ids[name]]
+            bit = self._size_ids[size] * len(self.ices) + self._ice_ids[ice]
+        except (KeyError, TypeError, ValueError):
+            return default
+        mask = self._pair_mask[pair]
+        if not mask >> bit & 1:
+            return default
+        row = self._pair_start[pair] + (mask & ((1 << bit) - 1)).bit_count()
+        calories, sugar = self._calories[row], self._sugar[row]
+        return (None if calories != calories else calories, None if sugar != sugar else sugar)
+
+    def __getitem__(self, key):
+        value = self.get(key, _NOT_FOUND)
+        if value is _NOT_FOUND:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _NOT_FOUND) is not _NOT_FOUND
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        return map(self._key, self._order)
+
+    def items(self):
+        """依原本的列順序產生 (鍵, 值)；比 Mapping 預設逐鍵查表快得多（排行、矩陣建置時使用）。"""
+        return ((self._key(row), self._value(row)) for row in self._order)
+
+    def values(self):
+        return map(self._value, self._order)
+
+    # --- 內部 ---
+    def _find_pair(self, brand, name):
+        b = self._brand_ids.get(brand)
+        n = self._name_ids.get(name)
+        if b is None or n is None:
+            return None
+        return self._pairs.get(b << _NAME_BITS | n)
+
+    def _brand_range(self, b):
+        keys = self._pair_keys
+        return bisect_left(keys, b << _NAME_BITS), bisect_left(keys, (b + 1) << _NAME_BITS)
+
+    def _key(self, row):
+        code = self._pair_code[self._row_pair[row]]
+        return (self.brands[code >> _NAME_BITS], self.names[code & _NAME_MASK],
+                self.sizes[self._row_size[row]], self.ices[self._row_ice[row]])
+
+    def _value(self, row):
+        calories, sugar = self._calories[row], self._sugar[row]
+        return (None if calories != calories else calories, None if sugar != sugar else sugar)
+
+
+# 存進快照檔的欄位（其餘為可由這些欄位重建的查找用 dict）
+_STATE = ("brands", "names", "sizes", "ices", "_row_pair", "_row_size", "_row_ice", "_calories", "_sugar", "_order",
+          "_pair_code", "_pair_keys", "_pair_start", "_pair_mask", "brand_drinks", "drink_variants")
+
+
+class DrinkNames(Set):
+    """某品牌的正式品名集合（brand_drinks[品牌]）。"""
+    __slots__ = ("_table", "_brand")
+
+    def __init__(self, table, brand_id):
+        self._table = table
+        self._brand = brand_id
+
+    def __contains__(self, name):
+        n = self._table._name_ids.get(name)
+        return n is not None and (self._brand << _NAME_BITS | n) in self._table._pairs
+
+    def __iter__(self):
+        table = self._table
+        lo, hi = table._brand_range(self._brand)
+        names, keys = table.names, table._pair_keys
+        return (names[keys[k] & _NAME_MASK] for k in range(lo, hi))
+
+    def __len__(self):
+        lo, hi = self._table._brand_range(self._brand)
+        return hi - lo
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+    def __repr__(self):
+        return f"DrinkNames({set(self)!r})"
+
+
+class BrandDrinks(Mapping):
+    """品牌 -> 正式品名集合；與舊的 {品牌: set} 相同的讀取介面。"""
+    __slots__ = ("_table", "_sets")
+
+    def __init__(self, table):
+        self._table = table
+        self._sets = [DrinkNames(table, b) for b in range(len(table.brands))]
+
+    def __getitem__(self, brand):
+        b = self._table._brand_ids.get(brand)
+        if b is None:
+            raise KeyError(brand)
+        return self._sets[b]
+
+    def get(self, brand, default=None):
+        b = self._table._brand_ids.get(brand)
+        return default if b is None else self._sets[b]
+
+    def __contains__(self, brand):
+        return brand in self._table._brand_ids
+
+    def __iter__(self):
+        return iter(self._table.brands)
+
+    def __len__(self):
+        return len(self._table.brands)
+
+
+class DrinkVariants(Mapping):
+    """(品牌, 品名) -> {(Size, 冰量)}；與舊的 drink_variants 相同的讀取介面（值為 frozenset）。"""
+    __slots__ = ("_table",)
+
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, key):
+        table = self._table
+        try:
+            brand, name = key
+        except (TypeError, ValueError):
+            raise KeyError(key) from None
+        pair = table._find_pair(brand, name)
+        if pair is None:
+            raise KeyError(key)
+        sizes, ices, row_size, row_ice = table.sizes, table.ices, table._row_size, table._row_ice
+        return frozenset([(sizes[row_size[row]], ices[row_ice[row]])
+                          for row in range(table._pair_start[pair], table._pair_start[pair + 1])])
+
+    def __iter__(self):
+        table = self._table
+        for code in table._pair_code:
+            yield table.brands[code >> _NAME_BITS], table.names[code & _NAME_MASK]
+
+    def __len__(self):
+        return len(self._table._pair_code)
+
+
+def _code(ids, strings, value):
+    code = ids.get(value)
+    if code is None:
+        value = sys.intern(value)
+        code = ids[value] = len(strings)
+        strings.append(value)
+    return code
+
+
+# 不計入大小的物件：類別、模組、函式等程式本身的物件
+_SKIP = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+_LEAVES = (str, bytes, int, float, complex, bool, array, type(None))
+
+
+def deep_sizeof(obj, seen=None):
+    """obj 與其參照的所有物件的 sys.getsizeof 總和（位元組）。
+
+    seen 為已計算過的物件 id 集合；多次呼叫共用同一個 seen 時，共用的物件只算在第一次遇到它的呼叫。
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen or isinstance(current, _SKIP):
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, _LEAVES):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        else:
+            attributes = getattr(current, "__dict__", None)
+            if attributes is not None:
+                stack.append(attributes)
+            for cls in type(current).__mro__:
+                for slot in cls.__dict__.get("__slots__", ()):
+                    if slot not in ("__dict__", "__weakref__") and hasattr(current, slot):
+                        stack.append(getattr(current, slot))
+    return total
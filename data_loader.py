@@ -1,5 +1,5 @@
 # data_loader.py
-"""從 Google Sheets 載入營養資料，建立查詢用的索引結構。
+"""從資料來源（預設 Google Sheets）載入營養資料，建立查詢用的索引結構。
 
 工作表結構（試算表：Nutrition_Facts）：
 - Drinks:              Brand_Standard_Name, Standard_Drinks_Name, Size, 冰量, 熱量, 糖量, ...
@@ -10,17 +10,62 @@
 - Size_Alias:          Size_Alias, Size
 - Drinks_Alias:        Brand_Standard_Name, Standard_Drinks_Name, Alias_Drinks_Name（逗號分隔多個別名）
 
+六張工作表以一次 batch values 請求抓回，並逐表計算內容雜湊：只有內容變動的
+工作表會重建對應的索引區段，完全沒變時不換世代、也不改寫快取檔。
+資料來源也可以是本機的 CSV／TSV 目錄或 SQLite 資料庫（見 data_sources.py），以串流方式讀取，
+適合離線部署與負載測試；drinks_index 另可改查本機 SQLite 檔（見 sqlite_lookup.py）。
+
 載入成功後會把原始資料寫入本地快取檔；啟動時若 Google Sheets 連不上，
 會退回快取資料，避免 Sheets 故障導致機器人完全無法啟動。
+
+建好的索引收在不可變的 DataSnapshot 中，以「替換一個參照」的方式發布：
+讀取端（解析、計算）每個請求只取一次 loader.snapshot，之後都讀同一份，
+refresh 進行中也不會讀到新舊混雜的資料，讀取路徑不必加鎖。
+generation 每次 build 遞增，可作為下游快取的失效鍵。
+
+多 worker 時（snapshot_path 有設定）：refresh 成功後把快照寫入共用檔，
+其他 worker 呼叫 sync() 時發現較新版本即載入，一次「更新資料」即可更新所有 worker。
+同一個索引快照檔也是重啟時的快速載入來源：Sheets 連不上時優先載入它（毫秒級），
+檔案不存在、損壞或 schema 較舊時才退回原始 JSON 快取重建。
+
+每次 refresh 的抓取、重建與發布耗時，以及各工作表區段、各衍生索引的建置耗時
+都記錄在 metrics（/metrics 的 calcal_refresh_*、calcal_sheet_build_seconds、calcal_index_build_seconds）。
 """
+import dataclasses
+import hashlib
+import itertools
 import json
 import logging
 import os
+import random
+import threading
+import time
+from dataclasses import dataclass
 
-import gspread
+import metrics
+from alias_matcher import AliasMatcher
+from compact_index import BrandDrinks, DrinkTable, DrinkVariants, deep_sizeof
+from config import ICE_OPTIONS
+from data_sources import SHEETS, digest as _digest, open_source
+from fuzzy_index import SuggestionIndex
+from index_snapshot import SnapshotError, SnapshotWatcher, read_snapshot, write_snapshot
+from nutrition_matrix import NutritionMatrix
+from ranking_index import RankingIndex, ranking_rows
+from sqlite_lookup import SqliteDrinkTable, SqliteRankingIndex, SqliteSuggestionIndex
 
 logger = logging.getLogger(__name__)
 
+_REFRESH_SECONDS = metrics.Histogram(
+    "calcal_refresh_seconds", "DataLoader.refresh 各階段耗時（fetch、rebuild、publish、total）", ("phase",))
+_REFRESH_TOTAL = metrics.Counter(
+    "calcal_refresh_total", "DataLoader.refresh 次數，依結果（changed、unchanged、error）", ("result",))
+_SHEET_CHANGES = metrics.Counter(
+    "calcal_sheet_changes_total", "refresh 時內容有變動的工作表次數", ("sheet",))
+_SHEET_BUILD_SECONDS = metrics.Histogram(
+    "calcal_sheet_build_seconds", "各工作表區段的重建耗時", ("sheet",))
+_INDEX_BUILD_SECONDS = metrics.Histogram(
+    "calcal_index_build_seconds", "各衍生索引的建置耗時（沿用上一版時不記錄）", ("index",))
+
 
 def _to_float(value):
     try:
@@ -60,133 +105,464 @@ def _parse_ratio(value):
         return None
 
 
+# 全程序共用的世代計數器：不同 DataLoader 建出的快照也不會撞號
+_generations = itertools.count(1)
+
+# 索引快照檔的 schema 版本：DataSnapshot 欄位或其中表格的結構改變時要遞增，
+# 舊版程式寫出的快照檔就會被視為不相容，改由原始 JSON 快取重建
+SNAPSHOT_SCHEMA = 8
+
+
+@dataclass(frozen=True, slots=True)
+class DataSnapshot:
+    """某一次 build 的完整查詢索引。建好後不再修改，各表格只供讀取。"""
+    generation: int
+    source: object                # "sheets"、"csv"、"sqlite"、"cache"，或直接 build 時為 None
+    drinks_index: DrinkTable      # (品牌, 品名, Size, 冰量) -> (熱量, 糖量)；整數編碼的緊湊表（見 compact_index.py），
+                                  # SQLite 查表模式時為 SqliteDrinkTable（見 sqlite_lookup.py）
+    brand_drinks: BrandDrinks     # 品牌 -> {正式品名}（drinks_index 上的唯讀檢視）
+    drink_variants: DrinkVariants  # (品牌, 品名) -> {(Size, 冰量)}（同上）
+    toppings_map: dict            # 配料名 -> (熱量, 糖量)
+    brand_toppings: dict          # 品牌 -> {配料名}
+    sweet_map: dict               # 品牌 -> {甜度: 剩餘糖量比例}
+    sweetness_order: list         # 依工作表列順序，用於錯誤訊息中列出可選甜度
+    brands_alias_map: dict        # 品牌別名 -> 正式品牌
+    size_alias_map: dict          # 尺寸別名 -> Size
+    drinks_alias_map: dict        # (品牌, 別名) -> 正式品名
+    matrix_brands: list           # Brand_sweet_setting 標題列的品牌（含沒有任何甜度比例的品牌）
+    known_brands: set
+    sheet_digests: dict           # 工作表鍵 -> 原始內容雜湊（判斷下次 refresh 是否需要重建）
+    size_matcher: AliasMatcher
+    ice_matcher: AliasMatcher
+    sweetness_matcher: AliasMatcher
+    brand_matcher: AliasMatcher     # 品牌名稱與別名（casefold）-> 正式品牌；切分沒有空白的點單用
+    drink_name_lengths: dict        # 品牌 -> 正式品名與別名的最長字數（切分沒有空白的點單用）
+    ranking: RankingIndex           # 各品牌依最終熱量／糖量排序的排行索引（查表模式時為 SqliteRankingIndex）
+    suggestions: SuggestionIndex    # 找不到品名時的相近品名建議（查表模式時為 SqliteSuggestionIndex）
+    matrix: NutritionMatrix = None  # 預先算好的 飲品 × 甜度 結果矩陣；未啟用或沒有 numpy 時為 None
+    built_at: float = 0.0           # 建置時間（time.time()）；從快照檔載入時保留原本的建置時間
+
+
+def _build_drinks(rows):
+    """Drinks 工作表 -> DrinkTable（drinks_index）與建立在同一張表上的 brand_drinks、drink_variants 檢視。"""
+    table = DrinkTable.from_items(_drink_items(rows))
+    return {"drinks_index": table, "brand_drinks": table.brand_drinks,
+            "drink_variants": table.drink_variants}
+
+
+def _drink_items(rows):
+    for row in rows:
+        brand = str(row.get("Brand_Standard_Name", "")).strip()
+        drink = str(row.get("Standard_Drinks_Name", "")).strip()
+        size = str(row.get("Size", "")).strip()
+        ice = str(row.get("冰量", "")).strip()
+        if not (brand and drink):
+            continue
+        values = (_to_float(row.get("熱量")), _to_float(row.get("糖量")))
+        # 合併品名（含 "/"）展開成多個名稱，全部指向同一筆營養資料；
+        # 原始合併字串也保留可查
+        for name in {drink, *_expand_names(drink)}:
+            yield (brand, name, size, ice), values
+
+
+def _build_toppings(rows):
+    """品牌欄打 V 表示該品牌提供此配料。"""
+    toppings_map = {}    # 配料名 -> (熱量, 糖量)
+    brand_toppings = {}  # 品牌 -> {配料名}
+    base_cols = {"Topping_Name", "熱量", "糖量"}
+    for row in rows:
+        name = str(row.get("Topping_Name", "")).strip()
+        if not name:
+            continue
+        toppings_map[name] = (_to_float(row.get("熱量")), _to_float(row.get("糖量")))
+        for col, cell in row.items():
+            if col in base_cols:
+                continue
+            if str(cell).strip().upper() == "V":
+                brand_toppings.setdefault(str(col).strip(), set()).add(name)
+    return {"toppings_map": toppings_map, "brand_toppings": brand_toppings}
+
+
+def _build_sweet(matrix):
+    """Brand_sweet_setting 矩陣：列=甜度、欄=品牌。"""
+    matrix = list(matrix)
+    sweet_map = {}        # 品牌 -> {甜度: 剩餘糖量比例}
+    sweetness_order = []  # 依工作表列順序，用於錯誤訊息中列出可選甜度
+    header = [str(c).strip() for c in matrix[0]] if matrix else []
+    matrix_brands = header[1:]
+    for row in matrix[1:]:
+        sweet_name = str(row[0]).strip() if row else ""
+        if not sweet_name:
+            continue
+        sweetness_order.append(sweet_name)
+        for i, brand in enumerate(matrix_brands, start=1):
+            ratio = _parse_ratio(row[i]) if i < len(row) else None
+            if ratio is not None:
+                sweet_map.setdefault(brand, {})[sweet_name] = ratio
+    return {"sweet_map": sweet_map, "sweetness_order": sweetness_order,
+            "matrix_brands": matrix_brands}
+
+
+def _build_brands_alias(rows):
+    brands_alias_map = {}
+    for row in rows:
+        alias = str(row.get("Brand_Alias_Name", "")).strip()
+        std = str(row.get("Brand_Standard_Name", "")).strip()
+        if alias and std:
+            brands_alias_map[alias] = std
+            brands_alias_map.setdefault(alias.casefold(), std)  # 英文別名不分大小寫
+    return {"brands_alias_map": brands_alias_map}
+
+
+def _build_size_alias(rows):
+    size_alias_map = {}
+    for row in rows:
+        alias = str(row.get("Size_Alias", "")).strip()
+        if alias:
+            size_alias_map[alias] = str(row.get("Size", "")).strip()
+    return {"size_alias_map": size_alias_map}
+
+
+def _build_drinks_alias(rows):
+    drinks_alias_map = {}  # (品牌, 別名) -> 正式品名
+    for row in rows:
+        brand = str(row.get("Brand_Standard_Name", "")).strip()
+        std = str(row.get("Standard_Drinks_Name", "")).strip()
+        aliases = str(row.get("Alias_Drinks_Name", "")).strip()
+        if not (brand and std and aliases):
+            continue
+        for alias in aliases.split(","):
+            alias = alias.strip()
+            if alias:
+                drinks_alias_map[(brand, alias)] = std
+    return {"drinks_alias_map": drinks_alias_map}
+
+
+# 每張工作表只影響自己的區段；區段之間的衍生資料（known_brands、比對器）在 _assemble 組合
+_SECTION_BUILDERS = {
+    "drinks": _build_drinks,
+    "toppings": _build_toppings,
+    "brand_sweet": _build_sweet,
+    "brands_alias": _build_brands_alias,
+    "size_alias": _build_size_alias,
+    "drinks_alias": _build_drinks_alias,
+}
+
+# 各區段產生的 DataSnapshot 欄位；從快照檔載入時據此還原區段，之後仍可部分重建
+_SECTION_FIELDS = {
+    "drinks": ("drinks_index", "brand_drinks", "drink_variants"),
+    "toppings": ("toppings_map", "brand_toppings"),
+    "brand_sweet": ("sweet_map", "sweetness_order", "matrix_brands"),
+    "brands_alias": ("brands_alias_map",),
+    "size_alias": ("size_alias_map",),
+    "drinks_alias": ("drinks_alias_map",),
+}
+
+
+# 建置成本較高的衍生索引與其依賴的區段；依賴的區段都沒變時沿用上一版快照的索引
+_DERIVED_SECTIONS = {
+    "ranking": {"drinks", "brand_sweet"},
+    "matrix": {"drinks", "brand_sweet"},
+    "suggestions": {"drinks", "drinks_alias"},
+    "drink_name_lengths": {"drinks", "drinks_alias"},
+}
+
+
+def _assemble(sections, digests, source, previous=None, changed=(), precompute=False, lookup_dir=None,
+              keep=()):
+    """由各區段的表格組出新快照，並建立跨區段的衍生資料。
+
+    previous 為上一版快照（部分重建時），changed 為這次重建的區段；衍生索引依賴的區段沒變時直接沿用。
+    lookup_dir 有設定時排行與品名建議也寫成 SQLite 查表檔（見 sqlite_lookup）；keep 為清理舊檔時不可刪除的檔案。
+    """
+    tables = {}
+    for section in sections.values():
+        tables.update(section)
+    known_brands = (set(tables["brand_drinks"]) | set(tables["matrix_brands"])
+                    | set(tables["brand_toppings"]))
+
+    # 解析用的別名比對器（每次 build 編譯一次，解析時不再排序別名表）
+    sweet_names = {s for levels in tables["sweet_map"].values() for s in levels}
+    sweet_names.update(tables["sweetness_order"])
+
+    def reuse(name):
+        if previous is None or changed & _DERIVED_SECTIONS[name]:
+            return None
+        return getattr(previous, name)
+
+    if lookup_dir:
+        ranking = reuse("ranking") or _timed(
+            "ranking", SqliteRankingIndex.build, lookup_dir, _lookup_version(digests, "ranking"),
+            ranking_rows(tables["drinks_index"], tables["sweet_map"]), keep)
+        suggestions = reuse("suggestions") or _timed(
+            "suggestions", SqliteSuggestionIndex.build, lookup_dir, _lookup_version(digests, "suggestions"),
+            tables["brand_drinks"], tables["drinks_alias_map"], keep)
+    else:
+        ranking = reuse("ranking") or _timed("ranking", RankingIndex.build, tables["drinks_index"],
+                                             tables["sweet_map"])
+        suggestions = (reuse("suggestions") or _timed("suggestions", SuggestionIndex.build,
+                                                      tables["brand_drinks"], tables["drinks_alias_map"]))
+    matrix = (reuse("matrix") or _timed("matrix", _build_matrix, tables)) if precompute else None
+    drink_name_lengths = (reuse("drink_name_lengths")
+                          or _timed("drink_name_lengths", _build_drink_name_lengths, tables))
+    brand_names = {**{brand: brand for brand in known_brands}, **tables["brands_alias_map"]}
+    return DataSnapshot(
+        generation=next(_generations),
+        source=source,
+        known_brands=known_brands,
+        sheet_digests=digests,
+        size_matcher=AliasMatcher(tables["size_alias_map"]),
+        ice_matcher=AliasMatcher(ICE_OPTIONS),
+        sweetness_matcher=AliasMatcher({name: name for name in sweet_names}),
+        brand_matcher=AliasMatcher({alias.casefold(): brand for alias, brand in brand_names.items()}),
+        drink_name_lengths=drink_name_lengths,
+        ranking=ranking,
+        suggestions=suggestions,
+        matrix=matrix,
+        built_at=time.time(),
+        **tables,
+    )
+
+
+def snapshot_memory(snapshot):
+    """各表格（DataSnapshot 欄位）佔用的位元組數與總計。
+
+    依欄位順序計算，表格之間共用的物件（同一個字串、drinks_index 上的檢視）只算在第一個用到它的表格。
+    """
+    seen = set()
+    report = {}
+    for field in dataclasses.fields(snapshot):
+        value = getattr(snapshot, field.name)
+        if value is None or isinstance(value, (str, int, float)):
+            continue
+        report[field.name] = deep_sizeof(value, seen)
+    report["total"] = sum(report.values())
+    return report
+
+
+def _lookup_version(digests, index):
+    """SQLite 查表檔的版本鍵：快照 schema + 衍生索引所依賴工作表的內容雜湊。"""
+    combined = hashlib.sha256("".join(digests[key] for key in sorted(_DERIVED_SECTIONS[index])).encode())
+    return f"{SNAPSHOT_SCHEMA}-{combined.hexdigest()[:16]}"
+
+
+def _lookup_files(snapshot):
+    """快照目前使用中的 SQLite 查表檔路徑（清理舊檔時保留）。"""
+    if snapshot is None:
+        return set()
+    tables = (snapshot.drinks_index, snapshot.ranking, snapshot.suggestions)
+    return {table.path for table in tables if isinstance(getattr(table, "path", None), str)}
+
+
+def _timed(index, build, *args):
+    with _INDEX_BUILD_SECONDS.labels(index).time():
+        return build(*args)
+
+
+def _build_drink_name_lengths(tables):
+    """品牌 -> 最長品名／別名字數。品名本身直接查 brand_drinks 與 drinks_alias_map，不另建每個品牌的字典樹。"""
+    lengths = {}
+    for brand, alias in tables["drinks_alias_map"]:
+        lengths[brand] = max(lengths.get(brand, 0), len(alias))
+    for brand, drinks in tables["brand_drinks"].items():
+        lengths[brand] = max(lengths.get(brand, 0), max(map(len, drinks), default=0))
+    return lengths
+
+
+def _build_matrix(tables):
+    started = time.perf_counter()
+    matrix = NutritionMatrix.build(tables["drinks_index"], tables["sweet_map"], tables["sweetness_order"])
+    if matrix is None:
+        logger.warning("未安裝 numpy，略過預先計算，改為逐筆計算")
+    else:
+        logger.info("已預先計算 %d × %d 結果矩陣（%.1f ms）", len(matrix), len(matrix.levels),
+                    (time.perf_counter() - started) * 1000)
+    return matrix
+
+
 class DataLoader:
-    def __init__(self, secret_key_json_str="", sheet_name="", cache_path="cache/sheet_cache.json"):
+    def __init__(self, secret_key_json_str="", sheet_name="", cache_path="cache/sheet_cache.json",
+                 snapshot_path=None, sync_interval=1.0, client_factory=None, precompute=False,
+                 source=None, lookup_dir=None):
+        """client_factory(金鑰 JSON 字串) 回傳 gspread 用戶端；測試可傳入本地假物件。
+
+        precompute=True 時每次 build 以 NumPy 預先算好所有 飲品 × 甜度 的結果（見 nutrition_matrix）。
+        source 為 data_sources 的資料來源（CsvDirectorySource、SqliteSource…）；未指定時為 Google Sheets。
+        lookup_dir 有設定時 drinks_index 改查該目錄下的 SQLite 查表檔（見 sqlite_lookup），不放在記憶體。
+        """
         self.secret_key_json_str = secret_key_json_str
         self.sheet_name = sheet_name
+        self.backend = source or open_source("sheets", secret_key_json_str=secret_key_json_str,
+                                             sheet_name=sheet_name, client_factory=client_factory)
+        self.lookup_dir = lookup_dir
         self.cache_path = cache_path
-        self.source = None  # "sheets" 或 "cache"
+        self.snapshot = None  # 目前發布中的 DataSnapshot；只會被整個替換，不會原地修改
+        self.snapshot_path = snapshot_path  # 多 worker 共用的索引快照檔；None 表示不共用
+        self._watcher = (SnapshotWatcher(snapshot_path, SNAPSHOT_SCHEMA, sync_interval)
+                         if snapshot_path else None)
+        self._sections = {}  # 工作表鍵 -> 該區段建好的表格（供部分重建沿用）
+        self._digests = {}   # 工作表鍵 -> 原始內容雜湊（判斷是否需要重建）
+        self._memory = None  # (快照, 記憶體報告)；同一個快照只計算一次
+        self.precompute = precompute
+
+    @property
+    def source(self):
+        """目前資料來源：資料來源名稱（"sheets"、"csv"、"sqlite"）或 "cache"；尚未載入時為 None。"""
+        return self.snapshot.source if self.snapshot else None
+
+    @property
+    def generation(self):
+        return self.snapshot.generation if self.snapshot else 0
+
+    @property
+    def shared_version(self):
+        """目前採用的共用快照版本號；未共用時為 0。"""
+        return self._watcher.known_version if self._watcher else 0
 
     def load(self):
-        """啟動時載入：優先抓 Google Sheets，失敗時退回本地快取。"""
+        """啟動時載入：優先讀資料來源，失敗時退回本地快取。"""
         try:
             self.refresh()
         except Exception:
-            logger.exception("無法從 Google Sheets 載入資料，嘗試使用本地快取")
-            if not self._load_cache():
+            logger.exception("無法從 %s 載入資料，嘗試使用本地快取", self.backend.label)
+            if not self.load_local():
                 raise
 
     def refresh(self):
-        """重新從 Google Sheets 抓取所有工作表並重建索引。"""
-        secret_key_dict = json.loads(self.secret_key_json_str)
-        gc = gspread.service_account_from_dict(secret_key_dict)
-        spreadsheet = gc.open(self.sheet_name)
-
-        raw = {
-            "drinks": spreadsheet.worksheet("Drinks").get_all_records(),
-            "toppings": spreadsheet.worksheet("Toppings").get_all_records(),
-            "brand_sweet": spreadsheet.worksheet("Brand_sweet_setting").get_all_values(),
-            "brands_alias": spreadsheet.worksheet("Brands_Alias").get_all_records(),
-            "size_alias": spreadsheet.worksheet("Size_Alias").get_all_records(),
-            "drinks_alias": spreadsheet.worksheet("Drinks_Alias").get_all_records(),
-        }
-        self.build(raw)
-        self.source = "sheets"
-        self._save_cache(raw)
-        logger.info("已從 Google Sheets 載入 %d 筆飲品資料", len(self.drinks_index))
-
-    def build(self, raw):
-        """把原始資料轉成查詢索引。先在區域變數組完、最後一次掛上，避免其他執行緒讀到半成品。"""
-        # --- Drinks ---
-        drinks_index = {}    # (品牌, 品名, Size, 冰量) -> (熱量, 糖量)
-        brand_drinks = {}    # 品牌 -> {正式品名}
-        drink_variants = {}  # (品牌, 品名) -> {(Size, 冰量)}
-        for row in raw["drinks"]:
-            brand = str(row.get("Brand_Standard_Name", "")).strip()
-            drink = str(row.get("Standard_Drinks_Name", "")).strip()
-            size = str(row.get("Size", "")).strip()
-            ice = str(row.get("冰量", "")).strip()
-            if not (brand and drink):
-                continue
-            values = (_to_float(row.get("熱量")), _to_float(row.get("糖量")))
-            # 合併品名（含 "/"）展開成多個名稱，全部指向同一筆營養資料；
-            # 原始合併字串也保留可查
-            for name in {drink, *_expand_names(drink)}:
-                drinks_index[(brand, name, size, ice)] = values
-                brand_drinks.setdefault(brand, set()).add(name)
-                drink_variants.setdefault((brand, name), set()).add((size, ice))
-
-        # --- Toppings（品牌欄打 V 表示該品牌提供） ---
-        toppings_map = {}    # 配料名 -> (熱量, 糖量)
-        brand_toppings = {}  # 品牌 -> {配料名}
-        base_cols = {"Topping_Name", "熱量", "糖量"}
-        for row in raw["toppings"]:
-            name = str(row.get("Topping_Name", "")).strip()
-            if not name:
-                continue
-            toppings_map[name] = (_to_float(row.get("熱量")), _to_float(row.get("糖量")))
-            for col, cell in row.items():
-                if col in base_cols:
-                    continue
-                if str(cell).strip().upper() == "V":
-                    brand_toppings.setdefault(str(col).strip(), set()).add(name)
-
-        # --- Brand_sweet_setting 矩陣 ---
-        sweet_map = {}        # 品牌 -> {甜度: 剩餘糖量比例}
-        sweetness_order = []  # 依工作表列順序，用於錯誤訊息中列出可選甜度
-        matrix = raw["brand_sweet"]
-        header = [str(c).strip() for c in matrix[0]] if matrix else []
-        matrix_brands = header[1:]
-        for row in matrix[1:]:
-            sweet_name = str(row[0]).strip() if row else ""
-            if not sweet_name:
-                continue
-            sweetness_order.append(sweet_name)
-            for i, brand in enumerate(matrix_brands, start=1):
-                ratio = _parse_ratio(row[i]) if i < len(row) else None
-                if ratio is not None:
-                    sweet_map.setdefault(brand, {})[sweet_name] = ratio
-
-        # --- 別名表 ---
-        brands_alias_map = {}
-        for row in raw["brands_alias"]:
-            alias = str(row.get("Brand_Alias_Name", "")).strip()
-            std = str(row.get("Brand_Standard_Name", "")).strip()
-            if alias and std:
-                brands_alias_map[alias] = std
-                brands_alias_map.setdefault(alias.casefold(), std)  # 英文別名不分大小寫
-
-        size_alias_map = {}
-        for row in raw["size_alias"]:
-            alias = str(row.get("Size_Alias", "")).strip()
-            if alias:
-                size_alias_map[alias] = str(row.get("Size", "")).strip()
-
-        drinks_alias_map = {}  # (品牌, 別名) -> 正式品名
-        for row in raw["drinks_alias"]:
-            brand = str(row.get("Brand_Standard_Name", "")).strip()
-            std = str(row.get("Standard_Drinks_Name", "")).strip()
-            aliases = str(row.get("Alias_Drinks_Name", "")).strip()
-            if not (brand and std and aliases):
-                continue
-            for alias in aliases.split(","):
-                alias = alias.strip()
-                if alias:
-                    drinks_alias_map[(brand, alias)] = std
-
-        known_brands = set(brand_drinks) | set(matrix_brands) | set(brand_toppings)
-
-        self.drinks_index = drinks_index
-        self.brand_drinks = brand_drinks
-        self.drink_variants = drink_variants
-        self.toppings_map = toppings_map
-        self.brand_toppings = brand_toppings
-        self.sweet_map = sweet_map
-        self.sweetness_order = sweetness_order
-        self.brands_alias_map = brands_alias_map
-        self.size_alias_map = size_alias_map
-        self.drinks_alias_map = drinks_alias_map
-        self.known_brands = known_brands
+        """重新從資料來源讀取所有工作表，只重建內容有變動的索引區段。
+
+        回傳內容有變動的工作表鍵（如 {"drinks_alias"}）；全部沒變時回傳空集合，
+        此時不換世代、不改寫快取檔，下游快取維持有效。
+        """
+        started = time.perf_counter()
+        try:
+            changed = self._refresh()
+        except Exception:
+            _REFRESH_TOTAL.labels("error").inc()
+            raise
+        _REFRESH_TOTAL.labels("changed" if changed else "unchanged").inc()
+        _REFRESH_SECONDS.labels("total").observe(time.perf_counter() - started)
+        return changed
+
+    def _refresh(self):
+        backend = self.backend
+        with _REFRESH_SECONDS.labels("fetch").time():
+            fetched = backend.fetch()
+        self._touch_refresh_stamp()
+        digests = fetched.digests
+        changed = {key for key in digests if digests[key] != self._digests.get(key)}
+        for key in changed:
+            _SHEET_CHANGES.labels(key).inc()
+        if not changed and self.snapshot is not None:
+            if self.snapshot.source != backend.name:
+                # 內容與快取相同，只需標記來源；表格沒變，世代號也不用換
+                self.snapshot = dataclasses.replace(self.snapshot, source=backend.name)
+            logger.info("%s 內容沒有變動，沿用目前索引（世代 %d）", backend.label, self.snapshot.generation)
+            return changed
+
+        # 本機來源的 rows() 逐列讀取：只有變動的表會被讀第二次，直接串流進各區段的建置
+        with _REFRESH_SECONDS.labels("rebuild").time():
+            snapshot = self._rebuild(fetched.rows, changed, digests, source=backend.name)
+        with _REFRESH_SECONDS.labels("publish").time():
+            if fetched.raw is not None:
+                self._save_cache(fetched.raw)
+            self.publish()
+        logger.info("已從 %s 載入 %d 筆飲品資料（世代 %d，重建：%s）", backend.label,
+                    len(snapshot.drinks_index), snapshot.generation, "、".join(sorted(changed)))
+        return changed
+
+    def build(self, raw, source=None):
+        """把原始資料轉成查詢索引（全部重建），組成新的 DataSnapshot 後一次替換發布並回傳。"""
+        digests = {key: _digest(raw[key]) for key, _, _ in SHEETS}
+        return self._rebuild(raw.__getitem__, set(digests), digests, source)
+
+    def _rebuild(self, rows, changed, digests, source):
+        """只重建 changed 中的區段，其餘沿用上次的結果，再組成新快照。rows(鍵) 回傳該表的資料列。"""
+        sections = dict(self._sections)
+        for key in changed:
+            with _SHEET_BUILD_SECONDS.labels(key).time():
+                sections[key] = self._build_section(key, rows(key), digests[key])
+        previous = self.snapshot if self._sections else None
+        snapshot = _assemble(sections, digests, source, previous, changed, self.precompute, self.lookup_dir,
+                             _lookup_files(self.snapshot))
+        self._sections = sections
+        self._digests = digests
+        self.snapshot = snapshot  # 單一參照替換：讀取端不是拿到舊快照就是新快照
+        return snapshot
+
+    def _build_section(self, key, rows, digest):
+        if key == "drinks" and self.lookup_dir:
+            table = SqliteDrinkTable.build(self.lookup_dir, f"{SNAPSHOT_SCHEMA}-{digest[:16]}",
+                                           _drink_items(rows), _lookup_files(self.snapshot))
+            return {"drinks_index": table, "brand_drinks": table.brand_drinks,
+                    "drink_variants": table.drink_variants}
+        return _SECTION_BUILDERS[key](rows)
+
+    # --- 多 worker 共用快照 ---
+    def publish(self):
+        """把目前的快照寫入共用檔，讓其他 worker 載入。寫入失敗只記錄警告。"""
+        if not (self._watcher and self.snapshot):
+            return
+        try:
+            version = write_snapshot(self.snapshot_path, self.snapshot, SNAPSHOT_SCHEMA)
+        except OSError:
+            logger.warning("無法寫入共用快照檔 %s", self.snapshot_path, exc_info=True)
+            return
+        # 自己寫的版本不需要再讀回來
+        self._watcher.known_version = max(self._watcher.known_version, version)
+
+    def _touch_refresh_stamp(self):
+        """記錄「剛從 Sheets 抓過」，讓其他 worker 的排程更新可以跳過這一輪。"""
+        if not self.snapshot_path:
+            return
+        try:
+            with open(self.snapshot_path + ".checked", "a", encoding="utf-8"):
+                pass
+            os.utime(self.snapshot_path + ".checked")
+        except OSError:
+            logger.debug("無法更新 %s.checked", self.snapshot_path, exc_info=True)
+
+    def memory_report(self):
+        """目前快照各表格的記憶體用量（位元組），見 snapshot_memory；同一個快照只計算一次。"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        cached = self._memory
+        if cached is None or cached[0] is not snapshot:
+            cached = self._memory = (snapshot, snapshot_memory(snapshot))
+        return cached[1]
+
+    def seconds_since_shared_refresh(self):
+        """任一 worker 最近一次成功抓取 Sheets 距今秒數；未共用或無紀錄時回傳 None。"""
+        if not self.snapshot_path:
+            return None
+        try:
+            return time.time() - os.stat(self.snapshot_path + ".checked").st_mtime
+        except OSError:
+            return None
+
+    def sync(self):
+        """共用檔有較新版本時載入並替換目前的快照，回傳是否有替換。成本通常只是一次時間比較。"""
+        if not self._watcher:
+            return False
+        found = self._watcher.poll()
+        if found is None:
+            return False
+        version, snapshot = found
+        self._adopt(snapshot)
+        logger.info("已載入其他 worker 更新的共用快照（版本 %d，世代 %d）",
+                    version, self.snapshot.generation)
+        return True
+
+    def _adopt(self, snapshot, source=None):
+        """改用從快照檔載入的快照，並還原各區段與雜湊，之後的 refresh 仍可部分重建。"""
+        self._sections = {key: {name: getattr(snapshot, name) for name in fields}
+                          for key, fields in _SECTION_FIELDS.items()}
+        self._digests = snapshot.sheet_digests
+        # 世代號只在同一程序內唯一，從檔案載入的快照要換成本程序的新世代號，
+        # 才不會與本程序快取中的舊世代撞號
+        self.snapshot = dataclasses.replace(snapshot, generation=next(_generations),
+                                            source=source or snapshot.source)
 
     # --- 本地快取 ---
     def _save_cache(self, raw):
@@ -199,13 +575,129 @@ class DataLoader:
         except OSError:
             logger.warning("無法寫入快取檔 %s", self.cache_path, exc_info=True)
 
-    def _load_cache(self):
+    def load_local(self):
+        """只從本機載入（不連網），成功回傳 True。優先載入建好的索引快照檔；不存在、損壞或 schema 不符時退回原始 JSON 快取重建。"""
+        if self.snapshot_path:
+            try:
+                version, snapshot = read_snapshot(self.snapshot_path, SNAPSHOT_SCHEMA)
+            except SnapshotError as exc:
+                logger.warning("無法使用索引快照檔 %s（%s），改由原始快取重建", self.snapshot_path, exc)
+            else:
+                self._adopt(snapshot, source="cache")
+                self._watcher.known_version = max(self._watcher.known_version, version)
+                logger.warning("已改用索引快照檔（%s）", self.snapshot_path)
+                return True
         try:
             with open(self.cache_path, encoding="utf-8") as f:
                 raw = json.load(f)
         except (OSError, ValueError):
             return False
-        self.build(raw)
-        self.source = "cache"
+        self.build(raw, source="cache")
+        self.publish()  # 索引快照檔不可用才會走到這裡，重寫一份讓下次啟動可以直接載入
         logger.warning("已改用本地快取資料（%s）", self.cache_path)
         return True
+
+
+class _Flight:
+    """一次進行中的更新；所有等待者共用同一個結果。"""
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """等待更新完成，回傳是否已完成（逾時回傳 False，更新仍會在背景繼續）。"""
+        return self.done.wait(timeout)
+
+
+class RefreshScheduler:
+    """背景定期更新與單一進行中（single-flight）更新。
+
+    - trigger()：已有更新在跑就回傳同一個 _Flight，不會對 Sheets 發出第二次請求
+    - 更新在背景執行緒進行，期間讀取端照常使用目前的快照（stale-while-revalidate）
+    - interval > 0 時啟動排程執行緒，每輪間隔加上 ±jitter 比例的隨機抖動，
+      避免多個 worker 同時打 Sheets；should_skip() 回傳 True 時跳過該輪
+    """
+
+    def __init__(self, refresh, interval=0.0, jitter=0.1, should_skip=None):
+        self._refresh = refresh
+        self.interval = interval
+        self.jitter = jitter
+        self._should_skip = should_skip
+        self._lock = threading.Lock()
+        self._flight = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_success = None   # time.time()
+        self.last_duration = None  # 秒
+        self.last_error = None
+        self.failure_streak = 0
+        self.runs = 0
+        self.next_run = None       # time.time()
+
+    def trigger(self):
+        """開始一次更新（已有進行中的更新則沿用），回傳可等待的 _Flight。"""
+        with self._lock:
+            if self._flight is not None:
+                return self._flight
+            flight = self._flight = _Flight()
+        threading.Thread(target=self._run, args=(flight,), name="data-refresh", daemon=True).start()
+        return flight
+
+    def _run(self, flight):
+        start = time.perf_counter()
+        try:
+            flight.result = self._refresh()
+        except Exception as exc:  # noqa: BLE001 - 失敗記錄在統計中，沿用舊資料
+            logger.exception("背景更新資料失敗")
+            flight.error = exc
+        duration = time.perf_counter() - start
+        with self._lock:
+            self.runs += 1
+            self.last_duration = duration
+            if flight.error is None:
+                self.last_success = time.time()
+                self.failure_streak = 0
+                self.last_error = None
+            else:
+                self.failure_streak += 1
+                self.last_error = f"{type(flight.error).__name__}: {flight.error}"
+            self._flight = None
+        flight.done.set()
+
+    def start(self):
+        """啟動排程執行緒（interval <= 0 時不啟動）；重複呼叫無作用。"""
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="refresh-scheduler", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.next_run = time.time() + delay
+            if self._stop.wait(delay):
+                return
+            if self._should_skip and self._should_skip():
+                logger.debug("其他 worker 剛更新過，跳過本輪排程更新")
+                continue
+            self.trigger().wait()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "in_flight": self._flight is not None,
+                "runs": self.runs,
+                "last_success": metrics.isoformat(self.last_success),
+                "last_duration_ms": None if self.last_duration is None else round(self.last_duration * 1000),
+                "failure_streak": self.failure_streak,
+                "last_error": self.last_error,
+                "next_run": metrics.isoformat(self.next_run) if self.interval > 0 else None,
+            }
@@ -0,0 +1,206 @@
+# data_sources.py
+"""DataLoader 的資料來源：Google Sheets、CSV／TSV 目錄、SQLite 資料庫。
+
+三種來源都提供相同的六張表（見 SHEETS；CSV 檔名、SQLite 資料表名稱即工作表名稱，欄位即標題列）。
+每次 fetch() 回傳 Fetched：
+- digests：各表的內容雜湊，DataLoader 據此判斷哪些區段需要重建
+- rows(鍵)：該表的資料列（records 表為 {欄位: 值}，Brand_sweet_setting 為含標題列的二維值）
+- raw：需要寫入本地 JSON 快取的原始資料；本機來源本身就在本機，為 None
+
+本機來源以串流方式讀取：雜湊邊讀邊算（CSV 直接雜湊檔案位元組），rows() 每次重新開檔／查詢、逐列產生，
+只有內容有變動的表才會被讀第二次送進建置，整張表不會先整個載入成 list。
+Google Sheets 的 batch API 一次回傳整份資料，無法串流，維持原本的做法並寫入 JSON 快取。
+"""
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+
+# (原始資料鍵, 工作表名稱, 是否轉成 records)；順序即 batch 請求的範圍順序
+SHEETS = (
+    ("drinks", "Drinks", True),
+    ("toppings", "Toppings", True),
+    ("brand_sweet", "Brand_sweet_setting", False),
+    ("brands_alias", "Brands_Alias", True),
+    ("size_alias", "Size_Alias", True),
+    ("drinks_alias", "Drinks_Alias", True),
+)
+
+_TITLES = {key: (title, as_records) for key, title, as_records in SHEETS}
+_CHUNK = 1 << 16
+
+
+class Fetched:
+    """一次 fetch 的結果。rows 為 鍵 -> 可迭代資料列 的函式。"""
+    __slots__ = ("digests", "rows", "raw")
+
+    def __init__(self, digests, rows, raw=None):
+        self.digests = digests
+        self.rows = rows
+        self.raw = raw
+
+
+def _service_account_client(secret_key_json_str):
+    # gspread 與 Google 認證套件只在真的要連 Sheets 時才載入，從快取啟動不必付這段 import 時間
+    import gspread
+
+    return gspread.service_account_from_dict(json.loads(secret_key_json_str))
+
+
+def iter_records(values):
+    """把工作表的二維值（第一列為標題）逐列轉成 get_all_records 形式的 dict；短列補空字串。"""
+    values = iter(values)
+    header = next(values, None)
+    if header is None:
+        return
+    header = [str(c).strip() for c in header]
+    width = len(header)
+    for row in values:
+        yield dict(zip(header, list(row) + [""] * (width - len(row))))
+
+
+def _to_records(values):
+    return list(iter_records(values))
+
+
+def digest(rows):
+    """工作表內容的雜湊，用來判斷這張表自上次載入後是否有變動。"""
+    encoded = json.dumps(rows, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class GoogleSheetsSource:
+    """以一次 batch values 請求抓回六張工作表。gspread 用戶端與試算表物件會重複使用。"""
+    name = "sheets"
+    remote = True
+
+    def __init__(self, secret_key_json_str="", sheet_name="", client_factory=None):
+        self.secret_key_json_str = secret_key_json_str
+        self.sheet_name = sheet_name
+        self._client_factory = client_factory or _service_account_client
+        self._spreadsheet = None
+
+    @property
+    def label(self):
+        return "Google Sheets"
+
+    def fetch(self):
+        try:
+            if self._spreadsheet is None:
+                self._spreadsheet = self._client_factory(self.secret_key_json_str).open(self.sheet_name)
+            response = self._spreadsheet.values_batch_get([f"'{title}'" for _, title, _ in SHEETS])
+        except Exception:
+            self._spreadsheet = None  # 可能是憑證或連線問題，下次重新認證
+            raise
+        value_ranges = response.get("valueRanges", [])
+        if len(value_ranges) != len(SHEETS):
+            raise ValueError(f"batch 回傳 {len(value_ranges)} 個範圍，預期 {len(SHEETS)} 個")
+        raw = {}
+        for (key, _, as_records), value_range in zip(SHEETS, value_ranges):
+            values = value_range.get("values", [])
+            raw[key] = _to_records(values) if as_records else values
+        return Fetched({key: digest(raw[key]) for key in raw}, raw.__getitem__, raw)
+
+
+class CsvDirectorySource:
+    """一個目錄裡六個以工作表名稱命名的檔案：Drinks.csv、Toppings.csv…（.tsv 以 tab 分隔）。
+
+    檔案以 UTF-8 編碼（可帶 BOM，Excel 匯出的 CSV 即可直接使用），第一列為標題。
+    """
+    name = "csv"
+    remote = False
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @property
+    def label(self):
+        return f"CSV 目錄 {self.directory}"
+
+    def _path(self, key):
+        title = _TITLES[key][0]
+        for ext in (".csv", ".tsv"):
+            path = os.path.join(self.directory, title + ext)
+            if os.path.isfile(path):
+                return path
+        raise FileNotFoundError(f"{self.directory} 中找不到 {title}.csv 或 {title}.tsv")
+
+    def fetch(self):
+        return Fetched({key: _file_digest(self._path(key)) for key, _, _ in SHEETS}, self.rows)
+
+    def rows(self, key):
+        path = self._path(key)
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            values = csv.reader(f, delimiter="\t" if path.endswith(".tsv") else ",")
+            yield from (iter_records(values) if _TITLES[key][1] else values)
+
+
+class SqliteSource:
+    """SQLite 資料庫中六張以工作表名稱命名的資料表；欄位名稱即標題列，NULL 視為空白儲存格。
+
+    Brand_sweet_setting 的第一欄為甜度名稱，其餘每欄一個品牌（與工作表相同）。以唯讀模式開啟。
+    """
+    name = "sqlite"
+    remote = False
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def label(self):
+        return f"SQLite {self.path}"
+
+    def fetch(self):
+        conn = self._connect()
+        try:
+            digests = {}
+            for key, _, _ in SHEETS:
+                h = hashlib.sha256()
+                for values in _select(conn, key):
+                    h.update(repr(values).encode("utf-8"))
+                digests[key] = h.hexdigest()
+        finally:
+            conn.close()
+        return Fetched(digests, self.rows)
+
+    def rows(self, key):
+        conn = self._connect()
+        try:
+            values = _select(conn, key)
+            yield from (iter_records(values) if _TITLES[key][1] else values)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"找不到 SQLite 資料庫 {self.path}")
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+
+def _select(conn, key):
+    """標題列（欄位名稱）後接各列的值；NULL 轉成空字串。"""
+    cursor = conn.execute(f'SELECT * FROM "{_TITLES[key][0]}"')
+    yield [column[0] for column in cursor.description]
+    for row in cursor:
+        yield ["" if value is None else value for value in row]
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def open_source(kind="sheets", path="", secret_key_json_str="", sheet_name="", client_factory=None):
+    """依設定建立資料來源：sheets（預設）、csv（path 為目錄）、sqlite（path 為資料庫檔）。"""
+    kind = (kind or "sheets").strip().lower()
+    if kind == "sheets":
+        return GoogleSheetsSource(secret_key_json_str, sheet_name, client_factory)
+    if kind not in ("csv", "sqlite"):
+        raise ValueError(f"不支援的資料來源 {kind!r}（可用 sheets、csv、sqlite）")
+    if not path:
+        raise ValueError(f"資料來源 {kind} 需要設定路徑")
+    return CsvDirectorySource(path) if kind == "csv" else SqliteSource(path)
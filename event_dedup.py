@@ -0,0 +1,175 @@
+# event_dedup.py
+"""webhook 事件去重：記錄處理過的 webhookEventId，LINE 重送同一事件時直接略過。
+
+我們回應太慢（或回了非 2xx）時 LINE 會重送 webhook；若每次重送都重跑解析、計算與回覆，
+負載會在原本就已過載的時候加倍。事件 id 在 TTL 內第一次出現才處理，之後出現一律視為重複。
+
+- EventDeduper：程序內記憶體，有上限的 OrderedDict；每次檢查取一次鎖、均攤 O(1)
+- SqliteEventDeduper：本機 SQLite 檔，同一台機器上的 gunicorn worker 共用（重送可能落在另一個 worker）；
+  以單一 INSERT … ON CONFLICT 原子地「檢查並記錄」，WAL 模式讓多個程序同時讀寫
+- 處理失敗的事件以 forget() 移除記錄，LINE 重送時可以再處理一次
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# SQLite 每寫入幾筆清理一次過期記錄
+PURGE_EVERY = 256
+
+
+class EventDeduper:
+    def __init__(self, maxsize=10000, ttl=3600.0, clock=time.monotonic):
+        """maxsize <= 0 表示停用去重（每個事件都視為第一次出現）；ttl <= 0 表示只靠數量上限淘汰。"""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._seen = OrderedDict()  # 事件 id -> 第一次出現的時間（依時間先後排列）
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.duplicates = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def first_seen(self, event_id):
+        """第一次出現（或已過期）時記錄並回傳 True；TTL 內重複出現回傳 False。"""
+        if not self.enabled or not event_id:
+            return True
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[event_id] = now
+            if len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+            self.accepted += 1
+            return True
+
+    def _expire(self, now):
+        # 依寫入順序排列，最舊的在最前面：只需從頭清到第一個未過期的項目
+        if self.ttl <= 0:
+            return
+        seen = self._seen
+        while seen:
+            event_id, seen_at = next(iter(seen.items()))
+            if now - seen_at < self.ttl:
+                break
+            del seen[event_id]
+
+    def forget(self, event_id):
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._seen)
+        return {"backend": "memory", "size": size, "maxsize": self.maxsize, "ttl": self.ttl,
+                "accepted": self.accepted, "duplicates": self.duplicates}
+
+
+class SqliteEventDeduper:
+    """多個 worker 共用的去重記錄（本機 SQLite 檔）。資料庫出錯時一律放行，不因去重擋下正常事件。"""
+
+    def __init__(self, path, ttl=3600.0, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self._clock = clock  # 跨程序比較，需用牆上時鐘
+        self._local = threading.local()
+        self._lock = threading.Lock()  # 計數器由多個執行緒更新
+        self._writes = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.errors = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS webhook_events (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS webhook_events_seen_at ON webhook_events (seen_at)")
+
+    @property
+    def enabled(self):
+        return True
+
+    def _connect(self):
+        """每個執行緒一條連線；fork 出的子程序不可沿用父程序的連線，需重開。"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def first_seen(self, event_id):
+        if not event_id:
+            return True
+        now = self._clock()
+        expired_before = now - self.ttl if self.ttl > 0 else float("-inf")
+        try:
+            conn = self._connect()
+            # 單一陳述式原子地檢查並記錄：新 id 插入；已存在但過期的以新時間覆寫；未過期的不變（rowcount 0）
+            changed = conn.execute(
+                "INSERT INTO webhook_events (id, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET seen_at = excluded.seen_at WHERE webhook_events.seen_at < ?",
+                (event_id, now, expired_before)).rowcount
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+            logger.exception("讀寫去重記錄 %s 失敗，照常處理事件", self.path)
+            return True
+        with self._lock:
+            if not changed:
+                self.duplicates += 1
+                return False
+            self.accepted += 1
+            self._writes += 1
+            purge = self._writes % PURGE_EVERY == 0
+        if purge:  # 每 PURGE_EVERY 次寫入恰好由一個執行緒清理，且不在鎖內執行 SQL
+            self._purge(conn, expired_before)
+        return True
+
+    def _purge(self, conn, expired_before):
+        if self.ttl <= 0:
+            return
+        try:
+            conn.execute("DELETE FROM webhook_events WHERE seen_at < ?", (expired_before,))
+        except sqlite3.Error:
+            logger.exception("清理過期去重記錄失敗")
+
+    def forget(self, event_id):
+        try:
+            self._connect().execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+        except sqlite3.Error:
+            logger.exception("移除去重記錄 %s 失敗", event_id)
+
+    def clear(self):
+        self._connect().execute("DELETE FROM webhook_events")
+
+    def stats(self):
+        try:
+            size = self._connect().execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            return {"backend": "sqlite", "path": self.path, "size": size, "ttl": self.ttl,
+                    "accepted": self.accepted, "duplicates": self.duplicates, "errors": self.errors}
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
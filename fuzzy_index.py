@@ -0,0 +1,123 @@
+# fuzzy_index.py
+"""找不到品名時的「您是不是要找…」建議：各品牌品名與別名的 n-gram 反向索引。
+
+DataLoader.build 時把每個品牌的正式品名（brand_drinks）與品名別名（drinks_alias_map）
+拆成單字與相鄰兩字（uni-gram + bi-gram，中文品名多為 2~6 字，單字能接住「珍奶」對「珍珠奶茶」
+這類縮寫），建立 gram -> 名稱編號 的反向索引。
+
+查詢時只走輸入字串的 gram 對應的清單，依清單長度由短到長累計共同 gram 數，
+累計掃描量超過 budget 就停止（最常見的 gram，如「茶」，最後才看，通常也最沒有鑑別力），
+再以 Dice 係數 2·共同 / (輸入 gram 數 + 候選 gram 數) 排名。每次查詢的成本有上限，
+不會隨目錄變大而對每個品名算一次編輯距離。
+
+合併品名（「奶茶/奶綠/奶青」）只以展開後的名稱建議；別名命中時建議其正式品名。
+"""
+from collections import Counter
+from itertools import chain
+
+# 每次查詢最多掃描的反向索引項目數（決定最壞情況延遲）
+DEFAULT_BUDGET = 4000
+# 依共同 gram 數先取出「建議數 × 此倍數」個候選，再精算相似度
+_CANDIDATES_PER_RESULT = 10
+
+
+def _normalize(text):
+    return "".join(str(text).split()).casefold()
+
+
+def _grams(key):
+    return {*key, *(key[i:i + 2] for i in range(len(key) - 1))}
+
+
+class _BrandIndex:
+    __slots__ = ("names", "targets", "gram_counts", "postings")
+
+    def __init__(self, entries):
+        self.names = []        # 編號 -> 正規化後的名稱（正式品名或別名）
+        self.targets = []      # 編號 -> 建議給使用者的正式品名
+        self.gram_counts = []  # 編號 -> 該名稱的 gram 數
+        postings = {}
+        for name, target in sorted(entries.items()):
+            key = _normalize(name)
+            if not key:
+                continue
+            grams = _grams(key)
+            number = len(self.names)
+            self.names.append(key)
+            self.targets.append(target)
+            self.gram_counts.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(number)
+        self.postings = {gram: tuple(numbers) for gram, numbers in postings.items()}  # gram -> (編號, ...)
+
+    def postings_for(self, grams):
+        """依 grams 的迭代順序回傳各 gram 的編號清單（沒有時為空 tuple）。"""
+        return [self.postings.get(gram, ()) for gram in grams]
+
+    def entries(self, numbers):
+        """編號 -> (名稱, 正式品名, gram 數)。"""
+        return {number: (self.names[number], self.targets[number], self.gram_counts[number]) for number in numbers}
+
+
+def brand_indexes(brand_drinks, drinks_alias_map):
+    """逐品牌產生 (品牌, _BrandIndex)；SuggestionIndex 與 SQLite 查表模式（sqlite_lookup）共用。"""
+    entries = {brand: {name: name for name in names if "/" not in name}
+               for brand, names in brand_drinks.items()}
+    for (brand, alias), std in drinks_alias_map.items():
+        entries.setdefault(brand, {}).setdefault(alias, std)
+    for brand, names in entries.items():
+        yield brand, _BrandIndex(names)
+
+
+def rank_suggestions(index, text, limit=3, min_score=0.3, budget=DEFAULT_BUDGET):
+    """在一個品牌的索引中找最接近 text 的正式品名。index 需提供 postings_for() 與 entries()（見 _BrandIndex）。"""
+    key = _normalize(text)
+    if not key:
+        return []
+    grams = _grams(key)
+    selected = []
+    scanned = 0
+    for numbers in sorted(index.postings_for(grams), key=len):
+        if not numbers:
+            continue
+        if scanned + len(numbers) > budget:
+            break  # 其餘 gram 更常見，掃描成本高而鑑別力低
+        scanned += len(numbers)
+        selected.append(numbers)
+    candidates = Counter(chain.from_iterable(selected)).most_common(limit * _CANDIDATES_PER_RESULT)
+    entries = index.entries([number for number, _ in candidates])
+
+    # 先依共同 gram 數取出少量候選，再算 Dice 係數排名（同分時長度較接近者優先）
+    total = len(grams)
+    scored = sorted(
+        ((2 * count / (total + entries[number][2]), -abs(len(entries[number][0]) - len(key)), -number)
+         for number, count in candidates),
+        reverse=True)
+    suggestions = []
+    for score, _, negated in scored:
+        if score < min_score:
+            break
+        target = entries[-negated][1]
+        if target not in suggestions:
+            suggestions.append(target)
+            if len(suggestions) == limit:
+                break
+    return suggestions
+
+
+class SuggestionIndex:
+    __slots__ = ("_brands",)
+
+    def __init__(self, brands):
+        self._brands = brands  # 品牌 -> _BrandIndex
+
+    @classmethod
+    def build(cls, brand_drinks, drinks_alias_map):
+        return cls(dict(brand_indexes(brand_drinks, drinks_alias_map)))
+
+    def suggest(self, brand, text, limit=3, min_score=0.3, budget=DEFAULT_BUDGET):
+        """回傳最接近 text 的至多 limit 個正式品名（相似度由高到低）；沒有夠接近的回傳空清單。"""
+        index = self._brands.get(brand)
+        if index is None:
+            return []
+        return rank_suggestions(index, text, limit, min_score, budget)
@@ -0,0 +1,147 @@
+# index_snapshot.py
+"""建好的索引快照檔：多 worker 共用，也用於重啟時快速載入。
+
+負責更新的 worker（執行「更新資料」或排程更新的那一個）把建好的 DataSnapshot
+寫成單一檔案（先寫暫存檔再 os.replace，讀取端永遠看到完整的檔案），
+其他 worker 以 SnapshotWatcher 定期檢查檔頭的版本號，發現較新版本就以 mmap
+映射檔案後載入，因此一次「更新資料」就能更新所有 worker。
+
+重啟時直接載入這個檔案即可服務，不必重新解析原始 JSON 快取、展開品名與建索引；
+檔頭帶有格式版本、schema 版本與 CRC32，任何一項不符都會拋出 SnapshotError，
+由呼叫端退回原始 JSON 快取重建。
+
+檔案格式（little-endian）：
+    MAGIC(6) + 格式版本(uint16) + schema(uint32) + 版本號(uint64) + 內容長度(uint64) + CRC32(uint32)
+    + pickle 內容
+"""
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CALIDX"
+FORMAT_VERSION = 2
+_HEADER = struct.Struct("<6sHIQQI")
+
+
+class SnapshotError(ValueError):
+    """快照檔不存在、格式或 schema 不符、或內容不完整。"""
+
+
+def new_version():
+    """以寫入時間（奈秒）作為版本號：不同 worker 各自寫入也能比較新舊。"""
+    return time.time_ns()
+
+
+def write_snapshot(path, snapshot, schema, version=None):
+    """把快照寫入 path（原子替換），回傳寫入的版本號。schema 由呼叫端定義（資料結構改變時遞增）。"""
+    version = version or new_version()
+    payload = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, schema, version, len(payload), zlib.crc32(payload))
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return version
+
+
+def read_version(path, schema):
+    """只讀檔頭取得版本號；檔案不存在、格式或 schema 不符時拋出 SnapshotError。"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+    except OSError as exc:
+        raise SnapshotError(str(exc)) from exc
+    return _unpack_header(header, schema)[0]
+
+
+def read_snapshot(path, schema):
+    """以 mmap 映射檔案、驗證 CRC32 後載入快照，回傳 (版本號, 快照)。"""
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            version, length, checksum = _unpack_header(mm[:_HEADER.size], schema)
+            if len(mm) != _HEADER.size + length:
+                raise SnapshotError(f"快照檔 {path} 長度不符")
+            with memoryview(mm) as view, view[_HEADER.size:] as payload:
+                if zlib.crc32(payload) != checksum:
+                    raise SnapshotError(f"快照檔 {path} 檢查碼不符")
+                snapshot = pickle.loads(payload)
+    except SnapshotError:
+        raise
+    except Exception as exc:  # noqa: BLE001 - OSError、mmap 空檔、unpickle 失敗都視為快照損壞
+        raise SnapshotError(f"{type(exc).__name__}: {exc}") from exc
+    return version, snapshot
+
+
+def _unpack_header(header, schema):
+    if len(header) < _HEADER.size:
+        raise SnapshotError("快照檔頭不完整")
+    magic, fmt, file_schema, version, length, checksum = _HEADER.unpack(header[:_HEADER.size])
+    if magic != MAGIC:
+        raise SnapshotError("不是索引快照檔")
+    if fmt != FORMAT_VERSION:
+        raise SnapshotError(f"快照檔格式版本 {fmt}，預期 {FORMAT_VERSION}")
+    if file_schema != schema:
+        raise SnapshotError(f"快照檔 schema {file_schema}，預期 {schema}")
+    return version, length, checksum
+
+
+class SnapshotWatcher:
+    """定期（最多每 interval 秒一次）檢查快照檔是否有比 known_version 更新的版本。"""
+
+    def __init__(self, path, schema, interval=1.0):
+        self.path = path
+        self.schema = schema
+        self.interval = interval
+        self.known_version = 0
+        self._next_check = 0.0
+        self._stat_key = None
+        self._lock = threading.Lock()
+
+    def poll(self):
+        """有較新版本時回傳 (版本號, 快照)，否則回傳 None。
+
+        大多數呼叫只比較一次時間就返回；同一時間只有一個執行緒會去讀檔，
+        其他執行緒不等待，繼續使用目前的快照。
+        """
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return None
+        try:
+            self._next_check = now + self.interval
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return None
+            stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stat_key == self._stat_key:
+                return None
+            self._stat_key = stat_key
+            try:
+                if read_version(self.path, self.schema) <= self.known_version:
+                    return None
+                version, snapshot = read_snapshot(self.path, self.schema)
+            except SnapshotError:
+                logger.warning("無法讀取共用快照檔 %s", self.path, exc_info=True)
+                return None
+            self.known_version = version
+            return version, snapshot
+        finally:
+            self._lock.release()
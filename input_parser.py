@@ -4,8 +4,24 @@
 解析順序：
 1. 先用正則抽出 +配料 / -配料（支援 *N 份數與全形符號），並從字串移除
 2. 第 1 個詞比對品牌（別名表或正式名稱）
-3. 品牌後的詞組出品名（最多合併 3 個連續詞，處理品名被空格拆開的情況）
-4. 剩餘文字依序比對尺寸、冰量、甜度（長別名優先，比中後即從文字移除，避免重複比對）
+3. 品牌後的詞組出品名（最多合併 3 個連續詞，處理品名被空格拆開的情況）；
+   找不到時以 data.suggestions（n-gram 索引）附上最接近的幾個正式品名
+   沒有空白或空白位置不對（「50嵐珍奶微糖」、「50嵐 珍奶微糖」）時，改把文字去掉空白後
+   以 data.brand_matcher（每個資料世代建一次的字典樹）切出最長的品牌，再由長到短嘗試品名；
+   品名之後的文字必須能完全被尺寸、冰量、甜度比對用完才採用，否則視為找不到品名
+   （「50嵐 奶茶拿鐵」不會被當成「奶茶」加上無法辨識的「拿鐵」）
+4. 剩餘文字依序比對尺寸、冰量、甜度（長別名優先，比中後即從文字移除，避免重複比對）；
+   別名表在 DataLoader.build 時已編成 AliasMatcher，這裡只需掃描一次文字
+
+每次解析只取一次 loader.snapshot（或由呼叫端傳入 data），整個解析過程都讀同一份資料。
+
+normalize() 則處理已拆好欄位的結構化點單（批次 API 用），輸出格式與 parse() 相同。
+
+parse_ranking() / normalize_ranking() 解析排行查詢（「低卡 50嵐 300以下」與 /api/rank 參數），
+輸出 {brand, metric, descending, low, high, size, ice}，交給 RankingIndex.query。
+
+無法解析時各函式都回傳 {"error": 給使用者看的訊息, "code": 錯誤類別}；
+code 為固定的英文代碼（unknown_brand、unknown_drink、too_short…），供監控指標分類計數。
 """
 import re
 
@@ -17,12 +33,30 @@ _TOPPING_PATTERN = re.compile(r"([+＋\-－])\s*([^\s+＋\-－*＊]+)(?:[*＊](\
 # 品名最多可由幾個連續詞組成
 _MAX_DRINK_TOKENS = 3
 
+# 結構化點單的冰量欄位：除了自然語言關鍵字，也接受標準代碼與「冰」
+_STRUCTURED_ICE = {**ICE_OPTIONS, "冰": "I", "I": "I", "H": "H"}
+
+# 排行查詢指令 -> (排序指標, 是否由高到低)
+RANKING_COMMANDS = {
+    "低卡": ("calories", False),
+    "高卡": ("calories", True),
+    "低糖": ("sugar", False),
+    "高糖": ("sugar", True),
+}
+
+# 排行查詢的數值範圍：300、300以下、200~400大卡、20克以上
+_RANGE_PATTERN = re.compile(
+    r"(\d+(?:\.\d+)?)\s*(?:[~～\-－到至]\s*(\d+(?:\.\d+)?))?\s*"
+    r"(大卡|kcal|卡|公克|克|g)?\s*(以下|以內|內|以上)?", re.IGNORECASE)
+_CALORIE_UNITS = {"大卡", "kcal", "卡"}
+
 
 class UserInputParser:
     def __init__(self, data_loader):
         self.loader = data_loader
 
-    def parse(self, user_input: str) -> dict:
+    def parse(self, user_input: str, data=None) -> dict:
+        data = data or self.loader.snapshot
         text = user_input.strip()
 
         toppings, removed = [], []
@@ -34,66 +68,252 @@ class UserInputParser:
             return " "
 
         remainder = _TOPPING_PATTERN.sub(_collect, text)
+        brand, drink, rest_text, error = self._split_order(data, remainder.split())
+        if error:
+            return error
 
-        words = remainder.split()
-        if len(words) < 2:
-            return {"error": "輸入資訊過少，請遵循「品牌 品名 [尺寸/冰量/甜度] [+配料]」格式"}
+        size, rest_text = data.size_matcher.consume(rest_text)
+        ice, rest_text = data.ice_matcher.consume(rest_text)
+        sweetness, rest_text = data.sweetness_matcher.consume(rest_text)
 
-        brand = self._identify_brand(words[0])
-        if not brand:
-            return {"error": f"找不到品牌「{words[0]}」"}
+        return {
+            "brand": brand,
+            "drink": drink,
+            "size": size or DEFAULT_SIZE,
+            "ice": ice or DEFAULT_ICE,
+            "sweetness": sweetness,
+            "toppings": toppings,
+            "removed_toppings": removed,
+        }
+
+    def normalize(self, fields: dict, data=None) -> dict:
+        """把 {brand, drink, size, ice, sweetness, toppings, removed_toppings} 轉成與 parse() 相同的格式。
 
-        drink, used_tokens = self._identify_drink(brand, words[1:])
+        品牌、品名、尺寸、冰量都接受別名或標準值；配料清單必須是 list，每項可為 "珍珠" 或 {"name": "珍珠", "count": 2}。
+        """
+        data = data or self.loader.snapshot
+        brand_text = str(fields.get("brand") or "").strip()
+        drink_text = str(fields.get("drink") or "").strip()
+        if not (brand_text and drink_text):
+            return _error("missing_field", "結構化點單需要 brand 與 drink 欄位")
+
+        brand = self._identify_brand(data, brand_text)
+        if not brand:
+            return _error("unknown_brand", f"找不到品牌「{brand_text}」")
+        drink, _ = self._identify_drink(data, brand, drink_text.split())
         if not drink:
-            return {"error": f"在 {brand} 中找不到飲品「{words[1]}」"}
+            return _drink_not_found(data, brand, drink_text)
 
-        rest_text = " ".join(words[1 + used_tokens:])
-        size, rest_text = self._consume(rest_text, self.loader.size_alias_map)
-        ice, rest_text = self._consume(rest_text, ICE_OPTIONS)
-        sweetness, rest_text = self._consume_sweetness(rest_text)
+        size_text = str(fields.get("size") or "").strip()
+        ice_text = str(fields.get("ice") or "").strip()
+        ice = _STRUCTURED_ICE.get(ice_text.upper()) if ice_text else DEFAULT_ICE
+        if not ice:
+            return _error("unknown_ice", f"無法辨識冰量「{ice_text}」")
+        try:
+            toppings = _topping_items(fields.get("toppings"))
+            removed = _topping_items(fields.get("removed_toppings"))
+        except (KeyError, TypeError, ValueError):
+            return _error("bad_topping", "配料格式錯誤，請使用 \"名稱\" 或 {\"name\": 名稱, \"count\": 份數}")
 
         return {
             "brand": brand,
             "drink": drink,
-            "size": size or DEFAULT_SIZE,
-            "ice": ice or DEFAULT_ICE,
-            "sweetness": sweetness,
+            "size": data.size_alias_map.get(size_text, size_text) or DEFAULT_SIZE,
+            "ice": ice,
+            "sweetness": str(fields.get("sweetness") or "").strip() or None,
             "toppings": toppings,
             "removed_toppings": removed,
         }
 
-    def _identify_brand(self, token):
+    def parse_ranking(self, user_input: str, data=None) -> dict:
+        """解析「低卡 品牌 [尺寸] [冰量] [範圍]」；指令須為 RANKING_COMMANDS 之一，無法辨識的條件回傳 bad_filter。"""
+        data = data or self.loader.snapshot
+        words = user_input.split()
+        command = RANKING_COMMANDS.get(words[0]) if words else None
+        if not command:
+            return _error("bad_command", f"排行指令需以 {'、'.join(RANKING_COMMANDS)} 開頭")
+        metric, descending = command
+        if len(words) < 2:
+            return _error("missing_field", f"請指定品牌，例如「{words[0]} 50嵐 300以下」")
+        brand = self._identify_brand(data, words[1])
+        if not brand:
+            return _error("unknown_brand", f"找不到品牌「{words[1]}」")
+
+        # 先移除數值範圍再比對尺寸，避免「大卡」的「大」被當成尺寸別名
+        rest_text = " ".join(words[2:])
+        low = high = None
+        match = _RANGE_PATTERN.search(rest_text)
+        if match:
+            first, second, unit, bound = match.groups()
+            if unit and (unit.lower() in _CALORIE_UNITS) != (metric == "calories"):
+                return _error("bad_range", f"「{words[0]}」的範圍單位是{'大卡' if metric == 'calories' else '克'}")
+            if second is not None:
+                low, high = sorted((float(first), float(second)))
+            elif bound == "以上":
+                low = float(first)
+            else:
+                high = float(first)
+            rest_text = rest_text[:match.start()] + " " + rest_text[match.end():]
+        size, rest_text = data.size_matcher.consume(rest_text)
+        ice, rest_text = data.ice_matcher.consume(rest_text)
+        # 與 normalize() 相同，也接受工作表的尺寸代碼（L、M）與冰量代碼（冰、I、H）；
+        # 其餘無法辨識的文字不可默默忽略，否則使用者會拿到沒有套用篩選的排行
+        sizes = {code.upper(): code for code in data.size_alias_map.values()}
+        unknown = []
+        for word in rest_text.split():
+            if size is None and word.upper() in sizes:
+                size = sizes[word.upper()]
+            elif ice is None and word.upper() in _STRUCTURED_ICE:
+                ice = _STRUCTURED_ICE[word.upper()]
+            else:
+                unknown.append(word)
+        if unknown:
+            return _error("bad_filter", f"無法辨識篩選條件「{' '.join(unknown)}」，可指定尺寸、冰量與範圍，"
+                                        f"例如「{words[0]} {words[1]} 大杯 熱 300以下」")
+        return {"brand": brand, "metric": metric, "descending": descending,
+                "low": low, "high": high, "size": size, "ice": ice}
+
+    def normalize_ranking(self, fields, data=None) -> dict:
+        """把 /api/rank 的參數 {brand, metric, order, min, max, size, ice} 轉成與 parse_ranking() 相同的格式。"""
+        data = data or self.loader.snapshot
+        brand_text = str(fields.get("brand") or "").strip()
+        if not brand_text:
+            return _error("missing_field", "需要 brand 參數")
+        brand = self._identify_brand(data, brand_text)
+        if not brand:
+            return _error("unknown_brand", f"找不到品牌「{brand_text}」")
+        metric = str(fields.get("metric") or "calories").strip()
+        if metric not in ("calories", "sugar"):
+            return _error("bad_metric", "metric 只能是 calories 或 sugar")
+        order = str(fields.get("order") or "asc").strip()
+        if order not in ("asc", "desc"):
+            return _error("bad_order", "order 只能是 asc 或 desc")
+        try:
+            low, high = (float(fields[name]) if str(fields.get(name) or "").strip() else None
+                         for name in ("min", "max"))
+        except ValueError:
+            return _error("bad_range", "min、max 必須是數字")
+        size_text = str(fields.get("size") or "").strip()
+        ice_text = str(fields.get("ice") or "").strip()
+        ice = _STRUCTURED_ICE.get(ice_text.upper()) if ice_text else None
+        if ice_text and not ice:
+            return _error("unknown_ice", f"無法辨識冰量「{ice_text}」")
+        return {"brand": brand, "metric": metric, "descending": order == "desc",
+                "low": low, "high": high, "size": data.size_alias_map.get(size_text, size_text) or None,
+                "ice": ice}
+
+    def _split_order(self, data, words):
+        """切出品牌與品名，回傳 (品牌, 品名, 剩餘文字, 錯誤)；錯誤為 _error() 的結果。
+
+        先以空白切詞；失敗時把所有詞接起來，用字典樹取最長的品牌，再由長到短嘗試品名，
+        採用第一個「剩餘文字能被尺寸、冰量、甜度完全比對掉」的切法。
+        兩種方式都失敗時，錯誤訊息以較接近成功的一方為準。
+        """
+        brand = self._identify_brand(data, words[0]) if len(words) >= 2 else None
+        if brand:
+            drink, used_tokens = self._identify_drink(data, brand, words[1:])
+            if drink:
+                return brand, drink, " ".join(words[1 + used_tokens:]), None
+
+        compact = "".join(words)
+        folded = compact.casefold()
+        match = data.brand_matcher.longest_prefix(folded if len(folded) == len(compact) else compact)
+        if match:
+            brand_end, segmented_brand = match
+            for drink_end, drink in self._drink_prefixes(data, segmented_brand, compact, brand_end):
+                if _fully_consumed(data, compact[drink_end:]):
+                    return segmented_brand, drink, compact[drink_end:], None
+
+        if brand:
+            return None, None, None, _drink_not_found(data, brand, words[1])
+        if match and brand_end < len(compact):
+            return None, None, None, _drink_not_found(data, segmented_brand, compact[brand_end:])
+        if len(words) < 2:
+            return None, None, None, _error(
+                "too_short", "輸入資訊過少，請遵循「品牌 品名 [尺寸/冰量/甜度] [+配料]」格式")
+        return None, None, None, _error("unknown_brand", f"找不到品牌「{words[0]}」")
+
+    @staticmethod
+    def _identify_brand(data, token):
         token = token.strip()
-        if token in self.loader.known_brands:
+        if token in data.known_brands:
             return token
-        return (self.loader.brands_alias_map.get(token)
-                or self.loader.brands_alias_map.get(token.casefold()))
+        return data.brands_alias_map.get(token) or data.brands_alias_map.get(token.casefold())
 
-    def _identify_drink(self, brand, tokens):
+    @staticmethod
+    def _identify_drink(data, brand, tokens):
         """從品牌後的詞嘗試組出品名，較長的組合優先。"""
-        brand_drinks = self.loader.brand_drinks.get(brand, set())
+        brand_drinks = data.brand_drinks.get(brand, set())
         for k in range(min(_MAX_DRINK_TOKENS, len(tokens)), 0, -1):
             candidate = "".join(tokens[:k])
             # 正式品名優先於別名，避免別名表把使用者輸入的正式品名改寫成別款飲料
             if candidate in brand_drinks:
                 return candidate, k
-            std = self.loader.drinks_alias_map.get((brand, candidate))
+            std = data.drinks_alias_map.get((brand, candidate))
             if std:
                 return std, k
         return None, 0
 
     @staticmethod
-    def _consume(text, mapping):
-        """在剩餘文字中尋找別名（長的優先），找到後從文字移除。回傳 (標準值, 剩餘文字)。"""
-        for alias in sorted(mapping, key=len, reverse=True):
-            if alias and alias in text:
-                return mapping[alias], text.replace(alias, " ", 1)
-        return None, text
-
-    def _consume_sweetness(self, text):
-        names = {s for levels in self.loader.sweet_map.values() for s in levels}
-        names.update(self.loader.sweetness_order)
-        for name in sorted(names, key=len, reverse=True):
-            if name and name in text:
-                return name, text.replace(name, " ", 1)
-        return None, text
+    def _drink_prefixes(data, brand, text, start):
+        """從 start 開始可作為品名的前綴，由長到短產生 (終點, 正式品名)；正式品名優先於別名。"""
+        brand_drinks = data.brand_drinks.get(brand, set())
+        longest = data.drink_name_lengths.get(brand, 0)
+        for end in range(min(len(text), start + longest), start, -1):
+            candidate = text[start:end]
+            if candidate in brand_drinks:
+                yield end, candidate
+                continue
+            std = data.drinks_alias_map.get((brand, candidate))
+            if std:
+                yield end, std
+
+
+def _fully_consumed(data, text):
+    """text 是否全由尺寸、冰量、甜度別名組成。
+
+    同一個詞可能同時是冰量與甜度（「正常」），比對到的不一定是使用者的本意，
+    因此重複比對到沒有進展為止，只判斷是否還有無法辨識的文字。
+    """
+    matchers = (data.size_matcher, data.ice_matcher, data.sweetness_matcher)
+    progress = True
+    while progress and text.strip():
+        progress = False
+        for matcher in matchers:
+            value, rest = matcher.consume(text)
+            if value is not None and rest != text:
+                text, progress = rest, True
+    return not text.strip()
+
+
+def _error(code, message):
+    return {"error": message, "code": code}
+
+
+def _drink_not_found(data, brand, text):
+    message = f"在 {brand} 中找不到飲品「{text}」"
+    suggestions = data.suggestions.suggest(brand, text)
+    if suggestions:
+        message += f"，您是不是要找：{'、'.join(suggestions)}？"
+    return _error("unknown_drink", message)
+
+
+def _topping_items(items):
+    """結構化配料清單 -> [(名稱, 份數), ...]；必須是 list，否則字串會被逐字拆開、物件只剩鍵名。"""
+    if not items:
+        return []
+    if not isinstance(items, list):
+        raise TypeError(items)
+    return [_topping_item(t) for t in items]
+
+
+def _topping_item(item):
+    """結構化配料 -> (名稱, 份數)。"""
+    if isinstance(item, str):
+        name, count = item, 1
+    else:
+        name, count = item["name"], int(item.get("count", 1))
+    name = str(name).strip()
+    if not name or count < 1:
+        raise ValueError(item)
+    return name, count
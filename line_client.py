@@ -0,0 +1,126 @@
+# line_client.py
+"""全程序共用、連線可重複使用的 LINE Messaging API 用戶端。
+
+舊做法每個事件都 `with ApiClient(configuration)` 建一個新的連線池，
+每次回覆都要重新做 TCP/TLS 握手；改成整個 worker 共用一個 ApiClient，
+urllib3 連線池保持 keep-alive，暖連線上的回覆只需一次請求。
+
+連線池大小（LINE_POOL_SIZE）應與 gunicorn 的 --threads 相同，
+讓每個執行緒都能拿到一條連線，不會互相等待。
+
+每次呼叫的耗時另外記錄在 calcal_line_api_seconds 直方圖（/metrics），依成功與否分開。
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+from linebot.v3.messaging import (
+    ApiClient,
+    ApiException,
+    MessagingApi,
+    ReplyMessageRequest,
+    TextMessage,
+)
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_API_SECONDS = metrics.Histogram("calcal_line_api_seconds", "LINE reply API 呼叫耗時", ("result",))
+_API_OK = _API_SECONDS.labels("ok")
+_API_ERROR = _API_SECONDS.labels("error")
+
+
+class LineReplyClient:
+    def __init__(self, configuration, pool_size=8, timeout=10.0):
+        configuration.connection_pool_maxsize = pool_size
+        self.configuration = configuration
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._api_client = None
+        self._messaging_api = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # 回覆 API 延遲統計（與我們自己的計算時間分開看）
+        self.calls = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def _api(self):
+        """第一次使用時才建立連線池；fork 出的子程序不可沿用父程序的連線，需重建。"""
+        api = self._messaging_api
+        if api is not None and self._pid == os.getpid():
+            return api
+        with self._lock:
+            if self._messaging_api is None or self._pid != os.getpid():
+                self._api_client = ApiClient(self.configuration)
+                self._messaging_api = MessagingApi(self._api_client)
+                self._pid = os.getpid()
+            return self._messaging_api
+
+    def reply(self, reply_token, text):
+        """送出文字回覆，回傳此次 API 呼叫耗時（秒）；失敗時照常拋出例外。"""
+        api = self._api()
+        start = time.perf_counter()
+        ok = False
+        try:
+            api.reply_message_with_http_info(
+                ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text)]),
+                _request_timeout=self.timeout,
+            )
+            ok = True
+        finally:
+            elapsed = time.perf_counter() - start
+            self._record(elapsed, ok)
+        logger.debug("LINE reply API 耗時 %.1f ms", elapsed * 1000)
+        return elapsed
+
+    def reply_with_retry(self, reply_token, text, deadline, retries=3, backoff=0.5):
+        """失敗時以指數退避（含抖動）重試，直到 deadline（time.time() 秒數，即 reply token 到期前）。
+
+        只重試暫時性錯誤（連線錯誤、429、5xx）；4xx 代表 token 已失效或請求有誤，重試也沒用。
+        """
+        for attempt in range(retries + 1):
+            try:
+                return self.reply(reply_token, text)
+            except Exception as exc:  # noqa: BLE001 - 依錯誤類型決定是否重試
+                status = exc.status if isinstance(exc, ApiException) else None
+                retryable = status is None or status == 429 or status >= 500
+                delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if not retryable or attempt == retries or time.time() + delay >= deadline:
+                    raise
+                logger.warning("LINE reply 失敗（%s），%.2f 秒後第 %d 次重試",
+                               status or type(exc).__name__, delay, attempt + 1)
+                time.sleep(delay)
+
+    def _record(self, elapsed, ok):
+        (_API_OK if ok else _API_ERROR).observe(elapsed)
+        with self._lock:
+            self.calls += 1
+            self.failures += not ok
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+    def close(self):
+        """關閉連線池（程序結束時由 atexit 呼叫）。"""
+        with self._lock:
+            if self._api_client is not None and self._pid == os.getpid():
+                self._api_client.close()
+                # ApiClient.close 只關 SDK 自己的執行緒池，keep-alive 連線要另外關
+                self._api_client.rest_client.pool_manager.clear()
+            self._api_client = None
+            self._messaging_api = None
+
+    def stats(self):
+        with self._lock:
+            calls = self.calls
+            return {
+                "pool_size": self.pool_size,
+                "calls": calls,
+                "failures": self.failures,
+                "avg_ms": round(self.total_seconds / calls * 1000, 1) if calls else None,
+                "max_ms": round(self.max_seconds * 1000, 1),
+            }
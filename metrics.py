@@ -0,0 +1,323 @@
+# metrics.py
+"""程序內的 Prometheus 指標（計數器、量表、直方圖），由 /metrics 以文字格式輸出。
+
+記錄路徑不加鎖：每個執行緒第一次記錄某個指標時配一份自己的計數陣列（分片），
+之後只在自己的分片上累加，執行緒之間不會互相等待；只有配分片與 /metrics 匯總時才取鎖。
+已結束的執行緒的分片會在下次配分片時併入「已退場」總計，背景更新這類短命執行緒不會讓分片越積越多。
+
+已經有自己計數的元件（回覆快取、LINE 用戶端、回覆佇列）不重複計數：以 callback 在輸出時讀取。
+
+用法（與 prometheus_client 相同的習慣：指標在使用它的模組層級定義一次）：
+    STAGE_SECONDS = metrics.Histogram("calcal_stage_seconds", "各階段耗時", ("stage",))
+    STAGE_SECONDS.labels("parse").observe(0.0003)
+    with STAGE_SECONDS.labels("calculate").time():
+        ...
+    metrics.Gauge("calcal_data_generation", "資料世代", callback=lambda: loader.generation)
+
+指標只在單一程序內累計：gunicorn 多 worker 時每次抓取只會看到其中一個 worker 的數值。
+"""
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+
+# 預設的延遲分桶（秒）：涵蓋微秒級的解析到數秒的 Sheets 抓取
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指標 {metric.name} 已註冊")
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """輸出 Prometheus 文字格式（text/plain; version=0.0.4）。"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception:  # noqa: BLE001 - 單一 callback 出錯不能讓整個 /metrics 失敗
+                logger.exception("輸出指標 %s 失敗", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Shards:
+    """每個執行緒一份的數值陣列；totals() 匯總所有分片（含已結束執行緒留下的數值）。"""
+    __slots__ = ("size", "_local", "_live", "_retired", "_lock")
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._live = []  # [(執行緒, 陣列)]
+        self._retired = [0.0] * size
+        self._lock = threading.Lock()
+
+    def mine(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            return self._allocate()
+
+    def _allocate(self):
+        values = [0.0] * self.size
+        with self._lock:
+            live = []
+            for thread, other in self._live:
+                if thread.is_alive():
+                    live.append((thread, other))
+                else:  # 已結束的執行緒不會再寫入，可以安全併入總計
+                    self._retired = [a + b for a, b in zip(self._retired, other)]
+            live.append((threading.current_thread(), values))
+            self._live = live
+        self._local.values = values
+        return values
+
+    def totals(self):
+        with self._lock:
+            rows = [values for _, values in self._live]
+            totals = list(self._retired)
+        for values in rows:
+            for i, value in enumerate(values):
+                totals[i] += value
+        return totals
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._unlabelled = None if self.labelnames else self._new_child()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """回傳指定標籤值的子指標；同樣的標籤值永遠回傳同一個物件，可在模組層級先取好。"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} 需要標籤 {self.labelnames}，收到 {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _items(self):
+        if self._unlabelled is not None:
+            return [((), self._unlabelled)]
+        with self._lock:
+            return sorted(self._children.items())
+
+    def _label_text(self, values, extra=()):
+        pairs = [*zip(self.labelnames, values), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs) + "}"
+
+
+class _CounterChild:
+    __slots__ = ("_shards",)
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.mine()[0] += amount
+
+    @property
+    def value(self):
+        return self._shards.totals()[0]
+
+
+class Counter(_Metric):
+    """只增不減的計數。callback 回傳數值（無標籤）或 {標籤值 tuple: 數值}，用於輸出既有元件自己的計數。"""
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, callback=None):
+        self.callback = callback
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    @property
+    def value(self):
+        return self._unlabelled.value
+
+    def samples(self):
+        if self.callback is not None:
+            return _callback_samples(self, self.callback())
+        return [f"{self.name}{self._label_text(values)} {_format(child.value)}"
+                for values, child in self._items()]
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value  # 單一參照替換，不需要鎖
+
+
+class Gauge(_Metric):
+    """目前數值。多半以 callback 在輸出時才讀取（資料世代、列數等），記錄端完全沒有成本。"""
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, callback=None):
+        self.callback = callback
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+    def samples(self):
+        if self.callback is not None:
+            return _callback_samples(self, self.callback())
+        return [f"{self.name}{self._label_text(values)} {_format(child.value)}"
+                for values, child in self._items()]
+
+
+class _Timer:
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class _HistogramChild:
+    __slots__ = ("_bounds", "_shards")
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        # 分片陣列：各分桶的計數（最後一格為 +Inf），再加上總和
+        self._shards = _Shards(len(bounds) + 2)
+
+    def observe(self, value):
+        values = self._shards.mine()
+        values[bisect_left(self._bounds, value)] += 1
+        values[-1] += value
+
+    def time(self):
+        """with histogram.time(): ... 記錄區塊耗時（秒）。"""
+        return _Timer(self)
+
+    def snapshot(self):
+        """回傳 (各分桶累積計數, 總數, 總和)。"""
+        totals = self._shards.totals()
+        cumulative, running = [], 0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, totals[-1]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+    def samples(self):
+        lines = []
+        for values, child in self._items():
+            cumulative, count, total = child.snapshot()
+            for bound, running in zip((*self.bounds, math.inf), cumulative):
+                le = "+Inf" if bound == math.inf else _format(bound)
+                lines.append(f"{self.name}_bucket{self._label_text(values, (('le', le),))} {_format(running)}")
+            lines.append(f"{self.name}_sum{self._label_text(values)} {_format(total)}")
+            lines.append(f"{self.name}_count{self._label_text(values)} {_format(count)}")
+        return lines
+
+
+def isoformat(timestamp):
+    """epoch 秒數 -> 本地時區的 ISO 8601 字串（None 照樣回傳 None）；/healthz 等狀態報告共用。"""
+    if timestamp is None:
+        return None
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(timestamp))
+
+
+def _callback_samples(metric, result):
+    if result is None:
+        return []
+    if not isinstance(result, dict):
+        return [f"{metric.name} {_format(result)}"]
+    return [f"{metric.name}{metric._label_text(values)} {_format(value)}"
+            for values, value in sorted(result.items()) if value is not None]
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _escape_help(text):
+    return text.replace("\\", r"\\").replace("\n", r"\n")
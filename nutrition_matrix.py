@@ -0,0 +1,119 @@
+# nutrition_matrix.py
+"""以 NumPy 預先算好「每筆飲品 × 每種甜度」的最終熱量與糖量（選用功能）。
+
+DataLoader 以 precompute=True 建立時，build 會一次用陣列運算算出整個結果矩陣：
+    列 = drinks_index 的每個 (品牌, 品名, 尺寸, 冰量)，另外補上「熱飲查無資料退回冰飲」的列
+    欄 = 不指定甜度（匯出時標為「未指定」）+ 所有甜度名稱
+品牌不提供的甜度、或熱量糖量不是有效數字的格子為 NaN，查表回傳 None，
+由 CalorieCalculator 走原本的逐步計算產生錯誤訊息。
+
+公式與 CalorieCalculator 完全相同（含運算順序），查表結果與逐步計算逐位元一致：
+    最終熱量 = 熱量 − 糖量 × (1 − p) × 4
+    最終糖量 = 糖量 × p
+
+numpy 為選用套件，只在 build 時才 import（未啟用預先計算時不增加啟動時間）；
+沒有安裝時 build() 回傳 None，計算器照常逐筆計算。
+"""
+import csv
+
+
+def numpy_module():
+    """回傳 numpy 模組；未安裝時回傳 None。"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def round_calories(value):
+    """與 CalorieCalculator 相同的進位方式（+1e-9 補償二進位浮點誤差）。"""
+    return round(max(0.0, value) + 1e-9)
+
+
+def round_sugar(value):
+    return round(max(0.0, value) + 1e-9, 1)
+
+
+class NutritionMatrix:
+    __slots__ = ("keys", "row_index", "levels", "level_index", "calories", "sugar", "fallback")
+
+    def __init__(self, keys, levels, calories, sugar, fallback):
+        self.keys = keys                # 列 -> (品牌, 品名, 尺寸, 冰量)
+        self.row_index = {key: i for i, key in enumerate(keys)}
+        self.levels = levels            # 欄 -> 甜度名稱；第 0 欄為 None（不指定甜度）
+        self.level_index = {level: j for j, level in enumerate(levels)}
+        self.calories = calories        # float64 (列數, 欄數)
+        self.sugar = sugar              # float64 (列數, 欄數)
+        self.fallback = fallback        # bool (列數,)：此列是熱飲退回冰飲數值
+
+    @classmethod
+    def build(cls, drinks_index, sweet_map, sweetness_order):
+        """由快照的表格建立矩陣；沒有 numpy 時回傳 None。"""
+        np = numpy_module()
+        if np is None:
+            return None
+        keys = list(drinks_index)
+        fallback = [False] * len(keys)
+        # 熱飲查無資料時退回同尺寸冰飲（與 CalorieCalculator 相同規則）
+        for brand, drink, size, ice in list(keys):
+            hot = (brand, drink, size, "H")
+            if ice == "I" and hot not in drinks_index:
+                keys.append(hot)
+                fallback.append(True)
+        values = [drinks_index[key] if not is_fallback else drinks_index[(*key[:3], "I")]
+                  for key, is_fallback in zip(keys, fallback)]
+        base = np.array([[np.nan if v is None else v for v in pair] for pair in values],
+                        dtype=np.float64).reshape(len(keys), 2)
+
+        levels = [None, *dict.fromkeys([*sweetness_order, *(s for m in sweet_map.values() for s in m)])]
+        brands = sorted({key[0] for key in keys})
+        brand_ids = {brand: i for i, brand in enumerate(brands)}
+        # 品牌 × 甜度的剩餘糖量比例；第 0 欄（不指定甜度）為 1，不提供的甜度為 NaN
+        ratios = np.full((len(brands), len(levels)), np.nan)
+        ratios[:, 0] = 1.0
+        for brand, row in brand_ids.items():
+            for j, level in enumerate(levels[1:], start=1):
+                ratio = sweet_map.get(brand, {}).get(level)
+                if ratio is not None:
+                    ratios[row, j] = ratio
+        row_ratios = ratios[np.fromiter((brand_ids[key[0]] for key in keys), dtype=np.intp,
+                                        count=len(keys))]
+
+        calories = base[:, :1] - base[:, 1:] * (1 - row_ratios) * 4
+        sugar = base[:, 1:] * row_ratios
+        return cls(keys, levels, calories, sugar, np.array(fallback, dtype=bool))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, brand, drink, size, ice, sweetness=None):
+        """回傳 (熱量, 糖量, 是否退回冰飲)（未進位）；查無此列、品牌無此甜度或數值無效時回傳 None。"""
+        i = self.row_index.get((brand, drink, size, ice))
+        j = self.level_index.get(sweetness or None)
+        if i is None or j is None:
+            return None
+        calories = float(self.calories[i, j])
+        if calories != calories:  # NaN
+            return None
+        return calories, float(self.sugar[i, j]), bool(self.fallback[i])
+
+    def iter_rows(self):
+        """逐格產生 (品牌, 品名, 尺寸, 冰量, 甜度, 熱量, 糖量, 是否退回冰飲)，已依計算器規則進位。"""
+        valid = self.calories == self.calories  # NaN 不等於自己
+        for i, j in zip(*valid.nonzero()):
+            brand, drink, size, ice = self.keys[i]
+            yield (brand, drink, size, ice, self.levels[j] or "未指定",
+                   round_calories(float(self.calories[i, j])), round_sugar(float(self.sugar[i, j])),
+                   bool(self.fallback[i]))
+
+    def to_csv(self, path):
+        """把整個目錄的營養表匯出成 CSV，回傳列數。"""
+        count = 0
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["品牌", "品名", "尺寸", "冰量", "甜度", "熱量", "糖量", "熱飲以冰飲估算"])
+            for row in self.iter_rows():
+                writer.writerow(row)
+                count += 1
+        return count
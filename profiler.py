@@ -0,0 +1,227 @@
+# profiler.py
+"""線上流量的即時剖析：剖析接下來 N 次（或一段時間內）的 build_reply / callback 呼叫。
+
+- 平常（沒有進行中的剖析）：被掛勾的函式只多一次屬性讀取與比較，沒有其他成本
+- 剖析中：每次呼叫各自建立一個 cProfile.Profile（只剖析該執行緒），結束後把結果放進清單，
+  取結果時才合併成 pstats；請求執行緒之間不共用鎖，不會被剖析器串行化
+- 另有一個取樣執行緒，每 interval 秒以 sys._current_frames() 記錄正在被剖析的執行緒的呼叫堆疊，
+  輸出 collapsed stack 文字（「a;b;c 次數」，可直接交給 flamegraph.pl / speedscope）
+- 同一執行緒巢狀呼叫（callback 內的 build_reply）只剖析最外層
+
+執行環境為 Python 3.11（見 Dockerfile），cProfile 只剖析啟用它的執行緒。3.12 起 cProfile 改用
+sys.monitoring，同一時間只能有一個 Profile 啟用：搶不到的呼叫只留下取樣堆疊。
+"""
+import cProfile
+import functools
+import io
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from metrics import isoformat
+
+# 單次剖析最長秒數（次數模式沒有流量時也會在這之後結束）
+MAX_SECONDS = 300.0
+DEFAULT_INTERVAL = 0.005
+
+
+class ProfileSession:
+    def __init__(self, targets, count=None, seconds=None, interval=DEFAULT_INTERVAL, cprofile=True,
+                 on_close=None):
+        self.targets = frozenset(targets)
+        self.count = count
+        self.seconds = min(seconds or MAX_SECONDS, MAX_SECONDS)
+        self.interval = interval
+        self.cprofile = cprofile
+        self.started_at = time.time()
+        self._deadline = time.monotonic() + self.seconds
+        self._on_close = on_close
+        self._tickets = itertools.count()  # 每次呼叫取號；取號是原子操作，不需要鎖
+        self._profiles = []                # 已完成的 cProfile.Profile（list.append 為原子操作）
+        self._durations = []
+        self._active = {}                  # 執行緒 id -> 目標名稱（取樣執行緒據此挑選要記錄的執行緒）
+        self._samples = Counter()          # collapsed stack -> 次數；只有取樣執行緒會寫入
+        self._closed = threading.Event()
+        self.ended_at = None
+        self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+        self._sampler.start()
+
+    @property
+    def running(self):
+        return not self._closed.is_set()
+
+    def run(self, target, func, args, kwargs):
+        ident = threading.get_ident()
+        if ident in self._active or not self.running:
+            return func(*args, **kwargs)
+        if self.count is not None and next(self._tickets) >= self.count:
+            return func(*args, **kwargs)
+        if time.monotonic() >= self._deadline:
+            self.close()
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile() if self.cprofile else None
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:  # Python 3.12+：已有其他執行緒啟用 cProfile
+                profile = None
+        self._active[ident] = target
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._profiles.append(profile)
+            self._durations.append(time.perf_counter() - start)
+            del self._active[ident]
+            if self.count is not None and len(self._durations) >= self.count:
+                self.close()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.ended_at = time.time()
+        if self._on_close:
+            self._on_close(self)
+
+    def wait(self, timeout=None):
+        return self._closed.wait(timeout)
+
+    def _sample_loop(self):
+        run_code = ProfileSession.run.__code__
+        while not self._closed.wait(self.interval):
+            if time.monotonic() >= self._deadline:
+                self.close()
+                break
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for ident, target in list(self._active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and frame.f_code is not run_code:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(target)
+                self._samples[";".join(reversed(stack))] += 1
+
+    # --- 結果 ---
+    def stats(self):
+        """合併所有呼叫的 pstats.Stats（沒有 cProfile 結果時為空的 Stats）。"""
+        profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0]) if profiles else pstats.Stats()
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def pstats_bytes(self):
+        """與 Stats.dump_stats 相同格式（marshal），存成 .prof 後可用 pstats、snakeviz 開啟。"""
+        return marshal.dumps(self.stats().stats)
+
+    def collapsed(self):
+        samples = dict(self._samples)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+    def text(self, limit=40, sort="cumulative"):
+        stream = io.StringIO()
+        stats = self.stats()
+        stats.stream = stream
+        if stats.stats:
+            stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def summary(self):
+        durations = sorted(self._durations)
+        return {
+            "running": self.running,
+            "targets": sorted(self.targets),
+            "count": self.count,
+            "seconds": self.seconds,
+            "cprofile": self.cprofile,
+            "started_at": isoformat(self.started_at),
+            "ended_at": isoformat(self.ended_at),
+            "invocations": len(durations),
+            "profiled": len(self._profiles),
+            "samples": sum(dict(self._samples).values()),
+            "avg_ms": round(sum(durations) / len(durations) * 1000, 2) if durations else None,
+            "max_ms": round(durations[-1] * 1000, 2) if durations else None,
+        }
+
+
+class Profiler:
+    """持有目前進行中的剖析；hook(名稱) 裝飾要剖析的函式。"""
+
+    TARGETS = ("build_reply", "callback")
+
+    def __init__(self):
+        self.session = None  # 進行中的 ProfileSession；沒有時為 None（hook 據此直接呼叫原函式）
+        self.last = None     # 最近一次（含進行中）的剖析，供取結果
+        self._lock = threading.Lock()
+
+    def hook(self, target):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                session = self.session
+                if session is None or target not in session.targets:
+                    return func(*args, **kwargs)
+                return session.run(target, func, args, kwargs)
+            return wrapper
+        return decorator
+
+    def start(self, targets=TARGETS, count=None, seconds=None, interval=DEFAULT_INTERVAL, cprofile=True):
+        """開始剖析；已有進行中的剖析時回傳 None，參數不合法時拋出 ValueError。"""
+        unknown = set(targets) - set(self.TARGETS)
+        if unknown or not targets:
+            raise ValueError(f"target 只能是 {'、'.join(self.TARGETS)}")
+        # 次數或秒數不是正數的剖析永遠不會剖析到東西，卻會佔住剖析器、擋下之後的 /admin/profile
+        if (count is not None and count < 1) or (seconds is not None and not seconds > 0):
+            raise ValueError("count、seconds 必須為正數")
+        with self._lock:
+            if self.session is not None:
+                return None
+            session = ProfileSession(targets, count=count, seconds=seconds, interval=interval,
+                                     cprofile=cprofile, on_close=self._closed)
+            self.session = self.last = session
+        return session
+
+    def stop(self):
+        session = self.session
+        if session is not None:
+            session.close()
+        return session
+
+    def _closed(self, session):
+        with self._lock:
+            if self.session is session:
+                self.session = None
+
+
+def parse_spec(spec):
+    """PROFILE_ON_START 的格式：「200」剖析接下來 200 次呼叫、「60s」剖析 60 秒。回傳 start() 的參數。
+
+    格式錯誤或不是正數時拋出 ValueError（與 start() 相同的檢查）。
+    """
+    spec = spec.strip().lower()
+    if spec.endswith("s"):
+        seconds = float(spec[:-1])
+        if not seconds > 0:
+            raise ValueError("seconds 必須為正數")
+        return {"seconds": seconds}
+    count = int(spec)
+    if count < 1:
+        raise ValueError("count 必須為正數")
+    return {"count": count}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
@@ -0,0 +1,95 @@
+# ranking_index.py
+"""依最終熱量／糖量排序的各品牌排行索引：「50嵐 300 大卡以下熱量最低的飲料」這類查詢。
+
+DataLoader.build 時對每個品牌展開 品名 × 尺寸 × 冰量 × 該品牌提供的甜度
+（品牌沒有任何甜度設定時只列不指定甜度），以與 CalorieCalculator 相同的公式與進位
+算出最終熱量、糖量，依 (品牌, 尺寸, 冰量) 分桶後，每桶各依熱量、糖量排序一次。
+
+查詢時以 bisect 找出每個符合篩選條件的桶內的範圍；沒有指定尺寸或冰量時，
+以 heapq.merge 合併同品牌的幾個桶，只取出需要的前 k 筆。耗時與目錄大小無關
+（約 O(桶數 × log n + k)），不必為每種篩選組合各存一份排序清單，快照檔也不會變大太多。
+
+熱量或糖量欄位無效的列不列入；熱飲沒有資料時不以冰飲估算列入（排行只列工作表上
+實際有的組合）；合併品名（「奶茶/奶綠/奶青」）只列展開後的各品名，不重複列出原始合併字串。
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import islice
+from operator import itemgetter
+
+METRICS = ("calories", "sugar")
+
+RankEntry = namedtuple("RankEntry", "calories sugar drink size ice sweetness")
+
+# 各指標的排序鍵：主要依該指標，同分時依另一指標、品名、尺寸、冰量、甜度，結果固定不隨建置順序變動
+# （同一品牌的甜度不是全為 None 就是全為字串；None 只出現在沒有甜度設定的品牌，每個組合只有一列）
+_SORT_KEYS = {"calories": itemgetter(0, 1, 2, 3, 4, 5), "sugar": itemgetter(1, 0, 2, 3, 4, 5)}
+_VALUE_KEYS = {"calories": itemgetter(0), "sugar": itemgetter(1)}
+
+
+def ranking_rows(drinks_index, sweet_map):
+    """展開排行的所有列：(品牌, 熱量, 糖量, 品名, 尺寸, 冰量, 甜度)，依 drinks_index 的順序逐列產生。"""
+    for (brand, drink, size, ice), (calories, sugar) in drinks_index.items():
+        if calories is None or sugar is None or "/" in drink:
+            continue
+        # 與 CalorieCalculator 相同的公式與進位（+1e-9 補償二進位浮點誤差）
+        for sweetness, ratio in (sweet_map.get(brand) or {None: 1.0}).items():
+            yield (brand, round(max(0.0, calories - sugar * (1 - ratio) * 4) + 1e-9),
+                   round(max(0.0, sugar * ratio) + 1e-9, 1), drink, size, ice, sweetness)
+
+
+class RankingIndex:
+    __slots__ = ("_buckets", "rows")
+
+    def __init__(self, buckets, rows):
+        # 品牌 -> {(尺寸, 冰量): {指標: 依該指標排序的列清單}}；列為一般 tuple（欄位同 RankEntry），
+        # 查詢時才轉成 RankEntry，建置快、快照檔也較小
+        self._buckets = buckets
+        self.rows = rows  # 總列數（所有品牌 × 甜度）
+
+    @classmethod
+    def build(cls, drinks_index, sweet_map):
+        groups = {}
+        for brand, *entry in ranking_rows(drinks_index, sweet_map):
+            groups.setdefault(brand, {}).setdefault((entry[3], entry[4]), []).append(tuple(entry))
+
+        buckets = {brand: {variant: {metric: sorted(entries, key=_SORT_KEYS[metric]) for metric in METRICS}
+                           for variant, entries in variants.items()}
+                   for brand, variants in groups.items()}
+        rows = sum(len(entries) for variants in groups.values() for entries in variants.values())
+        return cls(buckets, rows)
+
+    def query(self, brand, metric="calories", low=None, high=None, size=None, ice=None,
+              limit=10, descending=False):
+        """回傳 low <= 指標 <= high 的前 limit 筆 RankEntry（預設由低到高；descending 由高到低）。"""
+        spans = self._spans(brand, metric, low, high, size, ice)
+        if descending:
+            runs = [map(entries.__getitem__, range(hi - 1, lo - 1, -1)) for entries, lo, hi in spans]
+        else:
+            runs = [islice(entries, lo, hi) for entries, lo, hi in spans]
+        if len(runs) == 1:
+            rows = islice(runs[0], limit)
+        else:
+            rows = islice(heapq.merge(*runs, key=_SORT_KEYS[metric], reverse=descending), limit)
+        return [RankEntry._make(row) for row in rows]
+
+    def count(self, brand, metric="calories", low=None, high=None, size=None, ice=None):
+        """符合條件的總筆數。"""
+        return sum(hi - lo for _, lo, hi in self._spans(brand, metric, low, high, size, ice))
+
+    def _spans(self, brand, metric, low, high, size, ice):
+        """符合尺寸、冰量篩選的各桶中，指標落在 [low, high] 的 (列清單, 起, 迄)。"""
+        if metric not in METRICS:
+            raise ValueError(f"不支援的排序指標「{metric}」，可用：{'、'.join(METRICS)}")
+        value = _VALUE_KEYS[metric]
+        spans = []
+        for (entry_size, entry_ice), sorted_entries in self._buckets.get(brand, {}).items():
+            if (size is not None and entry_size != size) or (ice is not None and entry_ice != ice):
+                continue
+            entries = sorted_entries[metric]
+            lo = 0 if low is None else bisect_left(entries, low, key=value)
+            hi = len(entries) if high is None else bisect_right(entries, high, key=value)
+            if lo < hi:
+                spans.append((entries, lo, hi))
+        return spans
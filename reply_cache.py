@@ -0,0 +1,80 @@
+# reply_cache.py
+"""build_reply 結果的 LRU 快取（含 TTL）。
+
+熱門點單（「50嵐 珍奶 微糖」這類）佔了大部分流量，解析與計算結果只取決於
+輸入文字與資料快照，因此以 (資料世代, 正規化後的輸入) 為鍵快取回覆文字：
+資料更新後世代改變，舊項目自然不會再命中；refresh 成功時也會整個清空，
+釋放舊世代佔用的空間。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """快取鍵用的正規化：去頭尾空白、連續空白併成一個（解析結果與空白數量無關）。"""
+    return " ".join(text.split())
+
+
+class ReplyCache:
+    def __init__(self, maxsize=1024, ttl=300.0, clock=time.monotonic):
+        """maxsize <= 0 表示停用快取；ttl <= 0 表示項目不會過期（只靠 LRU 淘汰）。"""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._items = OrderedDict()  # 鍵 -> (寫入時間, 回覆)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def get(self, key):
+        """命中回傳回覆文字，否則回傳 None。"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            stored_at, value = item
+            if self.ttl > 0 and self._clock() - stored_at >= self.ttl:
+                del self._items[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items[key] = (self._clock(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._items)
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,201 @@
+# reply_worker.py
+"""回覆的執行方式：背景工作池（async）與單一 webhook 內多個事件的並行處理。
+
+ReplyDispatcher：webhook 驗簽後立即回 200，解析、計算與呼叫 LINE API 交給背景執行緒。
+- 佇列有上限（REPLY_QUEUE_SIZE）；滿了直接丟棄並計數，不讓 webhook 執行緒排隊等待
+- 每個工作記錄排隊時間，/healthz 可看到佇列深度、等待時間與丟棄數
+- 工作函式自行決定重試策略（見 LineReplyClient.reply_with_retry）
+- 排隊時間另外記錄在 calcal_reply_queue_wait_seconds 直方圖（/metrics）
+
+group_by_source() + EventFanout：LINE 可能在一個 webhook 本文裡送來多個事件，逐一處理時
+總延遲是各事件回覆延遲的總和。依 source 的 userId 分組後，不同使用者的組別在有上限的執行緒池
+並行處理，同一使用者的事件仍依原順序逐一回覆。
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+_QUEUE_WAIT_SECONDS = metrics.Histogram("calcal_reply_queue_wait_seconds", "背景回覆工作的排隊時間")
+
+
+class ReplyDispatcher:
+    def __init__(self, work, workers=4, maxsize=100):
+        """work(item) 在背景執行緒中被呼叫；例外會被記錄，不會讓工作執行緒結束。"""
+        self.work = work
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _ensure_started(self):
+        """第一次送出工作時才啟動執行緒；fork 後的子程序需要自己的一組執行緒。"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            self._threads = [
+                threading.Thread(target=self._run, name=f"reply-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, item):
+        """放入佇列並立即返回；佇列已滿時丟棄並回傳 False。"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.monotonic(), item))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self):
+        q = self._queue
+        while True:
+            job = q.get()
+            if job is _STOP:
+                return
+            enqueued_at, item = job
+            wait = time.monotonic() - enqueued_at
+            _QUEUE_WAIT_SECONDS.observe(wait)
+            ok = False
+            try:
+                self.work(item)
+                ok = True
+            except Exception:  # noqa: BLE001 - 單一工作失敗不能讓工作執行緒結束
+                logger.exception("背景回覆工作失敗")
+            with self._lock:
+                self.processed += 1
+                self.failed += not ok
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def stop(self, timeout=5.0):
+        """送出停止信號並等待工作執行緒把手上的工作做完（程序結束時呼叫）。"""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            try:
+                self._queue.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._pid = None
+
+    def stats(self):
+        with self._lock:
+            processed = self.processed
+            return {
+                "workers": self.workers,
+                "depth": self._queue.qsize(),
+                "maxsize": self.maxsize,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "processed": processed,
+                "failed": self.failed,
+                "avg_wait_ms": round(self.total_wait / processed * 1000, 1) if processed else None,
+                "max_wait_ms": round(self.max_wait * 1000, 1),
+            }
+
+
+def source_key(event):
+    """事件的排序鍵：同一使用者（userId）的事件必須依序處理。
+
+    沒有 userId 時（群組中未授權取得 userId 等）以群組／聊天室為鍵，都沒有時視為獨立事件。
+    """
+    source = getattr(event, "source", None)
+    for field in ("user_id", "group_id", "room_id"):
+        value = getattr(source, field, None)
+        if value:
+            return field, value
+    return None
+
+
+def group_by_source(events, key=source_key):
+    """把事件依 source_key 分組，回傳 [[事件, ...], ...]；組別依首次出現的順序，組內維持原順序。
+
+    元素不是事件本身時（例如 (事件, 附帶資料)），以 key 取出排序鍵。
+    """
+    groups = {}
+    for event in events:
+        k = key(event)
+        groups.setdefault(k if k is not None else object(), []).append(event)
+    return list(groups.values())
+
+
+class EventFanout:
+    """同一個 webhook 內的多個事件組別並行處理，由呼叫端執行緒等待全部完成。
+
+    第一組在呼叫端執行緒上直接處理，其餘交給最多 workers 條執行緒的共用執行緒池；
+    只有一組（最常見的情況）時完全不經過執行緒池。
+    """
+
+    def __init__(self, work, workers=4):
+        """work(組別) 依序處理一組事件；workers <= 1 時所有組別都在呼叫端執行緒上依序處理。"""
+        self.work = work
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        """第一次需要時才建立執行緒池；fork 出的子程序不能沿用父程序的執行緒。"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix="event-fanout")
+                    self._pid = os.getpid()
+        return self._executor
+
+    def run(self, groups):
+        """處理所有組別並等待完成；任一組失敗時，等其他組都處理完後拋出第一個例外。"""
+        if self.workers <= 1 or len(groups) <= 1:
+            errors = [_call(self.work, group) for group in groups]
+        else:
+            pool = self._pool()
+            futures = [pool.submit(self.work, group) for group in groups[1:]]
+            errors = [_call(self.work, groups[0])]
+            errors += [future.exception() for future in futures]
+        error = next((e for e in errors if e is not None), None)
+        if error is not None:
+            raise error
+
+    def stop(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._pid = None
+
+
+def _call(func, arg):
+    try:
+        func(arg)
+    except Exception as exc:  # noqa: BLE001 - 先讓其他組別處理完，再由 run() 拋出
+        return exc
+    return None
@@ -0,0 +1,38 @@
+# scripts/export_table.py
+"""由本地快取一次匯出全目錄的營養表（每個 品牌 × 品名 × 尺寸 × 冰量 × 甜度 一列，不含配料）。
+
+不連網：讀取 SHEET_CACHE_PATH（預設 cache/sheet_cache.json）的原始資料，
+以 NutritionMatrix 一次算好整個矩陣後寫成 CSV（Excel 可直接開啟）。需要安裝 numpy。
+用法：
+  python scripts/export_table.py                     # 輸出到 nutrition_table.csv
+  python scripts/export_table.py out.csv
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_loader import DataLoader  # noqa: E402
+
+
+def main():
+    output = sys.argv[1] if len(sys.argv) > 1 else "nutrition_table.csv"
+    cache_path = os.getenv("SHEET_CACHE_PATH", "cache/sheet_cache.json")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            raw = json.load(f)
+    except (OSError, ValueError) as exc:
+        print(f"無法讀取快取檔 {cache_path}（{exc}），請先啟動一次服務或執行「更新資料」")
+        sys.exit(1)
+
+    snapshot = DataLoader(cache_path=os.devnull, precompute=True).build(raw, source="cache")
+    if snapshot.matrix is None:
+        print("需要 numpy：pip install numpy")
+        sys.exit(1)
+    count = snapshot.matrix.to_csv(output)
+    print(f"已匯出 {count} 列到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+# scripts/replay.py
+"""重播大量真實使用者訊息：量測 build_reply 的吞吐量與各階段延遲，並比較兩份資料的回覆差異。
+
+不經過 LINE、預設不連網：資料來自本機檔案，路徑可以是
+- 原始 JSON 快取（SHEET_CACHE_PATH，預設 cache/sheet_cache.json）
+- 索引快照檔（SHARED_SNAPSHOT_PATH 寫出的檔案）
+- CSV／TSV 目錄或 SQLite 資料庫（格式同 DATA_SOURCE=csv／sqlite）
+- sheets：當下從 Google Sheets 抓一份（需 .env 的金鑰；只有這個選項會連網，也不會改寫本地快取）
+
+訊息檔逐行串流讀取，不會整份載入：每行一則純文字；以 { 或 " 開頭的行視為 JSON
+（字串、{"text": ...}、LINE 事件或整個 webhook 內容皆可，只取文字訊息）。- 表示標準輸入。
+「更新資料」是管理指令而不是查詢，重播時略過（只計數），不會觸發資料更新。
+
+每個階段的延遲取自 build_reply 實際經過的程式碼（app 的 reply、parse、calculate、format、ranking 計時點），
+逐筆記錄後算出精確的 p50／p95／p99。預設停用回覆快取，量測的是實際計算；--reply-cache 可模擬線上的快取。
+
+加上 --against 時每則訊息在兩份資料上各跑一次，列出回覆不同的訊息（依出現次數排序），
+編輯試算表後、按「更新資料」之前，就能確認這次修改會改變哪些回答。
+
+用法：
+  python scripts/replay.py messages.txt                               # 以本地快取重播，輸出吞吐量與延遲
+  python scripts/replay.py messages.jsonl --workers 4                 # 分給 4 個程序
+  python scripts/replay.py messages.txt --against edited/             # 本地快取 vs 編輯後匯出的 CSV 目錄
+  python scripts/replay.py messages.txt --against sheets              # 本地快取 vs 目前的試算表
+  python scripts/replay.py messages.txt --data old.json --against new.json \\
+      --diff-output diff.jsonl --output report.json                   # 完整差異與報告寫成檔案
+"""
+import argparse
+import difflib
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+from collections import Counter, deque
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calorie_calculator import CalorieCalculator  # noqa: E402
+from data_loader import DataLoader  # noqa: E402
+from data_sources import CsvDirectorySource, SqliteSource  # noqa: E402
+from index_snapshot import MAGIC  # noqa: E402
+from input_parser import UserInputParser  # noqa: E402
+from reply_cache import ReplyCache, normalize_text  # noqa: E402
+
+# 階段 -> app 中對應的計時點
+STAGES = {"reply": "_REPLY", "parse": "_PARSE", "calculate": "_CALCULATE", "format": "_FORMAT",
+          "ranking": "_RANKING"}
+ERROR_PREFIXES = ("❌", "抱歉")
+# 重播時略過的管理指令
+SKIPPED_COMMANDS = {"更新資料"}
+# Google 金鑰相關的環境變數：import app 前清空，只有明確指定 sheets 時才暫時放回
+_CREDENTIAL_VARS = ("GOOGLE_SERVICE_ACCOUNT_FILE", "GOOGLE_SHEETS_API_KEY")
+
+_STATE = {}  # 每個程序一份：app 模組、各資料集的服務與原本的金鑰設定
+
+
+class StageRecorder:
+    """代替 app 的階段 Histogram：保留每一筆秒數，才能算出精確的百分位數。"""
+    __slots__ = ("samples",)
+
+    def __init__(self):
+        self.samples = array("d")
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append(time.perf_counter() - started)
+
+
+def iter_messages(f):
+    """逐行產生訊息文字（見模組說明）；空行與非文字的 JSON 事件略過。"""
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] not in "{\"":
+            yield line
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            yield line
+            continue
+        yield from (text for text in _texts(obj) if text.strip())
+
+
+def _texts(obj):
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        if isinstance(obj.get("events"), list):  # 整個 webhook 內容
+            for event in obj["events"]:
+                yield from _texts(event)
+        elif isinstance(obj.get("message"), dict):  # LINE 事件
+            if obj["message"].get("type", "text") == "text":
+                yield from _texts(obj["message"].get("text"))
+        elif isinstance(obj.get("text"), str):
+            yield obj["text"]
+
+
+def open_loader(path, credentials=None):
+    """依路徑種類建立並載入 DataLoader，回傳 (loader, 種類說明)；無法載入時拋出 ValueError。
+
+    只有 path 為 sheets 時會連網：暫時放回 credentials（setup() 清空前的金鑰設定）讀取金鑰。
+    """
+    if path == "sheets":
+        import app
+
+        saved = {name: os.environ.get(name, "") for name in _CREDENTIAL_VARS}
+        os.environ.update(credentials or {})
+        try:
+            key = app._google_key()
+        finally:
+            os.environ.update(saved)
+        loader = DataLoader(key, app.GOOGLE_SHEET_NAME, cache_path=os.devnull)
+        loader.refresh()
+        return loader, "Google Sheets"
+    if os.path.isdir(path):
+        loader = DataLoader(cache_path=os.devnull, source=CsvDirectorySource(path))
+        loader.refresh()
+        return loader, "CSV 目錄"
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except OSError as exc:
+        raise ValueError(f"無法讀取 {path}（{exc}）") from None
+    if head.startswith(b"SQLite format 3"):
+        loader = DataLoader(cache_path=os.devnull, source=SqliteSource(path))
+        loader.refresh()
+        return loader, "SQLite"
+    if head.startswith(MAGIC):
+        # 重播途中不跟隨伺服器對快照檔的更新，結果才對應到同一份資料
+        loader = DataLoader(cache_path=os.devnull, snapshot_path=path, sync_interval=math.inf)
+        kind = "索引快照檔"
+    else:
+        loader = DataLoader(cache_path=path)
+        kind = "JSON 快取"
+    if not loader.load_local():
+        raise ValueError(f"{path} 不是可用的{kind}")
+    return loader, kind
+
+
+def setup(paths, reply_cache=0):
+    """載入 app 與各份資料（每個程序一次；fork 出的子程序直接沿用父程序已載入的結果）。"""
+    if _STATE:
+        return _STATE
+    # import app 時會依設定初始化服務：指向不存在的快取、不共用快照，避免讀寫工作目錄裡的真實檔案；
+    # 先讀入 .env 記下金鑰再清空（load_dotenv 不覆寫已存在的環境變數），初始化不會連到 Sheets
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    credentials = {name: os.environ.get(name, "") for name in _CREDENTIAL_VARS}
+    os.environ.update(SHEET_CACHE_PATH=os.devnull, SHARED_SNAPSHOT_PATH="", DATA_SOURCE="sheets",
+                      **{name: "" for name in _CREDENTIAL_VARS})
+    logging.disable(logging.CRITICAL)
+    import app
+
+    datasets = []
+    for path in paths:
+        loader, kind = open_loader(path, credentials)
+        # 每份資料各自的回覆快取：兩個 loader 的世代號可能相同，不能共用以世代為鍵的快取
+        datasets.append({"path": path, "kind": kind, "loader": loader,
+                         "services": {"loader": loader, "parser": UserInputParser(loader),
+                                      "calculator": CalorieCalculator(loader)},
+                         "cache": ReplyCache(maxsize=reply_cache, ttl=0)})
+    _STATE.update(app=app, datasets=datasets)
+    return _STATE
+
+
+def replay_chunk(texts):
+    """在本程序重播一批訊息。回傳 (各資料集的 {階段: 秒數 array} 與錯誤回覆數, 回覆不同的 (訊息, 前, 後))。"""
+    app = _STATE["app"]
+    runs, replies = [], []
+    for dataset in _STATE["datasets"]:
+        app._services.update(dataset["services"])
+        app._reply_cache = dataset["cache"]
+        recorders = {stage: StageRecorder() for stage in STAGES}
+        for stage, attr in STAGES.items():
+            setattr(app, attr, recorders[stage])
+        out = [app.build_reply(text) for text in texts]
+        errors = sum(reply.startswith(ERROR_PREFIXES) for reply in out)
+        runs.append(({stage: recorder.samples for stage, recorder in recorders.items()}, errors))
+        replies.append(out)
+    diffs = []
+    if len(replies) == 2:
+        diffs = [(text, before, after) for text, before, after in zip(texts, *replies) if before != after]
+    return runs, diffs
+
+
+def replayable(messages, skipped):
+    """略過管理指令（見 SKIPPED_COMMANDS），略過的則數累計在 skipped。"""
+    for text in messages:
+        if text.strip() in SKIPPED_COMMANDS:
+            skipped[text.strip()] += 1
+            continue
+        yield text
+
+
+def chunked(messages, size):
+    messages = iter(messages)
+    while chunk := list(itertools.islice(messages, size)):
+        yield chunk
+
+
+def run(chunks, workers, consume, paths, reply_cache):
+    """逐批重播並依原順序交給 consume；多程序時最多同時排入 workers × 2 批，大檔案不會整份讀進佇列。"""
+    if workers <= 1:
+        for chunk in chunks:
+            consume(replay_chunk(chunk))
+        return
+    with multiprocessing.Pool(workers, initializer=setup, initargs=(paths, reply_cache)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(replay_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                consume(pending.popleft().get())
+        while pending:
+            consume(pending.popleft().get())
+
+
+class Report:
+    """彙總各批結果：各資料集的階段樣本、錯誤回覆數，與依正規化文字合併的回覆差異。"""
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.messages = 0
+        self.samples = [{stage: array("d") for stage in STAGES} for _ in datasets]
+        self.errors = [0] * len(datasets)
+        self.diffs = {}  # 正規化文字 -> [第一次出現的原文, 前, 後, 次數]
+        self.diff_messages = 0
+
+    def consume(self, result):
+        runs, diffs = result
+        for i, (samples, errors) in enumerate(runs):
+            for stage, values in samples.items():
+                self.samples[i][stage].extend(values)
+            self.errors[i] += errors
+        self.messages += len(runs[0][0]["reply"])
+        self.diff_messages += len(diffs)
+        for text, before, after in diffs:
+            entry = self.diffs.setdefault(normalize_text(text), [text, before, after, 0])
+            entry[3] += 1
+
+    def summary(self, workers, wall, skipped):
+        result = {"messages": self.messages, "skipped": dict(skipped), "workers": workers, "wall_seconds": wall,
+                  "throughput": self.messages / wall if wall else None, "datasets": []}
+        for dataset, samples, errors in zip(self.datasets, self.samples, self.errors):
+            loader = dataset["loader"]
+            reply_total = sum(samples["reply"])
+            result["datasets"].append({
+                "path": dataset["path"], "kind": dataset["kind"], "generation": loader.generation,
+                "drinks": len(loader.snapshot.drinks_index), "errors": errors,
+                "single_process_throughput": len(samples["reply"]) / reply_total if reply_total else None,
+                "stages": {stage: _stats(values) for stage, values in samples.items() if values}})
+        if len(self.datasets) == 2:
+            result["diff"] = {"messages": self.diff_messages, "distinct": len(self.diffs)}
+        return result
+
+    def ranked_diffs(self):
+        return sorted(self.diffs.values(), key=lambda entry: -entry[3])
+
+
+def _stats(values):
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p))]  # noqa: E731
+    return {"count": len(ordered), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "mean": sum(ordered) / len(ordered)}
+
+
+def _format_seconds(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} µs"
+
+
+def print_summary(summary, ranked, show):
+    messages = summary["messages"]
+    print(f"重播 {messages} 則訊息，{summary['workers']} 個程序，耗時 {summary['wall_seconds']:.2f} s"
+          f"（{summary['throughput'] or 0:,.0f} 則/秒，含所有資料集）")
+    for command, count in summary["skipped"].items():
+        print(f"略過「{command}」指令 {count} 則")
+    for label, data in zip("AB", summary["datasets"]):
+        print(f"\n[{label}] {data['path']}（{data['kind']}，世代 {data['generation']}，"
+              f"飲品 {data['drinks']} 筆）")
+        print(f"  錯誤回覆 {data['errors']} 則（{data['errors'] / max(messages, 1):.1%}）；"
+              f"單程序 build_reply 約 {data['single_process_throughput'] or 0:,.0f} 則/秒")
+        print(f"  {'階段':<10}{'筆數':>10}{'p50':>12}{'p95':>12}{'p99':>12}{'平均':>12}")
+        for stage, stats in data["stages"].items():
+            print(f"  {stage:<10}{stats['count']:>10}" + "".join(
+                f"{_format_seconds(stats[key]):>12}" for key in ("p50", "p95", "p99", "mean")))
+    if "diff" not in summary:
+        return
+    diff = summary["diff"]
+    print(f"\n回覆不同：{diff['messages']} 則（{diff['messages'] / max(messages, 1):.1%}），"
+          f"{diff['distinct']} 種訊息")
+    for text, before, after, count in ranked[:show]:
+        print(f"\n×{count}  {text}")
+        for line in difflib.ndiff(before.splitlines(), after.splitlines()):
+            if line.startswith(("- ", "+ ")):
+                print(f"  {line}")
+    if len(ranked) > show:
+        print(f"\n…另有 {len(ranked) - show} 種訊息的回覆不同（--show 調整、--diff-output 輸出全部）")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("messages", help="訊息檔（- 為標準輸入）")
+    ap.add_argument("--data", default=os.getenv("SHEET_CACHE_PATH", "cache/sheet_cache.json"),
+                    help="重播用的資料（預設 SHEET_CACHE_PATH）")
+    ap.add_argument("--against", help="比較用的第二份資料；列出回覆不同的訊息")
+    ap.add_argument("--workers", type=int, default=1, help="程序數（預設 1）")
+    ap.add_argument("--chunk", type=int, default=500, help="每批交給程序的訊息數")
+    ap.add_argument("--reply-cache", type=int, default=0, help="回覆快取大小（預設 0：停用，量測實際計算）")
+    ap.add_argument("--limit", type=int, default=0, help="最多重播幾則（0 為全部）")
+    ap.add_argument("--show", type=int, default=20, help="列出幾種回覆不同的訊息")
+    ap.add_argument("--diff-output", help="把所有回覆不同的訊息寫成 JSON Lines")
+    ap.add_argument("--output", help="把統計結果寫成 JSON")
+    args = ap.parse_args()
+
+    paths = [args.data] + ([args.against] if args.against else [])
+    try:
+        state = setup(paths, args.reply_cache)
+    except Exception as exc:  # noqa: BLE001 - 載入失敗直接告知並結束
+        print(f"無法載入資料：{exc}")
+        sys.exit(1)
+    report = Report(state["datasets"])
+
+    skipped = Counter()
+    f = sys.stdin if args.messages == "-" else open(args.messages, encoding="utf-8")
+    with f:
+        messages = replayable(iter_messages(f), skipped)
+        if args.limit:
+            messages = itertools.islice(messages, args.limit)
+        started = time.perf_counter()
+        run(chunked(messages, args.chunk), args.workers, report.consume, paths, args.reply_cache)
+        wall = time.perf_counter() - started
+    if not report.messages:
+        print("訊息檔中沒有可重播的文字訊息")
+        sys.exit(1)
+
+    summary = report.summary(args.workers, wall, skipped)
+    ranked = report.ranked_diffs()
+    print_summary(summary, ranked, args.show)
+    if args.diff_output:
+        with open(args.diff_output, "w", encoding="utf-8") as out:
+            for text, before, after, count in ranked:
+                out.write(json.dumps({"text": text, "count": count, "before": before, "after": after},
+                                     ensure_ascii=False) + "\n")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump(summary, out, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+# sqlite_lookup.py
+"""SQLite 查表模式：體積最大的三個索引改查本機 SQLite 檔，不放在每個 worker 的記憶體裡。
+
+目錄大到每個 gunicorn worker 各放一份索引都嫌多時使用（DRINKS_LOOKUP=sqlite）。以 100 品牌、
+約 3 萬列 Drinks 的合成目錄為例，快照在記憶體中約 26 MB，其中排行索引約 15 MB、品名建議約 6 MB、
+飲品營養表約 3 MB；查表模式把這三者都寫進 <目錄>：
+- drinks-<版本鍵>.db：飲品營養表，以 (brand, name, size, ice) 唯一索引查表（SqliteDrinkTable）
+- ranking-<版本鍵>.db：排行的每一列，依 (品牌, 熱量…) 與 (品牌, 糖量…) 兩個覆蓋索引排序（SqliteRankingIndex）
+- suggestions-<版本鍵>.db：品名建議的 n-gram 反向索引，每個 (品牌, gram) 一列（SqliteSuggestionIndex）
+
+檔案先寫暫存檔再 os.replace；版本鍵由快照 schema 與所依賴工作表的內容雜湊組成，內容沒變時
+（重啟、其他 worker 已建好）直接沿用。快照只記錄檔案路徑與少量統計，pickle 進共用索引快照檔後，
+其他 worker 載入時各自以唯讀模式開啟同一個檔。
+
+各類別與 compact_index、ranking_index、fuzzy_index 的介面相同（既有呼叫端不需修改）。
+每次查詢為一次以索引完成的 SELECT（約數微秒到數十微秒，比記憶體查表慢）。
+
+新檔建好後只保留每種檔案最近 KEEP_FILES 個；目前快照還在用的檔案、PRUNE_GRACE 秒內建立或沿用過的檔案
+不會刪除（其他 worker 可能還沒跟上共用快照）。萬一檔案仍被刪除，已載入的表格改用載入時開啟的連線繼續查詢。
+"""
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections.abc import Mapping, Set
+
+from fuzzy_index import DEFAULT_BUDGET, brand_indexes, rank_suggestions
+from ranking_index import METRICS, RankEntry
+
+logger = logging.getLogger(__name__)
+
+# 目錄中每種查表檔保留最近幾個版本（其他 worker 可能還在用較舊的快照）
+KEEP_FILES = 3
+# 最近這麼多秒內建立或沿用過的查表檔不刪除
+PRUNE_GRACE = 600.0
+
+_DRINKS_SCHEMA = (
+    "CREATE TABLE drinks (row INTEGER PRIMARY KEY, brand TEXT NOT NULL, name TEXT NOT NULL, "
+    "size TEXT NOT NULL, ice TEXT NOT NULL, calories REAL, sugar REAL)",
+    "CREATE UNIQUE INDEX drinks_key ON drinks (brand, name, size, ice)",
+)
+# 與 dict 相同：重複的鍵保留第一次的位置（row）、最後一次的值
+_DRINKS_INSERT = ("INSERT INTO drinks (brand, name, size, ice, calories, sugar) VALUES (?, ?, ?, ?, ?, ?) "
+                  "ON CONFLICT (brand, name, size, ice) DO UPDATE SET calories = excluded.calories, "
+                  "sugar = excluded.sugar")
+
+# 欄位不宣告型別，值原樣保存（熱量為整數、糖量為浮點數，與記憶體中的排行相同）
+_RANKING_SCHEMA = (
+    "CREATE TABLE ranking (brand NOT NULL, calories NOT NULL, sugar NOT NULL, drink NOT NULL, "
+    "size NOT NULL, ice NOT NULL, sweetness)",
+    "CREATE INDEX ranking_calories ON ranking (brand, calories, sugar, drink, size, ice, sweetness)",
+    "CREATE INDEX ranking_sugar ON ranking (brand, sugar, calories, drink, size, ice, sweetness)",
+)
+# 各指標的排序欄位，與 ranking_index 的排序鍵相同
+_RANKING_ORDER = {"calories": ("calories", "sugar", "drink", "size", "ice", "sweetness"),
+                  "sugar": ("sugar", "calories", "drink", "size", "ice", "sweetness")}
+
+_SUGGESTION_SCHEMA = (
+    "CREATE TABLE names (brand NOT NULL, number INTEGER NOT NULL, name NOT NULL, target NOT NULL, "
+    "gram_count INTEGER NOT NULL, PRIMARY KEY (brand, number)) WITHOUT ROWID",
+    "CREATE TABLE postings (brand NOT NULL, gram NOT NULL, numbers BLOB NOT NULL, "
+    "PRIMARY KEY (brand, gram)) WITHOUT ROWID",
+)
+# 一次 IN (...) 查詢最多帶幾個參數（舊版 SQLite 上限為 999）
+_MAX_PARAMS = 500
+
+
+class _SqliteReader:
+    """唯讀查表檔的連線：每個執行緒一條，另保留載入時開啟的一條。
+
+    檔案被其他 worker 刪除後新執行緒已無法開檔，改用保留的連線（檔案刪除後仍可讀取，存取以鎖序列化）。
+    pickle（索引快照檔）只存路徑，載入時重新開檔。
+    """
+    __slots__ = ("path", "_local", "_anchor", "_anchor_pid", "_anchor_lock")
+
+    def _open(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._anchor_lock = threading.Lock()
+        self._anchor = self._connect()
+        self._anchor_pid = os.getpid()
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _conn(self):
+        """本執行緒的連線；fork 出的子程序需重開。檔案已被刪除時回傳 None（改用保留的連線）。"""
+        local = self._local
+        conn = getattr(local, "conn", None)
+        pid = os.getpid()
+        if conn is not None and local.pid == pid:
+            return conn
+        try:
+            conn = self._connect()
+        except sqlite3.OperationalError:
+            if self._anchor_pid != pid:
+                raise
+            logger.warning("查表檔 %s 已不存在，改用載入時開啟的連線", self.path)
+            return None
+        local.conn, local.pid = conn, pid
+        return conn
+
+    def _fetch(self, sql, params=()):
+        conn = self._conn()
+        if conn is not None:
+            return conn.execute(sql, params).fetchall()
+        with self._anchor_lock:
+            return self._anchor.execute(sql, params).fetchall()
+
+    def _fetch_one(self, sql, params=()):
+        rows = self._fetch(sql, params)
+        return rows[0] if rows else None
+
+    def _iterate(self, sql, params=()):
+        """逐列讀取，不整批載入；改用保留的連線時整批取回。"""
+        conn = self._conn()
+        return conn.execute(sql, params) if conn is not None else iter(self._fetch(sql, params))
+
+
+class SqliteDrinkTable(_SqliteReader, Mapping):
+    """(品牌, 品名, Size, 冰量) -> (熱量, 糖量)，查詢 SQLite 檔。以 build() 建立或沿用既有檔案。"""
+    __slots__ = ("_length", "_pairs", "_brands", "brand_drinks", "drink_variants")
+
+    def __init__(self, path):
+        self._open(path)
+        self._length = self._fetch_one("SELECT COUNT(*) FROM drinks")[0]
+        self._pairs = self._fetch_one("SELECT COUNT(*) FROM (SELECT DISTINCT brand, name FROM drinks)")[0]
+        # 品牌數不多，放在記憶體：brand_drinks 的 in／迭代不必查檔
+        self._brands = tuple(brand for brand, in self._fetch(
+            "SELECT brand FROM drinks GROUP BY brand ORDER BY MIN(row)"))
+        self.brand_drinks = SqliteBrandDrinks(self)
+        self.drink_variants = SqliteDrinkVariants(self)
+
+    @classmethod
+    def build(cls, directory, version, items, keep=()):
+        """items 為 ((品牌, 品名, Size, 冰量), (熱量, 糖量)) 序列，串流寫入以 version 命名的檔案。"""
+        def fill(conn):
+            conn.executemany(_DRINKS_INSERT, (key + values for key, values in items))
+        return cls(_write(directory, "drinks", version, _DRINKS_SCHEMA, fill, keep))
+
+    # --- Mapping ---
+    def get(self, key, default=None):
+        try:
+            brand, name, size, ice = key
+            row = self._fetch_one(
+                "SELECT calories, sugar FROM drinks WHERE brand = ? AND name = ? AND size = ? AND ice = ?",
+                (brand, name, size, ice))
+        except (TypeError, ValueError, sqlite3.InterfaceError):
+            return default
+        return default if row is None else row
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def items(self):
+        """依原本的列順序產生 (鍵, 值)；逐列讀取，不整張載入。"""
+        cursor = self._iterate("SELECT brand, name, size, ice, calories, sugar FROM drinks ORDER BY row")
+        return ((row[:4], row[4:]) for row in cursor)
+
+    def values(self):
+        return (value for _, value in self.items())
+
+
+class SqliteDrinkNames(Set):
+    """某品牌的正式品名集合（brand_drinks[品牌]）。"""
+    __slots__ = ("_table", "_brand")
+
+    def __init__(self, table, brand):
+        self._table = table
+        self._brand = brand
+
+    def __contains__(self, name):
+        return self._table._fetch_one(
+            "SELECT 1 FROM drinks WHERE brand = ? AND name = ? LIMIT 1", (self._brand, name)) is not None
+
+    def __iter__(self):
+        cursor = self._table._iterate(
+            "SELECT name FROM drinks WHERE brand = ? GROUP BY name ORDER BY MIN(row)", (self._brand,))
+        return (name for name, in cursor)
+
+    def __len__(self):
+        return self._table._fetch_one(
+            "SELECT COUNT(DISTINCT name) FROM drinks WHERE brand = ?", (self._brand,))[0]
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return frozenset(iterable)
+
+
+class SqliteBrandDrinks(Mapping):
+    """品牌 -> 正式品名集合。"""
+    __slots__ = ("_table", "_sets")
+
+    def __init__(self, table):
+        self._table = table
+        self._sets = {brand: SqliteDrinkNames(table, brand) for brand in table._brands}
+
+    def __getitem__(self, brand):
+        return self._sets[brand]
+
+    def get(self, brand, default=None):
+        return self._sets.get(brand, default)
+
+    def __contains__(self, brand):
+        return brand in self._sets
+
+    def __iter__(self):
+        return iter(self._sets)
+
+    def __len__(self):
+        return len(self._sets)
+
+
+class SqliteDrinkVariants(Mapping):
+    """(品牌, 品名) -> {(Size, 冰量)}（值為 frozenset）。"""
+    __slots__ = ("_table",)
+
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, key):
+        try:
+            brand, name = key
+            rows = self._table._fetch("SELECT size, ice FROM drinks WHERE brand = ? AND name = ?", (brand, name))
+        except (TypeError, ValueError, sqlite3.InterfaceError):
+            raise KeyError(key) from None
+        if not rows:
+            raise KeyError(key)
+        return frozenset(rows)
+
+    def __iter__(self):
+        return iter(self._table._iterate("SELECT brand, name FROM drinks GROUP BY brand, name ORDER BY MIN(row)"))
+
+    def __len__(self):
+        return self._table._pairs
+
+
+class SqliteRankingIndex(_SqliteReader):
+    """與 ranking_index.RankingIndex 相同的 query／count／rows；排序與範圍篩選交給覆蓋索引。"""
+    __slots__ = ("rows",)
+
+    def __init__(self, path):
+        self._open(path)
+        self.rows = self._fetch_one("SELECT COUNT(*) FROM ranking")[0]
+
+    @classmethod
+    def build(cls, directory, version, rows, keep=()):
+        """rows 為 (品牌, 熱量, 糖量, 品名, 尺寸, 冰量, 甜度) 序列（見 ranking_index.ranking_rows）。"""
+        def fill(conn):
+            conn.executemany("INSERT INTO ranking VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return cls(_write(directory, "ranking", version, _RANKING_SCHEMA, fill, keep))
+
+    def query(self, brand, metric="calories", low=None, high=None, size=None, ice=None,
+              limit=10, descending=False):
+        """回傳 low <= 指標 <= high 的前 limit 筆 RankEntry（預設由低到高；descending 由高到低）。"""
+        where, params = _ranking_filter(brand, metric, low, high, size, ice)
+        order = ", ".join(column + (" DESC" if descending else "") for column in _RANKING_ORDER[metric])
+        rows = self._fetch(f"SELECT calories, sugar, drink, size, ice, sweetness FROM ranking WHERE {where} "
+                           f"ORDER BY {order} LIMIT ?", (*params, -1 if limit is None else limit))
+        return [RankEntry._make(row) for row in rows]
+
+    def count(self, brand, metric="calories", low=None, high=None, size=None, ice=None):
+        """符合條件的總筆數。"""
+        where, params = _ranking_filter(brand, metric, low, high, size, ice)
+        return self._fetch_one(f"SELECT COUNT(*) FROM ranking WHERE {where}", params)[0]
+
+
+def _ranking_filter(brand, metric, low, high, size, ice):
+    if metric not in METRICS:
+        raise ValueError(f"不支援的排序指標「{metric}」，可用：{'、'.join(METRICS)}")
+    clauses, params = ["brand = ?"], [brand]
+    for clause, value in ((f"{metric} >= ?", low), (f"{metric} <= ?", high), ("size = ?", size), ("ice = ?", ice)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return " AND ".join(clauses), params
+
+
+class SqliteSuggestionIndex(_SqliteReader):
+    """與 fuzzy_index.SuggestionIndex 相同的 suggest()；n-gram 反向索引存在檔案中，每次查詢只讀輸入用到的 gram。"""
+    __slots__ = ("_brands",)
+
+    def __init__(self, path):
+        self._open(path)
+        self._brands = frozenset(brand for brand, in self._fetch("SELECT DISTINCT brand FROM names"))
+
+    @classmethod
+    def build(cls, directory, version, brand_drinks, drinks_alias_map, keep=()):
+        def fill(conn):
+            for brand, index in brand_indexes(brand_drinks, drinks_alias_map):
+                conn.executemany("INSERT INTO names VALUES (?, ?, ?, ?, ?)",
+                                 ((brand, number, name, target, count) for number, (name, target, count)
+                                  in enumerate(zip(index.names, index.targets, index.gram_counts))))
+                conn.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                 ((brand, gram, array("I", numbers).tobytes())
+                                  for gram, numbers in index.postings.items()))
+        return cls(_write(directory, "suggestions", version, _SUGGESTION_SCHEMA, fill, keep))
+
+    def suggest(self, brand, text, limit=3, min_score=0.3, budget=DEFAULT_BUDGET):
+        """回傳最接近 text 的至多 limit 個正式品名（相似度由高到低）；沒有夠接近的回傳空清單。"""
+        if brand not in self._brands:
+            return []
+        return rank_suggestions(_SqliteBrandIndex(self, brand), text, limit, min_score, budget)
+
+
+class _SqliteBrandIndex:
+    """一個品牌的建議索引（查詢期間的暫時物件），介面同 fuzzy_index._BrandIndex。"""
+    __slots__ = ("_index", "_brand")
+
+    def __init__(self, index, brand):
+        self._index = index
+        self._brand = brand
+
+    def postings_for(self, grams):
+        grams = list(grams)
+        found = {}
+        for chunk in _chunks(grams):
+            found.update(self._index._fetch(
+                f"SELECT gram, numbers FROM postings WHERE brand = ? AND gram IN ({', '.join('?' * len(chunk))})",
+                (self._brand, *chunk)))
+        return [array("I", found[gram]) if gram in found else () for gram in grams]
+
+    def entries(self, numbers):
+        entries = {}
+        for chunk in _chunks(list(numbers)):
+            rows = self._index._fetch(
+                f"SELECT number, name, target, gram_count FROM names WHERE brand = ? "
+                f"AND number IN ({', '.join('?' * len(chunk))})", (self._brand, *chunk))
+            entries.update((number, values) for number, *values in rows)
+        return entries
+
+
+def _chunks(values):
+    return (values[i:i + _MAX_PARAMS] for i in range(0, len(values), _MAX_PARAMS))
+
+
+def _write(directory, prefix, version, schema, fill, keep=()):
+    """建立 <目錄>/<prefix>-<version>.db 並回傳路徑；fill(連線) 寫入資料。檔案已存在時直接沿用。"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{prefix}-{version}.db")
+    if os.path.isfile(path):
+        logger.info("沿用既有的查表檔 %s", path)
+        try:
+            os.utime(path)  # 視為剛用過，清理時重新計算寬限期
+        except OSError:
+            logger.debug("無法更新 %s 的修改時間", path, exc_info=True)
+        return path
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{prefix}-", suffix=".db")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            for statement in schema:
+                conn.execute(statement)
+            fill(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    _prune(directory, prefix, keep={path, *keep})
+    return path
+
+
+def _prune(directory, prefix, keep=()):
+    """同一種查表檔只保留最近 KEEP_FILES 個；keep 中的檔案與寬限期內用過的檔案不刪除。"""
+    now = time.time()
+    files = sorted((os.path.join(directory, name) for name in os.listdir(directory)
+                    if name.startswith(f"{prefix}-") and name.endswith(".db")),
+                   key=os.path.getmtime, reverse=True)
+    for path in files[KEEP_FILES:]:
+        if path in keep:
+            continue
+        try:
+            if now - os.path.getmtime(path) < PRUNE_GRACE:
+                continue
+            os.unlink(path)
+        except OSError:
+            logger.debug("無法刪除舊的查表檔 %s", path, exc_info=True)
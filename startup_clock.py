@@ -0,0 +1,8 @@
+# startup_clock.py
+"""程序啟動計時的起點：app.py 第一個 import 本模組，之後的 import 與初始化耗時都從這裡算起。
+
+獨立成模組，app.py 的 import 區塊中間就不必夾著程式碼。
+"""
+import time
+
+STARTED = time.perf_counter()
@@ -0,0 +1,54 @@
+"""本地假 gspread 用戶端：以記憶體中的原始資料模擬 Google Sheets，並記錄 API 呼叫次數。
+
+用法：
+    client = FakeClient(RAW)
+    loader = DataLoader("{}", "Nutrition_Facts", client_factory=client.factory)
+"""
+from data_loader import SHEETS
+
+
+def raw_to_values(raw):
+    """把 DataLoader 的原始資料（records / 二維值）轉回工作表的二維字串值。"""
+    sheets = {}
+    for key, title, as_records in SHEETS:
+        rows = raw[key]
+        if as_records:
+            header = list(rows[0]) if rows else []
+            values = [header] + [[str(row.get(col, "")) for col in header] for row in rows]
+        else:
+            values = [[str(cell) for cell in row] for row in rows]
+        sheets[title] = values
+    return sheets
+
+
+class FakeSpreadsheet:
+    def __init__(self, client):
+        self.client = client
+
+    def values_batch_get(self, ranges):
+        self.client.calls["values_batch_get"] += 1
+        if self.client.gate is not None:
+            self.client.gate.wait(5)  # 模擬緩慢的 Sheets 回應
+        if self.client.fail:
+            raise ConnectionError("fake Sheets 無法連線")
+        return {"valueRanges": [{"range": r, "values": self.client.sheets[r.strip("'")]}
+                                for r in ranges]}
+
+
+class FakeClient:
+    def __init__(self, raw):
+        self.sheets = raw_to_values(raw)
+        self.fail = False
+        self.gate = None  # 設為 threading.Event 時，batch 請求會等到它被 set
+        self.calls = {"auth": 0, "open": 0, "values_batch_get": 0}
+
+    def factory(self, secret_key_json_str):
+        self.calls["auth"] += 1
+        return self
+
+    def open(self, name):
+        self.calls["open"] += 1
+        return FakeSpreadsheet(self)
+
+    def set_raw(self, raw):
+        self.sheets = raw_to_values(raw)
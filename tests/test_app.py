@@ -0,0 +1,512 @@
+"""app 層的離線測試：以模擬資料取代 Google Sheets，驗證回覆組字、快取與 /healthz。
+
+執行方式：python tests/test_app.py（需安裝 requirements.txt 的套件，不需金鑰）
+"""
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import marshal
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# 沒有金鑰時 import app 會記錄一次初始化失敗，測試中不需要看到
+logging.disable(logging.CRITICAL)
+
+import app  # noqa: E402
+
+# 沒有 Google 金鑰、也沒走到連網更新時，不應載入 gspread（延遲 import）；未啟用預先計算時也不載入 numpy
+GSPREAD_IMPORTED_AT_STARTUP = "gspread" in sys.modules
+NUMPY_IMPORTED_AT_STARTUP = "numpy" in sys.modules
+from admission import ConcurrencyLimiter, TokenBucketLimiter  # noqa: E402
+from calorie_calculator import CalorieCalculator  # noqa: E402
+from circuit_breaker import CircuitBreaker  # noqa: E402
+from data_loader import DataLoader  # noqa: E402
+from fake_gspread import FakeClient  # noqa: E402
+from input_parser import UserInputParser  # noqa: E402
+from line_client import LineReplyClient  # noqa: E402
+from reply_worker import ReplyDispatcher  # noqa: E402
+from linebot.v3.messaging import Configuration  # noqa: E402
+from test_offline import RAW  # noqa: E402
+
+PASSED = []
+FAILED = []
+
+
+def check(name, actual, expected):
+    if actual == expected:
+        PASSED.append(name)
+    else:
+        FAILED.append(f"{name}\n    期望: {expected}\n    實際: {actual}")
+
+
+class FakeLineAPI(BaseHTTPRequestHandler):
+    """本機假 LINE reply API：記錄收到的回覆與建立過的連線數。"""
+    protocol_version = "HTTP/1.1"  # 支援 keep-alive
+    replies = []
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).replies.append(json.loads(body))
+        payload = b'{"sentMessages": [{"id": "1", "quoteToken": "q"}]}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_line_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLineAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "").strip() or "not-set"
+
+
+_EVENT_IDS = itertools.count(1)
+
+
+def text_event(text, user_id="U1", token="t", event_id=None, redelivery=False):
+    """event_id 未指定時每次產生新的 id（相同 id 會被 webhook 去重略過）。"""
+    event_id = event_id or f"E{next(_EVENT_IDS)}"
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id}, "webhookEventId": event_id,
+        "deliveryContext": {"isRedelivery": redelivery}, "replyToken": token,
+        "message": {"type": "text", "id": "1", "quoteToken": "q", "text": text},
+    }
+
+
+def signed_body(events):
+    """組出 LINE webhook 請求本文與對應的 X-Line-Signature。"""
+    body = json.dumps({"destination": "D", "events": events}, ensure_ascii=False)
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return body, base64.b64encode(digest).decode()
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def install(loader):
+    app._services.update(loader=loader, parser=UserInputParser(loader),
+                         calculator=CalorieCalculator(loader))
+    app._reply_cache.clear()
+
+
+def main():
+    # 0. 啟動：延遲載入 gspread；cache_first 在沒有金鑰時也能靠本機快取上線
+    check("啟動時未載入 gspread", GSPREAD_IMPORTED_AT_STARTUP, False)
+    check("啟動時未載入 numpy", NUMPY_IMPORTED_AT_STARTUP, False)
+    check("記錄模組載入耗時", isinstance(app._startup["import_ms"], int), True)
+    with tempfile.TemporaryDirectory() as tmp:
+        app.CACHE_PATH = os.path.join(tmp, "sheet_cache.json")
+        app.SHARED_SNAPSHOT_PATH = None
+        with open(app.CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(RAW, f, ensure_ascii=False)
+        check("由本機快取上線", app.init_services(force=True), True)
+        check("快取來源", app._services["loader"].source, "cache")
+        check("記錄就緒時間", app._startup["ready_ms"] is not None, True)
+        check("快取上線仍未載入 gspread", "gspread" in sys.modules, False)
+
+    sheets = FakeClient(RAW)
+    loader = DataLoader("{}", "Nutrition_Facts", cache_path=os.devnull, client_factory=sheets.factory)
+    loader.refresh()
+    install(loader)
+    client = app.app.test_client()
+    # 以下各段同一位使用者會連續送出很多則訊息：先停用使用者限流，於 7b-4 另外測試
+    users_limiter, app._user_limiter = app._user_limiter, TokenBucketLimiter(rate=0)
+
+    # 1. 回覆組字
+    reply = app.build_reply("50嵐 珍奶 微糖 +珍珠*2")
+    check("回覆標題", reply.splitlines()[0], "🧋 50嵐 珍珠奶茶｜L｜冰｜微糖")
+    check("回覆數值", reply.splitlines()[-1], "熱量約 884 大卡，糖量約 33.5 克")
+
+    # 2. 同一世代、空白不同的輸入命中快取
+    hits = app._reply_cache.hits
+    check("快取命中回覆相同", app.build_reply(" 50嵐  珍奶 微糖 +珍珠*2 "), reply)
+    check("快取命中計數", app._reply_cache.hits, hits + 1)
+
+    # 3. 「更新資料」不進快取；內容有變動時清空快取並換世代
+    generation = loader.generation
+    check("內容未變動", app.build_reply("更新資料"), "✅ 試算表內容沒有變動，沿用目前資料")
+    check("未變動不換世代", loader.generation, generation)
+    sheets.set_raw({**RAW, "drinks": RAW["drinks"][:3]})
+    check("更新資料回覆", app.build_reply("更新資料"), "✅ 資料已成功更新，新的飲品資料可以查詢了")
+    check("更新資料後換世代", loader.generation > generation, True)
+    check("更新資料後清空快取", app._reply_cache.stats()["size"], 0)
+    check("更新資料不快取", sheets.calls["values_batch_get"], 3)
+    sheets.set_raw(RAW)
+    app.build_reply("更新資料")
+    sheets.fail = True
+    check("更新失敗沿用舊資料", app.build_reply("更新資料"), "❌ 資料更新失敗，暫時沿用原有資料")
+    check("healthz 失敗次數", client.get("/healthz").get_json()["refresh"]["failure_streak"], 1)
+    breaker = client.get("/healthz").get_json()["breaker"]
+    check("更新失敗斷路器斷開", (breaker["state"], breaker["consecutive_failures"], breaker["next_retry"] is not None),
+          ("open", 1, True))
+    calls = sheets.calls["values_batch_get"]
+    check("斷開期間立即回覆", app.build_reply("更新資料").startswith("⏳ 資料來源暫時無法連線"), True)
+    check("斷開期間不連 Sheets", sheets.calls["values_batch_get"], calls)
+    app._breaker.record_success()
+    sheets.fail = False
+    sheets.gate = threading.Event()
+    app.REFRESH_AWAIT_TIMEOUT = 0.05
+    check("逾時回覆更新中", app.build_reply("更新資料"), "⏳ 資料更新中，完成後會自動套用新資料")
+    check("更新中仍可查詢", app.build_reply("50嵐 奶青").startswith("🧋"), True)
+    app.REFRESH_AWAIT_TIMEOUT = 20
+    sheets.gate.set()
+    app.build_reply("更新資料")  # 與上一次進行中的更新合併
+    check("合併進行中的更新", sheets.calls["values_batch_get"], 6)
+    sheets.gate = None
+
+    # 4. 內部錯誤的回覆不快取
+    calculator = app._services["calculator"]
+    app._services["calculator"] = None
+    check("內部錯誤回覆", app.build_reply("清心 高山"), "抱歉，處理您的請求時發生了內部錯誤")
+    app._services["calculator"] = calculator
+    check("內部錯誤不快取", app.build_reply("清心 高山").startswith("🧋"), True)
+
+    # 5. /healthz 回報快取計數
+    body = client.get("/healthz").get_json()
+    check("healthz 狀態", body["status"], "ok")
+    check("healthz 快取計數", set(body["reply_cache"]) >= {"hits", "misses", "evictions"}, True)
+    check("healthz 預設不算記憶體", body["memory"], None)
+    memory = client.get("/healthz?memory=1").get_json()["memory"]
+    check("healthz 記憶體報告", (memory["total"] > 0, memory["drinks_index"] > 0), (True, True))
+
+    # 5b. 批次 API：一般 JSON 與 NDJSON 串流、上限與格式錯誤
+    resp = client.post("/api/calculate", json={"items": ["50嵐 珍奶 微糖", {"brand": "清心", "drink": "高山"}]})
+    body = resp.get_json()
+    check("批次 API 狀態", resp.status_code, 200)
+    check("批次 API 結果", [r["calories"] for r in body["results"]], [524, 120])
+    check("批次 API 世代", body["generation"], loader.generation)
+    resp = client.post("/api/calculate?stream=1", json={"items": ["50嵐 珍奶", "麻古 芝芝"]})
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    check("批次 API 串流", (resp.mimetype, [r["ok"] for r in lines]), ("application/x-ndjson", [True, False]))
+    calculator = app._services["calculator"]
+
+    class FailingCalculator:
+        def calculate(self, parsed, *args, **kwargs):
+            if parsed["brand"] != "50嵐":
+                raise RuntimeError("boom")
+            return calculator.calculate(parsed, *args, **kwargs)
+
+    app._services["calculator"] = FailingCalculator()
+    resp = client.post("/api/calculate?stream=1", json={"items": ["清心 高山", "50嵐 珍奶"]})
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    check("批次 API 單項例外不中斷串流", [(r["ok"], r.get("code")) for r in lines], [(False, "internal"), (True, None)])
+    app._services["calculator"] = calculator
+    original_batch = app.calculate_batch
+
+    def broken_batch(*args):
+        yield from itertools.islice(original_batch(*args), 1)
+        raise RuntimeError("boom")
+
+    app.calculate_batch = broken_batch
+    resp = client.post("/api/calculate?stream=1", json={"items": ["50嵐 珍奶", "50嵐 珍奶"]})
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    check("批次 API 串流中斷時回報錯誤行", [(r["ok"], r.get("code")) for r in lines], [(True, None), (False, "internal")])
+    app.calculate_batch = original_batch
+    check("批次 API 格式錯誤", client.post("/api/calculate", json=["x"]).status_code, 400)
+    max_items = app.BULK_MAX_ITEMS
+    app.BULK_MAX_ITEMS = 1
+    check("批次 API 上限", client.post("/api/calculate", json={"items": ["a", "b"]}).status_code, 413)
+    app.BULK_MAX_ITEMS = max_items
+    app.API_ALLOW_ORIGIN = "https://boba-cal.com"
+    resp = client.post("/api/calculate", json={"items": []})
+    check("批次 API CORS", resp.headers.get("Access-Control-Allow-Origin"), "https://boba-cal.com")
+    app.API_ALLOW_ORIGIN = ""
+
+    # 5c. 排行：聊天指令與 /api/rank
+    reply = app.build_reply("低卡 50嵐 大杯 300大卡以下")
+    check("排行指令標題", reply.splitlines()[0], "🏆 50嵐 熱量最低（300 大卡以下｜L）")
+    check("排行指令第一名", reply.splitlines()[1], "1. 四季春青茶｜L｜冰｜無糖：0 大卡／0.0 克")
+    check("排行指令無結果", app.build_reply("低卡 50嵐 10以下 熱").splitlines()[-1], "沒有符合條件的飲品")
+    check("排行指令錯誤", app.build_reply("低卡 麻古"), "❌ 找不到品牌「麻古」")
+    resp = client.get("/api/rank", query_string={"brand": "50嵐", "order": "desc", "max": "500", "limit": "2"})
+    body = resp.get_json()
+    check("排行 API", [(r["drink"], r["calories"]) for r in body["results"]],
+          [("珍珠奶茶", 500), ("波霸奶青", 482)])
+    check("排行 API 總數", (body["total"], body["order"], body["generation"]), (27, "desc", loader.generation))
+    check("排行 API 參數錯誤", client.get("/api/rank?brand=50嵐&metric=fat").status_code, 400)
+    check("排行 API limit 上限", client.get("/api/rank?brand=50嵐&limit=1000").status_code, 400)
+
+    # 6. 共用連線池：多次回覆只建立一條連線，並記錄 API 耗時
+    server, host = start_fake_line_api()
+    client_ = LineReplyClient(Configuration(host=host, access_token="test"), pool_size=2)
+    for token in ("t1", "t2", "t3"):
+        client_.reply(token, "hi")
+    check("回覆內容", [r["replyToken"] for r in FakeLineAPI.replies], ["t1", "t2", "t3"])
+    check("連線重複使用", FakeLineAPI.connections, 1)
+    check("API 計時", (client_.stats()["calls"], client_.stats()["avg_ms"] is not None), (3, True))
+    client_.close()
+
+    # 7. 背景回覆模式：callback 立即回 200，工作池計算後送出回覆
+    FakeLineAPI.replies.clear()
+    app.line_client = LineReplyClient(Configuration(host=host, access_token="test"), pool_size=2)
+    app.REPLY_MODE = "async"
+    body, signature = signed_body([text_event("50嵐 珍奶 微糖", token="async-1")])
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("背景模式回 200", resp.status_code, 200)
+    check("背景模式送出回覆", wait_until(lambda: len(FakeLineAPI.replies) == 1), True)
+    check("背景模式回覆內容", FakeLineAPI.replies[0]["messages"][0]["text"].splitlines()[-1],
+          "熱量約 524 大卡，糖量約 13.5 克")
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": "bad"})
+    check("背景模式驗簽失敗回 400", resp.status_code, 400)
+    check("healthz 佇列統計", client.get("/healthz").get_json()["reply_queue"]["processed"], 1)
+    app.REPLY_MODE = "sync"
+
+    # 7b. 同步模式 callback：驗簽後直接回覆；驗簽耗時與失敗次數記錄在指標中
+    FakeLineAPI.replies.clear()
+    verified = app._VERIFY.snapshot()[1]
+    body, signature = signed_body([text_event("50嵐 珍奶", token="sync-1")])
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("同步模式回覆", (resp.status_code, [r["replyToken"] for r in FakeLineAPI.replies]), (200, ["sync-1"]))
+    check("驗簽耗時記錄", app._VERIFY.snapshot()[1], verified + 1)
+    invalid = app._INVALID_SIGNATURES.value
+    client.post("/callback", data=body, headers={"X-Line-Signature": "bad"})
+    check("驗簽失敗計數", app._INVALID_SIGNATURES.value, invalid + 1)
+
+    # 7b-2. 一個 webhook 多個事件：不同使用者並行回覆，同一使用者的回覆維持原順序
+    FakeLineAPI.replies.clear()
+    events = [text_event("50嵐 珍奶", user_id=user, token=f"{user}-{i}", event_id=f"M{n}")
+              for n, (user, i) in enumerate([("U1", 1), ("U2", 1), ("U1", 2), ("U3", 1), ("U1", 3), ("U2", 2)])]
+    body, signature = signed_body(events)
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    tokens = [r["replyToken"] for r in FakeLineAPI.replies]
+    check("多事件全部回覆", (resp.status_code, sorted(tokens)), (200, sorted(e["replyToken"] for e in events)))
+    check("同一使用者依序回覆", ([t for t in tokens if t.startswith("U1")], [t for t in tokens if t.startswith("U2")]),
+          (["U1-1", "U1-2", "U1-3"], ["U2-1", "U2-2"]))
+
+    # 7b-3. 重送去重：同一個 webhookEventId 只處理一次；回覆失敗的事件不記錄，重送時可再處理
+    FakeLineAPI.replies.clear()
+    redelivered = app._DUPLICATE_EVENTS.labels("true").value
+    body, signature = signed_body([text_event("50嵐 珍奶", token="dup-1", event_id="DUP-1")])
+    client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    body, signature = signed_body([text_event("50嵐 珍奶", token="dup-2", event_id="DUP-1", redelivery=True),
+                                   text_event("50嵐 珍奶", token="dup-3", event_id="DUP-3")])
+    resp = client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("重送事件略過", (resp.status_code, [r["replyToken"] for r in FakeLineAPI.replies]), (200, ["dup-1", "dup-3"]))
+    check("重送計數", app._DUPLICATE_EVENTS.labels("true").value, redelivered + 1)
+    check("healthz 去重統計", client.get("/healthz").get_json()["webhook_dedup"]["backend"], "memory")
+    working_client = app.line_client
+    app.line_client = LineReplyClient(Configuration(host="http://127.0.0.1:9", access_token="test"), timeout=0.5)
+    body, signature = signed_body([text_event("50嵐 珍奶", token="fail-1", event_id="FAIL-1")])
+    check("回覆失敗回 500", client.post("/callback", data=body, headers={"X-Line-Signature": signature}).status_code,
+          500)
+    app.line_client = working_client
+    FakeLineAPI.replies.clear()
+    client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("回覆失敗的事件可再處理", [r["replyToken"] for r in FakeLineAPI.replies], ["fail-1"])
+
+    # 7b-4. 准入控制：超過 burst 的事件只回一次固定訊息、其餘略過；進行中事件達上限時回忙碌訊息；名額不外洩
+    check("預設啟用使用者限流", (users_limiter.enabled, users_limiter.burst), (True, app.USER_BURST))
+    check("已准入的名額都已釋放", app._inflight.in_flight, 0)
+    now = [0.0]
+    app._user_limiter = TokenBucketLimiter(rate=1, burst=2, clock=lambda: now[0])
+    throttled = app._THROTTLED_EVENTS.labels("user").value
+    FakeLineAPI.replies.clear()
+    body, signature = signed_body([text_event("50嵐 珍奶", user_id="U9", token=f"U9-{i}") for i in range(4)]
+                                  + [text_event("50嵐 珍奶", user_id="U8", token="U8-0")])
+    client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    replies = {r["replyToken"]: r["messages"][0]["text"] for r in FakeLineAPI.replies}
+    check("限流：超過 burst 只通知一次", sorted(replies), ["U8-0", "U9-0", "U9-1", "U9-2"])
+    check("限流：固定訊息不計算", replies["U9-2"], app.THROTTLED_REPLY)
+    check("限流計數", app._THROTTLED_EVENTS.labels("user").value, throttled + 2)
+    now[0] += 1
+    FakeLineAPI.replies.clear()
+    body, signature = signed_body([text_event("50嵐 珍奶", user_id="U9", token="U9-4")])
+    client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("限流：補充 token 後恢復", [r["messages"][0]["text"] == app.THROTTLED_REPLY for r in FakeLineAPI.replies],
+          [False])
+    app._user_limiter = TokenBucketLimiter(rate=0)
+    app._inflight = ConcurrencyLimiter(1)
+    app._inflight.try_acquire()  # 模擬另一個處理中的事件
+    FakeLineAPI.replies.clear()
+    body, signature = signed_body([text_event("50嵐 珍奶", token="busy-1")])
+    client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("超過進行中上限回忙碌訊息", [r["messages"][0]["text"] for r in FakeLineAPI.replies], [app.OVERLOADED_REPLY])
+    app.THROTTLE_ACTION = "drop"
+    FakeLineAPI.replies.clear()
+    body, signature = signed_body([text_event("50嵐 珍奶", token="busy-2")])
+    client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    check("drop 模式不回覆", FakeLineAPI.replies, [])
+    app.THROTTLE_ACTION = "reply"
+    app._inflight.release()
+    admission = client.get("/healthz").get_json()["admission"]
+    check("healthz 准入統計", (admission["in_flight"]["rejected"], admission["in_flight"]["in_flight"]), (2, 0))
+    app._inflight = ConcurrencyLimiter(app.MAX_INFLIGHT_EVENTS)
+    server.shutdown()
+
+    # 7c. /metrics：Prometheus 文字格式，含各階段直方圖、錯誤分類、快取事件與資料量表
+    app._reply_cache.clear()
+    app.build_reply("麻古 芝芝")
+    app.build_reply("清心 高山 少糖")
+    resp = client.get("/metrics")
+    text = resp.get_data(as_text=True)
+    samples = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+    check("metrics 格式", resp.content_type, "text/plain; version=0.0.4; charset=utf-8")
+    check("metrics 解析錯誤分類", float(samples['calcal_parse_errors_total{code="unknown_brand"}']) >= 1, True)
+    check("metrics 計算錯誤分類", float(samples['calcal_calculate_errors_total{code="unknown_sweetness"}']) >= 1,
+          True)
+    check("metrics 階段直方圖", all(f'calcal_stage_seconds_count{{stage="{stage}"}}' in samples
+                                 for stage in ("verify", "parse", "calculate", "format", "ranking", "reply")), True)
+    check("metrics LINE API", float(samples['calcal_line_api_seconds_count{result="ok"}']) >= 4, True)
+    check("metrics 快取事件", int(samples['calcal_reply_cache_events_total{event="hit"}']), app._reply_cache.hits)
+    check("metrics 資料量表", (int(samples["calcal_data_generation"]), int(samples['calcal_data_rows{table="drinks"}'])),
+          (loader.generation, len(loader.snapshot.drinks_index)))
+    check("metrics 快照年齡", 0 <= float(samples["calcal_snapshot_age_seconds"]) < 600, True)
+    check("metrics 更新耗時", float(samples['calcal_refresh_seconds_count{phase="fetch"}']) >= 1, True)
+    check("metrics 更新結果", float(samples['calcal_refresh_total{result="error"}']) >= 1, True)
+
+    # 7d. /admin/profile：需 ADMIN_TOKEN；剖析指定次數後可取回 pstats 與 collapsed stack
+    check("未設定 token 時 404", client.get("/admin/profile").status_code, 404)
+    app.ADMIN_TOKEN = "secret"
+    auth = {"Authorization": "Bearer secret"}
+    check("token 錯誤 401", client.get("/admin/profile", headers={"Authorization": "Bearer x"}).status_code, 401)
+    check("參數錯誤 400", client.post("/admin/profile?count=0", headers=auth).status_code, 400)
+    resp = client.post("/admin/profile?target=build_reply&count=2", headers=auth)
+    check("開始剖析 202", (resp.status_code, resp.get_json()["running"]), (202, True))
+    check("進行中 409", client.post("/admin/profile", headers=auth).status_code, 409)
+    app.build_reply("50嵐 珍奶 少糖")
+    app.build_reply("清心 高山 熱")
+    body = client.get("/admin/profile", headers=auth).get_json()
+    check("剖析摘要", (body["running"], body["invocations"], body["profiled"]), (False, 2, 2))
+    resp = client.get("/admin/profile?format=pstats", headers=auth)
+    functions = {name for _, _, name in marshal.loads(resp.data)}
+    check("pstats 含 build_reply", ("build_reply" in functions, "parse" in functions), (True, True))
+    check("文字報表", "function calls" in client.get("/admin/profile?format=text", headers=auth).get_data(as_text=True),
+          True)
+    client.post("/admin/profile?seconds=30", headers=auth)
+    check("提前結束", client.delete("/admin/profile", headers=auth).get_json()["running"], False)
+    app.ADMIN_TOKEN = ""
+
+    # 8. 佇列滿時丟棄並計數
+    release = threading.Event()
+    dispatcher = ReplyDispatcher(lambda item: release.wait(5), workers=1, maxsize=1)
+    dispatcher.submit("a")
+    wait_until(lambda: dispatcher.stats()["depth"] == 0)  # a 已被工作執行緒取走
+    accepted = [dispatcher.submit("b"), dispatcher.submit("c")]
+    release.set()
+    dispatcher.stop()
+    check("佇列滿時丟棄", accepted, [True, False])
+    check("丟棄計數", (dispatcher.stats()["dropped"], dispatcher.stats()["processed"]), (1, 2))
+
+    # 9. 資料來源故障且沒有快取：大量訊息同時進來只嘗試初始化一次，斷開期間立即回覆維護訊息
+    original_breaker, original_loader_class = app._breaker, app.DataLoader
+    app._services.clear()
+    app._breaker = CircuitBreaker(base_delay=60, jitter=0)
+    attempts = []
+
+    def failing_loader(*args, **kwargs):
+        attempts.append(1)
+        time.sleep(0.1)
+        raise ConnectionError("Sheets 無法連線")
+
+    app.DataLoader = failing_loader
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(app.build_reply("50嵐 珍奶"))) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check("故障時只嘗試一次初始化", len(attempts), 1)
+    check("故障時全部回覆維護訊息", set(replies), {"抱歉，機器人目前正在維護中，暫時無法提供服務"})
+    started = time.perf_counter()
+    app.build_reply("50嵐 珍奶")
+    check("斷開期間立即回覆", (len(attempts), time.perf_counter() - started < 0.05), (1, True))
+    resp = client.get("/healthz")
+    body = resp.get_json()
+    check("healthz 斷路器狀態", (resp.status_code, body["breaker"]["state"], body["breaker"]["consecutive_failures"]),
+          (503, "open", 1))
+    check("healthz 下次重試時間", body["breaker"]["retry_in_s"] > 50, True)
+    app.DataLoader = original_loader_class
+    install(loader)
+    triggered = []
+    original_scheduler, app._scheduler = app._scheduler, SimpleNamespace(trigger=lambda: triggered.append(1))
+    reply = app.build_reply("更新資料")
+    app._breaker.state = "half_open"  # 其他請求正在試探
+    replies = [reply, app.build_reply("更新資料")]
+    check("斷開或半開試探中不觸發更新", ([r.startswith("⏳ 資料來源暫時無法連線") for r in replies], triggered),
+          ([True, True], []))
+    app._scheduler, app._breaker = original_scheduler, original_breaker
+
+    # 10. 重播工具：兩份快取各跑一次，統計各階段延遲並列出回覆不同的訊息（多程序時順序與合併正確）
+    with tempfile.TemporaryDirectory() as tmp:
+        edited = json.loads(json.dumps(RAW))
+        edited["drinks"][0]["熱量"] = 700  # 50嵐 珍珠奶茶 L 冰
+        paths = {name: os.path.join(tmp, name) for name in ("a.json", "b.json", "m.jsonl", "r.json", "d.jsonl")}
+        for name, raw in (("a.json", RAW), ("b.json", edited)):
+            with open(paths[name], "w", encoding="utf-8") as f:
+                json.dump(raw, f, ensure_ascii=False)
+        lines = ["50嵐 珍奶", json.dumps({"text": "50嵐  珍奶"}, ensure_ascii=False), "清心 高山茶 微糖", "", "更新資料",
+                 json.dumps({"events": [text_event("低卡 50嵐"),
+                                        {"type": "message", "message": {"type": "sticker"}}]}, ensure_ascii=False)]
+        with open(paths["m.jsonl"], "w", encoding="utf-8") as f:
+            f.write("\n".join(lines * 3) + "\n")
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "replay.py")
+        proc = subprocess.run([sys.executable, script, paths["m.jsonl"], "--data", paths["a.json"],
+                               "--against", paths["b.json"], "--workers", "2", "--chunk", "2",
+                               "--output", paths["r.json"], "--diff-output", paths["d.jsonl"]],
+                              capture_output=True, text=True, timeout=60)
+        check("重播工具結束碼", (proc.returncode, proc.stderr), (0, ""))
+        with open(paths["r.json"], encoding="utf-8") as f:
+            report = json.load(f)
+        with open(paths["d.jsonl"], encoding="utf-8") as f:
+            diffs = [json.loads(line) for line in f]
+        check("重播訊息數（略過空行、貼圖與「更新資料」）", (report["messages"], report["skipped"]), (12, {"更新資料": 3}))
+        check("各階段筆數", {stage: stats["count"] for stage, stats in report["datasets"][0]["stages"].items()},
+              {"reply": 12, "parse": 9, "calculate": 9, "format": 9, "ranking": 3})
+        check("百分位數遞增", all(s["p50"] <= s["p95"] <= s["p99"]
+                                 for d in report["datasets"] for s in d["stages"].values()), True)
+        check("回覆差異（空白不同的訊息合併計數）", (report["diff"], [(d["text"], d["count"]) for d in diffs]),
+              ({"messages": 6, "distinct": 1}, [("50嵐 珍奶", 6)]))
+        check("差異內容", ("650 大卡" in diffs[0]["before"], "700 大卡" in diffs[0]["after"]), (True, True))
+        # .env 有金鑰時，import app 的初始化也不能連到 Sheets（只有 --data/--against sheets 才會）
+        probe = ("import sys, data_sources\n"
+                 "calls = []\n"
+                 "data_sources._service_account_client = lambda *a, **k: calls.append(a) or sys.exit(3)\n"
+                 f"sys.path.insert(0, {os.path.dirname(script)!r})\n"
+                 "import replay\n"
+                 f"replay.setup([{paths['a.json']!r}])\n"
+                 "print(len(calls))\n")
+        proc = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, timeout=60,
+                              cwd=os.path.dirname(os.path.dirname(script)),
+                              env=dict(os.environ, GOOGLE_SHEETS_API_KEY='{"type": "service_account"}'))
+        check("重播工具不連網", (proc.returncode, proc.stdout.strip()), (0, "0"))
+
+    print(f"通過 {len(PASSED)} 項")
+    if FAILED:
+        print(f"失敗 {len(FAILED)} 項：")
+        for f in FAILED:
+            print(f"  ✗ {f}")
+        sys.exit(1)
+    print("全部測試通過 ✅")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""DataLoader 與 Google Sheets 互動的離線測試：以本地假 gspread 用戶端驗證抓取、變動偵測與快取。
+
+執行方式：python tests/test_data_loader.py
+"""
+import copy
+import csv
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# 測試中會刻意讓 Sheets 失敗，不需要看到錯誤日誌
+logging.disable(logging.CRITICAL)
+
+from calorie_calculator import CalorieCalculator  # noqa: E402
+from data_loader import DataLoader, RefreshScheduler, _lookup_files  # noqa: E402
+from data_sources import CsvDirectorySource, SqliteSource, open_source  # noqa: E402
+from fake_gspread import FakeClient, raw_to_values  # noqa: E402
+from index_snapshot import read_snapshot, write_snapshot  # noqa: E402
+import sqlite_lookup  # noqa: E402
+from sqlite_lookup import SqliteDrinkTable, SqliteRankingIndex, SqliteSuggestionIndex  # noqa: E402
+from input_parser import UserInputParser  # noqa: E402
+import nutrition_matrix  # noqa: E402
+from test_offline import RAW  # noqa: E402
+
+PASSED = []
+FAILED = []
+
+
+def check(name, actual, expected):
+    if actual == expected:
+        PASSED.append(name)
+    else:
+        FAILED.append(f"{name}\n    期望: {expected}\n    實際: {actual}")
+
+
+def write_csv_dir(raw, directory, tsv=()):
+    """把原始資料寫成一個目錄的 CSV（tsv 中的工作表寫成 .tsv）。"""
+    os.makedirs(directory, exist_ok=True)
+    for title, values in raw_to_values(raw).items():
+        ext, delimiter = (".tsv", "\t") if title in tsv else (".csv", ",")
+        with open(os.path.join(directory, title + ext), "w", encoding="utf-8", newline="") as f:
+            csv.writer(f, delimiter=delimiter).writerows(values)
+
+
+def write_sqlite(raw, path):
+    """把原始資料寫成六張以工作表名稱命名的資料表；空白儲存格存成 NULL。"""
+    with sqlite3.connect(path) as conn:
+        for title, values in raw_to_values(raw).items():
+            header = values[0]
+            conn.execute(f'DROP TABLE IF EXISTS "{title}"')
+            conn.execute(f'CREATE TABLE "{title}" ({", ".join(f"{chr(34)}{col}{chr(34)}" for col in header)})')
+            conn.executemany(f'INSERT INTO "{title}" VALUES ({", ".join("?" * len(header))})',
+                             [[cell or None for cell in row + [""] * (len(header) - len(row))]
+                              for row in values[1:]])
+    conn.close()
+
+
+class CountingSource(CsvDirectorySource):
+    """記錄 rows() 讀了哪些表。"""
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.read = []
+
+    def rows(self, key):
+        self.read.append(key)
+        return super().rows(key)
+
+
+def _load_fails(loader):
+    try:
+        loader.load()
+    except Exception:  # noqa: BLE001
+        return True
+    return False
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "sheet_cache.json")
+        client = FakeClient(RAW)
+        loader = DataLoader("{}", "Nutrition_Facts", cache_path=cache_path,
+                            client_factory=client.factory)
+
+        # 1. 一次 batch 請求抓回六張表，字串數值也能正確計算
+        changed = loader.refresh()
+        check("首次載入全部重建", len(changed), 6)
+        check("只呼叫一次 batch", client.calls["values_batch_get"], 1)
+        check("來源", loader.source, "sheets")
+        parsed = UserInputParser(loader).parse("50嵐 珍奶 微糖 +珍珠*2")
+        result = CalorieCalculator(loader).calculate(parsed)
+        check("字串數值計算", (result["calories"], result["sugar"]), (884, 33.5))
+        check("寫入快取檔", os.path.isfile(cache_path), True)
+
+        # 2. 內容沒變：不換世代、不改寫快取，也不重新認證或開啟試算表
+        generation = loader.generation
+        mtime = os.stat(cache_path).st_mtime_ns
+        check("無變動回傳空集合", loader.refresh(), set())
+        check("無變動不換世代", loader.generation, generation)
+        check("無變動不改寫快取", os.stat(cache_path).st_mtime_ns, mtime)
+        check("重用用戶端", (client.calls["auth"], client.calls["open"]), (1, 1))
+
+        # 3. 只改 Drinks_Alias：只重建該區段，其他區段的表格物件沿用
+        raw = copy.deepcopy(RAW)
+        raw["drinks_alias"][0]["Alias_Drinks_Name"] = "珍奶, 波霸奶茶, 黑糖珍奶"
+        client.set_raw(raw)
+        old = loader.snapshot
+        check("只重建變動區段", loader.refresh(), {"drinks_alias"})
+        check("變動後換世代", loader.generation > generation, True)
+        check("未變動區段沿用", loader.snapshot.drinks_index is old.drinks_index, True)
+        check("變動區段重建", loader.snapshot.drinks_alias_map[("50嵐", "黑糖珍奶")], "珍珠奶茶")
+        check("衍生索引依區段沿用", (loader.snapshot.ranking is old.ranking,
+                                     loader.snapshot.suggestions is old.suggestions), (True, False))
+        check("別名變動後建議更新", loader.snapshot.suggestions.suggest("50嵐", "黑糖珍乃"), ["珍珠奶茶"])
+
+        # 4. 由快取啟動後，Sheets 內容相同時只改標記來源
+        cached = DataLoader("{}", "Nutrition_Facts", cache_path=cache_path,
+                            client_factory=client.factory)
+        client.fail = True
+        cached.load()
+        check("Sheets 失敗退回快取", cached.source, "cache")
+        client.fail = False
+        generation = cached.generation
+        check("快取與 Sheets 相同", cached.refresh(), set())
+        check("來源改為 sheets", (cached.source, cached.generation), ("sheets", generation))
+
+        # 5. 抓取失敗後下次重新認證
+        client.fail = True
+        try:
+            loader.refresh()
+        except ConnectionError:
+            pass
+        client.fail = False
+        auth = client.calls["auth"]
+        loader.refresh()
+        check("失敗後重新認證", client.calls["auth"], auth + 1)
+
+    # 5b. 重啟時優先載入索引快照檔；損壞或 schema 不符才退回原始 JSON 快取
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "sheet_cache.json")
+        snapshot_path = os.path.join(tmp, "index_snapshot.bin")
+        client = FakeClient(RAW)
+
+        def new_loader():
+            return DataLoader("{}", "Nutrition_Facts", cache_path=cache_path,
+                              snapshot_path=snapshot_path, client_factory=client.factory)
+
+        new_loader().refresh()
+        os.remove(cache_path)  # 只剩索引快照檔也能啟動
+        client.fail = True
+        restarted = new_loader()
+        restarted.load()
+        check("由索引快照檔啟動", (restarted.source, len(restarted.snapshot.drinks_index)), ("cache", 14))
+        client.fail = False
+        check("快照啟動後可偵測無變動", restarted.refresh(), set())
+
+        client.fail = True
+        with open(snapshot_path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\x00")  # 破壞最後一個位元組，CRC32 不符
+        check("損壞且無 JSON 快取時載入失敗", _load_fails(new_loader()), True)
+        client.fail = False
+        new_loader().refresh()  # 重新寫出 JSON 快取與快照
+        write_snapshot(snapshot_path, restarted.snapshot, schema=0)  # 模擬舊版 schema
+        client.fail = True
+        fallback = new_loader()
+        fallback.load()
+        check("schema 不符退回 JSON 快取", fallback.source, "cache")
+        recovered = new_loader()
+        recovered.load()
+        check("退回後重寫快照檔", recovered.shared_version > 0, True)
+        client.fail = False
+
+    # 6. single-flight：更新進行中再觸發，共用同一次更新與結果
+    release = threading.Event()
+    calls = []
+
+    def slow_refresh():
+        calls.append(1)
+        release.wait(5)
+        return {"drinks"}
+
+    scheduler = RefreshScheduler(slow_refresh)
+    first, second = scheduler.trigger(), scheduler.trigger()
+    check("進行中共用同一次更新", first is second, True)
+    check("逾時回傳未完成", first.wait(0.01), False)
+    check("進行中狀態", scheduler.stats()["in_flight"], True)
+    release.set()
+    check("等待者取得結果", (first.wait(5), second.result), (True, {"drinks"}))
+    check("只抓取一次", len(calls), 1)
+    check("完成後可再觸發", scheduler.trigger() is not first, True)
+
+    # 7. 失敗連續次數與成功後歸零
+    outcomes = [ConnectionError("down"), ConnectionError("down"), set()]
+
+    def flaky_refresh():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    scheduler = RefreshScheduler(flaky_refresh)
+    for _ in range(2):
+        flight = scheduler.trigger()
+        flight.wait(5)
+    check("失敗回傳例外", isinstance(flight.error, ConnectionError), True)
+    check("連續失敗次數", scheduler.stats()["failure_streak"], 2)
+    scheduler.trigger().wait(5)
+    stats = scheduler.stats()
+    check("成功後歸零", (stats["failure_streak"], stats["last_success"] is not None), (0, True))
+
+    # 8. 排程：依間隔自動更新，should_skip 為真時跳過
+    ticks = []
+    skip = [True]
+    scheduler = RefreshScheduler(lambda: ticks.append(1), interval=0.02, jitter=0.5,
+                                 should_skip=lambda: skip[0])
+    scheduler.start()
+    time.sleep(0.1)
+    check("should_skip 時跳過", len(ticks), 0)
+    skip[0] = False
+    deadline = time.monotonic() + 5
+    while len(ticks) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.stop()
+    check("排程自動更新", len(ticks) >= 2, True)
+
+    # 9. 預先計算的結果矩陣：只有 Drinks 或甜度表變動時才重算
+    if nutrition_matrix.numpy_module() is not None:
+        client = FakeClient(RAW)
+        loader = DataLoader("{}", "Nutrition_Facts", cache_path=os.devnull,
+                            client_factory=client.factory, precompute=True)
+        loader.refresh()
+        matrix = loader.snapshot.matrix
+        raw = copy.deepcopy(RAW)
+        raw["drinks_alias"][0]["Alias_Drinks_Name"] = "珍奶, 黑糖珍奶"
+        client.set_raw(raw)
+        loader.refresh()
+        check("別名變動沿用矩陣", loader.snapshot.matrix is matrix, True)
+        raw["brand_sweet"][2][1] = "50%"
+        client.set_raw(raw)
+        loader.refresh()
+        check("甜度變動重算矩陣", loader.snapshot.matrix.lookup("50嵐", "珍珠奶茶", "L", "I", "少糖")[1],
+              22.5)
+
+    # 10. 本機資料來源：CSV／TSV 目錄與 SQLite 資料庫建出與 Sheets 相同的索引；只重新讀取有變動的表
+    reference = DataLoader(cache_path=os.devnull)
+    reference.build(RAW)
+    expected = (list(reference.snapshot.drinks_index.items()), reference.snapshot.toppings_map,
+                reference.snapshot.sweet_map, reference.snapshot.drinks_alias_map)
+
+    def tables(loader):
+        data = loader.snapshot
+        return list(data.drinks_index.items()), data.toppings_map, data.sweet_map, data.drinks_alias_map
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "csv")
+        write_csv_dir(RAW, directory, tsv={"Toppings"})
+        source = CountingSource(directory)
+        loader = DataLoader(cache_path=os.path.join(tmp, "cache.json"), source=source)
+        check("CSV 首次載入", (len(loader.refresh()), loader.source), (6, "csv"))
+        check("CSV 索引與 Sheets 相同", tables(loader), expected)
+        check("CSV 不寫 JSON 快取", os.path.exists(os.path.join(tmp, "cache.json")), False)
+        source.read.clear()
+        check("CSV 沒變不重讀", (loader.refresh(), source.read), (set(), []))
+        raw = copy.deepcopy(RAW)
+        raw["size_alias"].append({"Size_Alias": "特大", "Size": "L"})
+        write_csv_dir(raw, directory, tsv={"Toppings"})
+        check("CSV 只重讀變動的表", (loader.refresh(), source.read), ({"size_alias"}, ["size_alias"]))
+        os.remove(os.path.join(directory, "Drinks_Alias.csv"))
+        check("CSV 缺檔時失敗", _load_fails(DataLoader(cache_path=os.devnull, source=CsvDirectorySource(directory))),
+              True)
+
+        database = os.path.join(tmp, "nutrition.db")
+        write_sqlite(RAW, database)
+        loader = DataLoader(cache_path=os.devnull, source=open_source("sqlite", database))
+        check("SQLite 首次載入", (len(loader.refresh()), loader.source), (6, "sqlite"))
+        check("SQLite 索引與 Sheets 相同", tables(loader), expected)
+        check("SQLite 沒變不重建", loader.refresh(), set())
+        check("SQLite 檔案不存在時失敗",
+              _load_fails(DataLoader(cache_path=os.devnull, source=SqliteSource(os.path.join(tmp, "none.db")))), True)
+        check("不支援的來源", _raises_value_error(lambda: open_source("excel", tmp)), True)
+        check("本機來源需要路徑", _raises_value_error(lambda: open_source("csv")), True)
+
+    # 11. SQLite 查表模式：營養表、排行、建議的結果與記憶體索引相同；查表檔依內容命名、重建時沿用；
+    #     可寫入共用快照檔；檔案被刪除時仍可查詢；清理舊檔保留使用中與寬限期內的檔案
+    with tempfile.TemporaryDirectory() as tmp:
+        lookup_dir = os.path.join(tmp, "lookup")
+        loader = DataLoader(cache_path=os.devnull, lookup_dir=lookup_dir)
+        loader.build(RAW)
+        table = loader.snapshot.drinks_index
+        check("查表模式使用 SQLite", isinstance(table, SqliteDrinkTable), True)
+        check("查表模式內容與順序", list(table.items()), expected[0])
+        check("查表模式查無", (table.get(("50嵐", "珍珠奶茶", "XL", "I")), ("50嵐", "珍珠奶茶") in table), (None, False))
+        check("查表模式品名集合", {b: set(n) for b, n in table.brand_drinks.items()},
+              {b: set(n) for b, n in reference.snapshot.brand_drinks.items()})
+        check("查表模式尺寸冰量", dict(table.drink_variants), dict(reference.snapshot.drink_variants))
+        for text in ("50嵐 珍奶 微糖 +珍珠*2", "50嵐 波霸奶綠 熱", "清心 高山"):
+            results = [CalorieCalculator(ld).calculate(UserInputParser(ld).parse(text)) for ld in (loader, reference)]
+            check(f"查表模式計算：{text}", results[0], results[1])
+        files = os.listdir(lookup_dir)
+        loader.build(RAW)
+        check("內容相同沿用查表檔", (os.listdir(lookup_dir), loader.snapshot.drinks_index.path), (files, table.path))
+        path = os.path.join(tmp, "index_snapshot.bin")
+        write_snapshot(path, loader.snapshot, 1)
+        restored = read_snapshot(path, 1)[1].drinks_index
+        check("查表模式寫入快照檔", (restored.path, list(restored.items())), (table.path, expected[0]))
+        check("查表模式 pickle 只存路徑", len(pickle.dumps(table)) < 200, True)
+
+        # 排行與品名建議也在 SQLite 檔中：結果與記憶體索引相同，記憶體只剩路徑與少量統計
+        ranking, suggestions = loader.snapshot.ranking, loader.snapshot.suggestions
+        check("查表模式排行與建議", (isinstance(ranking, SqliteRankingIndex), isinstance(suggestions, SqliteSuggestionIndex)),
+              (True, True))
+        queries = [dict(brand="50嵐"), dict(brand="50嵐", metric="sugar", descending=True, limit=3),
+                   dict(brand="50嵐", low=100, high=400, size="L", ice="I"), dict(brand="清心福全", ice="H"),
+                   dict(brand="麻古")]
+        for query in queries:
+            span = {k: v for k, v in query.items() if k not in ("limit", "descending")}
+            check(f"查表模式排行 {query}", (ranking.query(**query), ranking.count(**span)),
+                  (reference.snapshot.ranking.query(**query), reference.snapshot.ranking.count(**span)))
+        check("查表模式排行列數", ranking.rows, reference.snapshot.ranking.rows)
+        check("查表模式排行數值型別", type(ranking.query("50嵐")[0].calories), int)
+        check("查表模式排行指標錯誤", _raises_value_error(lambda: ranking.query("50嵐", metric="price")), True)
+        for brand, text in (("50嵐", "珍珠奶查"), ("清心福全", "高山綠"), ("50嵐", "巧克力"), ("麻古", "珍奶")):
+            check(f"查表模式建議 {text}", suggestions.suggest(brand, text),
+                  reference.snapshot.suggestions.suggest(brand, text))
+        sizes = (loader.memory_report(), reference.memory_report())
+        check("查表模式三個大索引不佔記憶體",
+              all(sizes[0][name] < min(sizes[1][name], 4096) for name in ("drinks_index", "ranking", "suggestions")),
+              True)
+        check("查表模式各自的查表檔", sorted(name.split("-")[0] for name in os.listdir(lookup_dir)),
+              ["drinks", "ranking", "suggestions"])
+
+        # 其他 worker 刪掉仍在使用的查表檔：新執行緒改用載入時開啟的連線，查詢不會失敗
+        other = DataLoader(cache_path=os.devnull, lookup_dir=os.path.join(tmp, "other"))
+        other.build(RAW)
+        data = other.snapshot
+        for path in _lookup_files(data):
+            os.unlink(path)
+        results = []
+        thread = threading.Thread(target=lambda: results.append((
+            data.drinks_index.get(("50嵐", "珍珠奶茶", "L", "I")), data.ranking.count("50嵐"),
+            data.suggestions.suggest("50嵐", "珍珠奶查"), list(data.brand_drinks["50嵐"]))))
+        thread.start()
+        thread.join()
+        check("查表檔被刪除後仍可查詢", results, [(reference.snapshot.drinks_index.get(("50嵐", "珍珠奶茶", "L", "I")),
+                                                reference.snapshot.ranking.count("50嵐"), ["珍珠奶茶"],
+                                                list(reference.snapshot.brand_drinks["50嵐"]))])
+
+        # 清理舊檔：只保留最近 KEEP_FILES 個；使用中與寬限期內的檔案不刪
+        prune_dir = os.path.join(tmp, "prune")
+        os.makedirs(prune_dir)
+        old = time.time() - sqlite_lookup.PRUNE_GRACE - 60
+        for i in range(6):
+            path = os.path.join(prune_dir, f"ranking-{i}.db")
+            open(path, "w").close()
+            os.utime(path, (old + i, old + i) if i < 4 else None)
+        sqlite_lookup._prune(prune_dir, "ranking", keep={os.path.join(prune_dir, "ranking-0.db")})
+        check("清理舊查表檔", sorted(os.listdir(prune_dir)), ["ranking-0.db", "ranking-3.db", "ranking-4.db",
+                                                            "ranking-5.db"])
+        for i in (4, 5):
+            os.utime(os.path.join(prune_dir, f"ranking-{i}.db"), (old + i, old + i))
+        sqlite_lookup._prune(prune_dir, "ranking")
+        check("寬限期過後依時間清理", sorted(os.listdir(prune_dir)), ["ranking-3.db", "ranking-4.db", "ranking-5.db"])
+
+    print(f"通過 {len(PASSED)} 項")
+    if FAILED:
+        print(f"失敗 {len(FAILED)} 項：")
+        for f in FAILED:
+            print(f"  ✗ {f}")
+        sys.exit(1)
+    print("全部測試通過 ✅")
+
+
+def _raises_value_error(func):
+    try:
+        func()
+    except ValueError:
+        return True
+    return False
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,33 @@
 
 執行方式：python tests/test_offline.py
 """
+import logging
 import os
 import sys
+import marshal
+import pickle
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from admission import ConcurrencyLimiter, TokenBucketLimiter
+from alias_matcher import AliasMatcher
+from batch_calculator import calculate_batch
 from calorie_calculator import CalorieCalculator
-from data_loader import DataLoader
+from circuit_breaker import CircuitBreaker, CircuitOpenError, SingleFlight
+from compact_index import DrinkTable, deep_sizeof
+from data_loader import SNAPSHOT_SCHEMA, DataLoader, _drink_items, snapshot_memory
+from event_dedup import EventDeduper, SqliteEventDeduper
+from index_snapshot import SnapshotError, read_snapshot
+import metrics
+import nutrition_matrix
 from input_parser import UserInputParser
+from profiler import Profiler, parse_spec
+from reply_cache import ReplyCache, normalize_text
+from reply_worker import EventFanout, group_by_source
 
 # 模擬新版 Google Sheets 結構的原始資料
 RAW = {
@@ -77,6 +96,14 @@ def check(name, actual, expected):
         FAILED.append(f"{name}\n    期望: {expected}\n    實際: {actual}")
 
 
+def _is_frozen(snapshot):
+    try:
+        snapshot.generation = 0
+    except AttributeError:  # dataclasses.FrozenInstanceError 是 AttributeError 的子類別
+        return True
+    return False
+
+
 def main():
     loader = DataLoader()
     loader.build(RAW)
@@ -166,6 +193,460 @@ def main():
     r, _ = run("50嵐 波霸奶茶")
     check("合併品名-第一段", r.get("calories"), 600)
 
+    # 16. 別名比對器：長別名優先、同長取最左、移除後以空白取代
+    matcher = AliasMatcher({"大": "L", "大杯": "L", "中": "M", "中杯": "M", "": "X"})
+    check("比對器-長別名優先", matcher.find("中 大杯"), (2, 4, "L"))
+    check("比對器-同長取最左", matcher.consume("中 大"), ("M", "  大"))
+    check("比對器-找不到", matcher.consume("少冰"), (None, "少冰"))
+    check("比對器-空表", AliasMatcher({}).find("大杯"), None)
+
+    # 17. 冰量與甜度依序比對，互不干擾
+    _, p = run("迷客夏 大正紅茶 熱 少糖")
+    check("甜度比對器", (p.get("ice"), p.get("sweetness")), ("H", "少糖"))
+
+    # 18. 快照：build 以新快照整個替換，舊快照不受影響，世代遞增
+    old = loader.snapshot
+    parsed = parser.parse("50嵐 珍奶", old)
+    loader.build({**RAW, "drinks": RAW["drinks"][2:]})
+    check("新快照世代遞增", loader.generation > old.generation, True)
+    check("新快照已替換", ("50嵐", "珍珠奶茶", "L", "I") in loader.snapshot.drinks_index, False)
+    check("舊快照仍可計算", calc.calculate(parsed, old).get("calories"), 650)
+    check("快照不可修改", _is_frozen(old), True)
+
+    # 19. 回覆快取：LRU 淘汰、TTL 過期、計數器
+    now = [0.0]
+    cache = ReplyCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.put((1, "a"), "A")
+    cache.put((1, "b"), "B")
+    cache.get((1, "a"))                  # a 變成最近使用
+    cache.put((1, "c"), "C")             # 淘汰最久未用的 b
+    check("快取-LRU 淘汰", (cache.get((1, "b")), cache.get((1, "a"))), (None, "A"))
+    now[0] = 10.0
+    check("快取-TTL 過期", cache.get((1, "c")), None)
+    stats = cache.stats()
+    check("快取-計數器", (stats["hits"], stats["misses"], stats["evictions"], stats["expirations"]),
+          (2, 2, 1, 1))
+    check("快取-停用", ReplyCache(maxsize=0).get("x"), None)
+    check("快取鍵正規化", normalize_text("  50嵐   珍奶 微糖 "), "50嵐 珍奶 微糖")
+
+    # 20. 多 worker 共用快照：A 發布後 B 同步載入，世代號換成 B 自己的
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index_snapshot.bin")
+        worker_a = DataLoader(snapshot_path=path, sync_interval=0)
+        worker_b = DataLoader(snapshot_path=path, sync_interval=0)
+        worker_b.build(RAW)
+        check("尚無共用檔不替換", worker_b.sync(), False)
+        worker_a.build({**RAW, "drinks": RAW["drinks"][:1]})
+        worker_a.publish()
+        check("B 偵測到新版本", worker_b.sync(), True)
+        check("B 載入 A 的資料", len(worker_b.snapshot.drinks_index), 1)
+        check("B 換成自己的世代號", worker_b.generation != worker_a.generation, True)
+        check("同版本不重複載入", worker_b.sync(), False)
+        check("版本號一致", worker_b.shared_version, worker_a.shared_version)
+        with open(path, "wb") as f:
+            f.write(b"garbage")
+        logging.disable(logging.WARNING)  # 預期中的讀檔警告
+        check("損壞檔不替換", worker_b.sync(), False)
+        logging.disable(logging.NOTSET)
+        try:
+            read_snapshot(path, SNAPSHOT_SCHEMA)
+            check("損壞檔拋出 SnapshotError", False, True)
+        except SnapshotError:
+            check("損壞檔拋出 SnapshotError", True, True)
+
+    # 21. 批次計算：文字與結構化點單混合，結果順序與輸入相同
+    loader.build(RAW)
+    items = [
+        "50嵐 珍奶 微糖 +珍珠*2",
+        {"brand": "五十嵐", "drink": "珍珠奶茶", "size": "中", "sweetness": "少糖"},
+        {"brand": "清心", "drink": "高山", "ice": "熱", "size": "L"},
+        {"brand": "50嵐", "drink": "珍奶", "toppings": [{"name": "珍珠", "count": 2}],
+         "sweetness": "微糖"},
+        {"brand": "麻古", "drink": "芝芝"},
+        {"brand": "50嵐", "drink": "珍奶", "ice": "溫溫"},
+        {"brand": "50嵐", "drink": "珍奶", "toppings": [{"count": 2}]},
+        42,
+        "50嵐 珍奶 微糖 +珍珠*2",
+        {"brand": "50嵐", "drink": "珍奶", "toppings": "珍珠"},
+        {"brand": "50嵐", "drink": "珍奶", "removed_toppings": {"珍珠": 1}},
+    ]
+    results = list(calculate_batch(items, parser, calc, loader.snapshot))
+    check("批次-順序", [r["index"] for r in results], list(range(len(items))))
+    check("批次-文字", (results[0]["calories"], results[0]["sugar"]), (884, 33.5))
+    check("批次-結構化別名", (results[1]["size"], results[1]["calories"]), ("M", 458))
+    check("批次-結構化熱飲 fallback", (results[2]["ice"], results[2]["ice_fallback"]), ("H", True))
+    check("批次-結構化配料", results[3]["calories"], results[0]["calories"])
+    check("批次-未知品牌", results[4]["error"], "找不到品牌「麻古」")
+    check("批次-未知冰量", results[5]["error"], "無法辨識冰量「溫溫」")
+    check("批次-配料格式錯誤", results[6]["error"].startswith("配料格式錯誤"), True)
+    check("批次-型別錯誤", results[7]["ok"], False)
+    check("批次-重複文字", results[8]["calories"], 884)
+    check("批次-配料不是清單", [results[i]["code"] for i in (9, 10)], ["bad_topping", "bad_topping"])
+
+    # 22. memo：同批相同查表只做一次
+    memo = {}
+    first = calc.calculate(parser.parse("50嵐 珍奶 +珍珠"), memo=memo)
+    calc.calculate(parser.parse("五十嵐 珍珠奶茶 微糖 +珍珠"), memo=memo)
+    check("memo 共用查表", sorted(k[0] for k in memo), ["drink", "topping"])
+    check("memo 結果不變", first["calories"], 830)
+
+    # 23. 預先計算的結果矩陣：每一格都與逐步計算完全相同（含熱飲退回冰飲、品牌不提供的甜度）
+    if nutrition_matrix.numpy_module() is None:
+        print("（未安裝 numpy，略過結果矩陣測試）")
+    else:
+        plain = loader.snapshot
+        fast = DataLoader(precompute=True).build(RAW)
+        matrix = fast.matrix
+        mismatches, hits = [], 0
+        for brand, drink, size, ice in {(*k[:3], i) for k in plain.drinks_index for i in ("I", "H")}:
+            for sweetness in [None, *plain.sweetness_order]:
+                parsed = {"brand": brand, "drink": drink, "size": size, "ice": ice,
+                          "sweetness": sweetness, "toppings": [], "removed_toppings": []}
+                hits += matrix.lookup(brand, drink, size, ice, sweetness) is not None
+                if calc.calculate(parsed, plain) != calc.calculate(parsed, fast):
+                    mismatches.append((brand, drink, size, ice, sweetness))
+        check("結果矩陣與逐步計算一致", mismatches, [])
+        check("結果矩陣有命中", hits > 0, True)
+        check("矩陣含熱飲退回列", matrix.lookup("50嵐", "珍珠奶茶", "L", "H", "微糖")[2], True)
+        check("品牌無此甜度查表為 None", matrix.lookup("清心福全", "嚴選高山茶", "L", "I", "少糖"), None)
+        parsed = parser.parse("50嵐 珍奶 微糖 +珍珠*2", fast)
+        check("矩陣 + 配料", calc.calculate(parsed, fast)["calories"], 884)
+        with tempfile.TemporaryDirectory() as tmp:
+            rows = matrix.to_csv(os.path.join(tmp, "table.csv"))
+            check("匯出列數", rows, sum(1 for _ in matrix.iter_rows()))
+
+    # 24. 排行索引：與逐一計算後排序的結果相同（範圍、尺寸／冰量篩選、由高到低）
+    data = loader.snapshot
+    everything = []
+    for brand, drink, size, ice in data.drinks_index:
+        if "/" in drink:
+            continue
+        for sweetness in data.sweet_map.get(brand) or [None]:
+            r = calc.calculate({"brand": brand, "drink": drink, "size": size, "ice": ice, "sweetness": sweetness,
+                                "toppings": [], "removed_toppings": []})
+            everything.append((brand, r["calories"], r["sugar"], drink, size, ice, sweetness))
+
+    def expected(brand, metric, low, high, size, ice, descending):
+        col = 1 if metric == "calories" else 2
+        rows = [e for e in everything if e[0] == brand and (low is None or e[col] >= low)
+                and (high is None or e[col] <= high) and size in (None, e[4]) and ice in (None, e[5])]
+        rows.sort(key=lambda e: (e[col], e[3 - col], *e[3:6], e[6] or ""), reverse=descending)
+        return [e[1:] for e in rows]
+
+    cases = [("50嵐", "calories", None, 500, None, None, False),
+             ("50嵐", "calories", 200, 600, "L", None, True),
+             ("50嵐", "sugar", None, None, None, "I", False),
+             ("迷客夏", "sugar", 10, 40, None, None, True),
+             ("清心福全", "calories", None, None, "L", "H", False)]
+    for brand, metric, low, high, size, ice, descending in cases:
+        want = expected(brand, metric, low, high, size, ice, descending)
+        got = data.ranking.query(brand, metric, low, high, size, ice, limit=5, descending=descending)
+        check(f"排行 {brand} {metric} {low}~{high} {size} {ice}", [tuple(e) for e in got], want[:5])
+        check(f"排行筆數 {brand} {metric}", data.ranking.count(brand, metric, low, high, size, ice), len(want))
+    check("排行不列合併品名", any("/" in e.drink for e in data.ranking.query("50嵐", limit=100)), False)
+    check("排行未知品牌", data.ranking.query("麻古"), [])
+    query = parser.parse_ranking("高卡 五十嵐 大 200~600大卡")
+    check("排行指令解析", (query["brand"], query["metric"], query["descending"], query["low"], query["high"],
+                          query["size"], query["ice"]), ("50嵐", "calories", True, 200.0, 600.0, "L", None))
+    query = parser.parse_ranking("低糖 迷客夏 熱 10克以上")
+    check("排行指令解析糖量", (query["metric"], query["low"], query["high"], query["ice"]), ("sugar", 10.0, None, "H"))
+    check("排行指令單位不符", "error" in parser.parse_ranking("低卡 50嵐 20克以下"), True)
+    query = parser.parse_ranking("低卡 50嵐 L 冰 300以下")
+    check("排行指令尺寸冰量代碼", (query["size"], query["ice"], query["high"]), ("L", "I", 300.0))
+    check("排行指令小寫代碼", (lambda q: (q["size"], q["ice"]))(parser.parse_ranking("高糖 50嵐 m h")), ("M", "H"))
+    check("排行指令無法辨識的條件", parser.parse_ranking("低卡 50嵐 超大 300以下").get("code"), "bad_filter")
+    check("排行指令重複尺寸", parser.parse_ranking("低卡 50嵐 大杯 M").get("code"), "bad_filter")
+
+    # 25. 找不到品名時的相近建議：錯字、縮寫、別名都建議正式品名；完全不像時不附建議
+    check("建議：錯字", data.suggestions.suggest("50嵐", "珍珠奶查"), ["珍珠奶茶"])
+    check("建議：別名錯字", data.suggestions.suggest("清心福全", "高山綠"), ["嚴選高山茶"])
+    check("建議：前綴", data.suggestions.suggest("50嵐", "波霸", limit=2), ["波霸奶綠", "波霸奶茶"])
+    check("建議：不列合併品名", any("/" in s for s in data.suggestions.suggest("50嵐", "奶茶奶綠", limit=10)), False)
+    check("建議：無相近", data.suggestions.suggest("50嵐", "巧克力"), [])
+    check("建議：未知品牌", data.suggestions.suggest("麻古", "珍奶"), [])
+    check("錯誤訊息附建議", parser.parse("50嵐 珍珠奶查 微糖")["error"],
+          "在 50嵐 中找不到飲品「珍珠奶查」，您是不是要找：珍珠奶茶？")
+    check("錯誤訊息無建議", parser.parse("50嵐 巧克力")["error"], "在 50嵐 中找不到飲品「巧克力」")
+
+    # 26. 沒有空白的點單：切出最長的品牌，品名由長到短嘗試，剩餘文字須能完全比對
+    prefix = AliasMatcher({"珍奶": "A", "珍珠奶茶": "B", "珍珠": "C"})
+    check("最長前綴", prefix.longest_prefix("珍珠奶茶微糖"), (4, "B"))
+    check("指定起點", prefix.longest_prefix("50嵐珍奶", 3), (5, "A"))
+    check("前綴不符", prefix.longest_prefix("奶茶"), None)
+
+    def fields(text):
+        p = parser.parse(text)
+        return p.get("error") or (p["brand"], p["drink"], p["size"], p["ice"], p["sweetness"], p["toppings"])
+
+    check("無空白", fields("50嵐珍奶微糖"), ("50嵐", "珍珠奶茶", "L", "I", "微糖", []))
+    check("無空白 + 別名品牌 + 尺寸冰量", fields("五十嵐珍珠奶茶大杯熱少糖"), ("50嵐", "珍珠奶茶", "L", "H", "少糖", []))
+    check("空白位置不對", fields("50嵐 珍奶微糖 +珍珠*2"), ("50嵐", "珍珠奶茶", "L", "I", "微糖", [("珍珠", 2)]))
+    check("品牌後直接接品名", fields("清心高山 熱"), ("清心福全", "嚴選高山茶", "L", "H", None, []))
+    check("無空白找不到品名", fields("50嵐巧克力"), "在 50嵐 中找不到飲品「巧克力」")
+    check("無空白只有品牌", fields("50嵐"), "輸入資訊過少，請遵循「品牌 品名 [尺寸/冰量/甜度] [+配料]」格式")
+    check("有空白時行為不變", fields("麻古 芝芝"), "找不到品牌「麻古」")
+    # 品名之後剩下無法辨識的文字時，不可把較短的品名前綴當成答案
+    check("前綴品名不可吞掉其餘文字", parser.parse("50嵐 奶茶拿鐵").get("code"), "unknown_drink")
+    check("前綴品名 + 甜度仍有剩餘", parser.parse("50嵐 奶綠多多 微糖")["error"],
+          "在 50嵐 中找不到飲品「奶綠多多」，您是不是要找：奶綠、波霸奶綠？")
+    check("無空白前綴品名有剩餘", parser.parse("五十嵐奶青凍")["error"],
+          "在 50嵐 中找不到飲品「奶青凍」，您是不是要找：奶青、波霸奶青？")
+    check("無空白剩餘全是尺寸冰量甜度", fields("五十嵐奶青大杯熱微糖"), ("50嵐", "奶青", "L", "H", "微糖", []))
+    check("無空白剩餘含冰量／甜度同名詞", parser.parse("50嵐奶青中杯熱正常").get("code"), None)
+    check("品名最長字數", data.drink_name_lengths["50嵐"], max(len(n) for n in data.brand_drinks["50嵐"]))
+
+    # 27. 錯誤類別代碼：供 /metrics 分類計數，批次 API 也會回傳
+    codes = [parser.parse(text).get("code") for text in ("麻古 芝芝", "50嵐 巧克力", "50嵐", "50嵐 珍奶")]
+    check("解析錯誤代碼", codes, ["unknown_brand", "unknown_drink", "too_short", None])
+    check("排行錯誤代碼", [parser.parse_ranking(text)["code"] for text in ("低卡", "低卡 麻古", "低卡 50嵐 20克以下",
+                                                                        "低卡 50嵐 芋頭")],
+          ["missing_field", "unknown_brand", "bad_range", "bad_filter"])
+    check("計算錯誤代碼", [calc.calculate(parser.parse(text)).get("code")
+                          for text in ("清心 高山 少糖", "50嵐 珍奶 +芋圓", "50嵐 四季春青茶 中杯")],
+          ["unknown_sweetness", "unknown_topping", "unknown_size"])
+
+    # 28. 指標：直方圖分桶（含邊界值）、多執行緒分片匯總、已結束執行緒的分片併入總計、文字格式
+    registry = metrics.Registry()
+    histogram = metrics.Histogram("t_seconds", "測試", ("stage",), registry=registry, buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.labels("parse").observe(value)
+    counter = metrics.Counter("t_total", "測試\n換行", registry=registry)
+    workers = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    counter.inc(0.5)
+    check("多執行緒計數", counter.value, 4000.5)
+    late = threading.Thread(target=counter.inc)  # 配分片時把已結束的 4 個執行緒的分片併入總計
+    late.start()
+    late.join()
+    check("分片回收後計數不變", (counter.value, len(counter._unlabelled._shards._live)), (4001.5, 2))
+    metrics.Gauge("t_rows", "測試", ("table",), registry=registry,
+                  callback=lambda: {("drinks",): 8, ("size",): None})
+    text = registry.render()
+    check("直方圖分桶", [line for line in text.splitlines() if line.startswith("t_seconds")], [
+        't_seconds_bucket{stage="parse",le="0.1"} 2',
+        't_seconds_bucket{stage="parse",le="1"} 3',
+        't_seconds_bucket{stage="parse",le="+Inf"} 4',
+        't_seconds_sum{stage="parse"} 3.65',
+        't_seconds_count{stage="parse"} 4',
+    ])
+    check("HELP 跳脫換行", "# HELP t_total 測試\\n換行" in text, True)
+    check("callback 量表略過 None", [line for line in text.splitlines() if line.startswith("t_rows")],
+          ['t_rows{table="drinks"} 8'])
+    check("標籤數量不符", _raises(lambda: histogram.labels("a", "b")), True)
+    check("重複註冊", _raises(lambda: metrics.Counter("t_total", "重複", registry=registry)), True)
+
+    # 29. 剖析器：沒有進行中的剖析時直接呼叫；次數用完自動結束；結果可合併成 pstats 與 collapsed stack
+    profiler = Profiler()
+    slow = profiler.hook("build_reply")(lambda seconds: time.sleep(seconds) or seconds)
+    outer = profiler.hook("callback")(lambda: slow(0))
+    check("未剖析直接呼叫", (slow(0), profiler.last), (0, None))
+    session = profiler.start(["build_reply"], count=2, interval=0.001)
+    check("進行中不可重複開始", profiler.start(["callback"]), None)
+    results = [slow(0.03), slow(0.03), slow(0)]
+    summary = session.summary()
+    check("剖析次數用完即結束", (results, summary["invocations"], summary["running"], profiler.session),
+          ([0.03, 0.03, 0], 2, False, None))
+    functions = {name for _, _, name in marshal.loads(session.pstats_bytes())}
+    check("pstats 含被剖析的函式", "<lambda>" in functions and "<built-in method time.sleep>" in functions, True)
+    check("collapsed stack 以目標開頭", all(line.startswith("build_reply;<lambda> (test_offline.py:")
+                                          for line in session.collapsed().splitlines()), True)
+    check("collapsed stack 有取樣", sum(int(line.rsplit(" ", 1)[1]) for line in session.collapsed().splitlines()) > 0,
+          True)
+    session = profiler.start(["build_reply", "callback"], count=5)
+    outer()
+    check("巢狀呼叫只剖析最外層", session.summary()["invocations"], 1)
+    profiler.stop()
+    check("提前結束", (session.running, profiler.session), (False, None))
+    check("未知目標", _raises(lambda: profiler.start(["parse"])), True)
+    check("啟動設定", (parse_spec(" 200 "), parse_spec("60S")), ({"count": 200}, {"seconds": 60.0}))
+    check("啟動設定不是正數", [_raises(lambda: parse_spec(spec)) for spec in ("0", "-5", "0s", "-1s", "nans", "s")],
+          [True] * 6)
+    check("次數、秒數不是正數", [_raises(lambda: profiler.start(**kwargs))
+                             for kwargs in ({"count": 0}, {"seconds": -1}, {"seconds": float("nan")})], [True] * 3)
+    check("不合法的剖析不佔住剖析器", profiler.session, None)
+
+    # 30. 多事件並行：依 userId 分組，不同使用者並行、同一使用者依序；某組失敗時其他組仍處理完
+    def event(user, text, group=None):
+        source = SimpleNamespace(user_id=user, group_id=group, room_id=None)
+        return SimpleNamespace(source=source, text=text)
+
+    events = [event("U1", "a1"), event("U2", "b1"), event("U1", "a2"), event(None, "g1", group="G1"),
+              event(None, "x"), event("U1", "a3"), event(None, "y")]
+    check("依使用者分組", [[e.text for e in group] for group in group_by_source(events)],
+          [["a1", "a2", "a3"], ["b1"], ["g1"], ["x"], ["y"]])
+    handled, threads, barrier = [], set(), threading.Barrier(3, timeout=5)
+
+    def work(group):
+        barrier.wait()  # 三組都開始後才繼續：依序處理時會逾時
+        threads.add(threading.get_ident())
+        for e in group:
+            time.sleep(0.001)
+            handled.append(e.text)
+
+    fanout = EventFanout(work, workers=4)
+    fanout.run(group_by_source(events[:3] + [event("U3", "c1")]))
+    check("不同使用者並行", len(threads), 3)
+    check("同一使用者依序", [text for text in handled if text.startswith("a")], ["a1", "a2"])
+
+    def flaky(group):
+        if group[0].text == "b1":
+            raise RuntimeError("boom")
+        handled.append(group[0].text)
+
+    handled.clear()
+    fanout.work = flaky
+    try:
+        fanout.run(group_by_source(events[:2] + [event("U3", "c1")]))
+        error = None
+    except RuntimeError as exc:
+        error = str(exc)
+    check("失敗組別拋出例外、其他組別照常處理", (error, sorted(handled)), ("boom", ["a1", "c1"]))
+    fanout.stop()
+
+    # 31. webhook 去重：TTL 內重複的 id 略過、過期後可再處理、數量上限淘汰最舊的、多執行緒同時檢查只放行一次
+    now = [0.0]
+    with tempfile.TemporaryDirectory() as tmp:
+        dedupers = {"記憶體": EventDeduper(maxsize=100, ttl=10, clock=lambda: now[0]),
+                    "SQLite": SqliteEventDeduper(os.path.join(tmp, "dedup", "events.db"), ttl=10,
+                                                 clock=lambda: now[0])}
+        for name, dedup in dedupers.items():
+            now[0] = 0.0
+            check(f"{name}去重", [dedup.first_seen(i) for i in ("a", "b", "a")], [True, True, False])
+            now[0] = 11.0
+            check(f"{name}過期後再處理", [dedup.first_seen("a"), dedup.first_seen("a")], [True, False])
+            dedup.forget("a")
+            check(f"{name}移除記錄", dedup.first_seen("a"), True)
+            check(f"{name}統計", (dedup.stats()["accepted"], dedup.stats()["duplicates"]), (4, 2))
+            results = []
+            threads = [threading.Thread(target=lambda: results.extend(dedup.first_seen(f"c{i}") for i in range(20)))
+                       for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            check(f"{name}多執行緒只放行一次", results.count(True), 20)
+            stats = dedup.stats()
+            check(f"{name}多執行緒計數", (stats["accepted"], stats["duplicates"]), (4 + 20, 2 + 60))
+        memory = EventDeduper(maxsize=3)
+        for i in ("x", "y", "z", "w"):
+            memory.first_seen(i)
+        check("數量上限淘汰最舊的", (memory.first_seen("x"), memory.first_seen("w")), (True, False))
+        check("停用時一律放行", EventDeduper(maxsize=0).first_seen("a") and EventDeduper(maxsize=0).first_seen("a"),
+              True)
+        dedupers["SQLite"].close()
+
+    # 32. 斷路器：失敗後以指數退避斷開、半開只放行一次試探、成功即恢復；SingleFlight 的等待者共用結果
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=2, base_delay=2, max_delay=10, jitter=0.5, clock=lambda: now[0],
+                             rng=lambda: 1.0)
+
+    def fail():
+        raise ConnectionError("down")
+
+    delays = []
+    for _ in range(5):
+        now[0] += breaker.retry_in()
+        while True:  # 第一輪連續失敗 threshold 次才斷開；之後半開試探失敗一次就再斷開
+            try:
+                breaker.call(fail)
+            except ConnectionError:
+                pass
+            if breaker.state == "open":
+                break
+        delays.append(breaker.retry_in())
+    check("指數退避（含抖動上限）", delays, [3.0, 6.0, 12.0, 15.0, 15.0])
+    check("斷開時不呼叫", _raises_type(lambda: breaker.call(fail), CircuitOpenError), True)
+    now[0] += 15
+    check("半開只放行一次", [breaker.allow(), breaker.allow()], [True, False])
+    breaker.record_success()
+    check("成功後恢復", (breaker.state, breaker.failures, breaker.allow(), breaker.stats()["next_retry"]),
+          ("closed", 0, True, None))
+
+    flight, gate, runs = SingleFlight(), threading.Event(), []
+
+    def slow():
+        runs.append(1)
+        gate.wait(5)
+        return "loaded"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do(slow))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    gate.set()
+    for t in threads:
+        t.join()
+    check("single-flight 只執行一次", (len(runs), results), (1, ["loaded"] * 5))
+    check("single-flight 完成後可再執行", (flight.do(lambda: "again"), flight.in_flight), ("again", False))
+    check("single-flight 拋出例外", _raises_type(lambda: flight.do(fail), ConnectionError), True)
+
+    # 33. 緊湊飲品表：查表、品名集合、尺寸冰量與原本的 dict／set 完全相同；pickle 往返不變；記憶體報告
+    drinks_index, brand_drinks, drink_variants = {}, {}, {}
+    for (brand, name, size, ice), values in _drink_items(RAW["drinks"]):
+        drinks_index[(brand, name, size, ice)] = values
+        brand_drinks.setdefault(brand, set()).add(name)
+        drink_variants.setdefault((brand, name), set()).add((size, ice))
+    table = DrinkTable.from_items(_drink_items(RAW["drinks"]))
+    check("緊湊表內容與順序", list(table.items()), list(drinks_index.items()))
+    check("緊湊表查表", [table[key] for key in drinks_index], list(drinks_index.values()))
+    check("緊湊表查無", [table.get(("50嵐", "珍珠奶茶", "XL", "I")), table.get(("50嵐", "珍珠奶茶")),
+                       ("無此牌", "珍珠奶茶", "L", "I") in table, _raises_type(lambda: table[None], KeyError)],
+          [None, None, False, True])
+    check("緊湊表品名集合", {b: set(names) for b, names in table.brand_drinks.items()}, brand_drinks)
+    check("緊湊表品名查詢", ("波霸奶綠" in table.brand_drinks["50嵐"], "高山" in table.brand_drinks["50嵐"],
+                         table.brand_drinks.get("無此牌")), (True, False, None))
+    check("緊湊表尺寸冰量", {pair: set(v) for pair, v in table.drink_variants.items()}, drink_variants)
+    check("緊湊表 pickle 往返", list(pickle.loads(pickle.dumps(table)).items()), list(table.items()))
+    dup = DrinkTable.from_items([(("A", "x", "L", "I"), (1.0, None)), (("A", "y", "M", "H"), (2.0, 3.0)),
+                                 (("A", "x", "L", "I"), (4.0, 5.0))])
+    check("緊湊表重複鍵取最後的值", list(dup.items()),
+          [(("A", "x", "L", "I"), (4.0, 5.0)), (("A", "y", "M", "H"), (2.0, 3.0))])
+    check("緊湊表保留 None", DrinkTable.from_items([(("A", "x", "L", "I"), (None, 2.0))])[("A", "x", "L", "I")],
+          (None, 2.0))
+    wide = DrinkTable.from_items(((("A", "x", f"S{s}", f"I{i}"), (s, i)) for s in range(10) for i in range(10)))
+    check("緊湊表尺寸冰量超過 64 種", (wide[("A", "x", "S9", "I9")], len(wide.drink_variants[("A", "x")])),
+          ((9, 9), 100))
+    report = snapshot_memory(loader.snapshot)
+    check("記憶體報告", (report["total"] == sum(v for k, v in report.items() if k != "total"),
+                    report["drinks_index"] > 0, "brand_drinks" in report), (True, True, True))
+    check("記憶體報告共用物件只算一次", deep_sizeof([table, table]) - deep_sizeof([table]), 8)
+
+    # 34. 准入控制：token bucket 依時間補充、閒置補滿的使用者自動清除、超過上限淘汰最久沒出現的；進行中上限
+    now = [0.0]
+    limiter = TokenBucketLimiter(rate=2, burst=3, maxsize=2, clock=lambda: now[0])
+    check("burst 內放行、超過即拒絕", [limiter.acquire("a") for _ in range(4)], [True, True, True, False])
+    check("限流只通知一次", [limiter.notify_once("a"), limiter.notify_once("a")], [True, False])
+    now[0] += 0.5
+    check("依速率補充", [limiter.acquire("a"), limiter.acquire("a")], [True, False])
+    check("再次取得 token 後可再通知", limiter.notify_once("a"), True)
+    check("沒有鍵時不限流", all(limiter.acquire(None) for _ in range(10)), True)
+    limiter.acquire("b")
+    limiter.acquire("c")
+    check("超過上限淘汰最舊的", (limiter.stats()["tracked"], limiter.stats()["evicted"]), (2, 1))
+    now[0] += 1.5
+    limiter.acquire("d")
+    check("閒置到補滿的使用者被清除", limiter.stats()["tracked"], 1)
+    check("停用時一律放行", all(TokenBucketLimiter(rate=0).acquire("a") for _ in range(10)), True)
+    shared = TokenBucketLimiter(rate=0.001, burst=50)
+    results = []
+    threads = [threading.Thread(target=lambda: results.extend(shared.acquire("x") for _ in range(10)))
+               for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check("多執行緒同時取用不超發", results.count(True), 50)
+    cap = ConcurrencyLimiter(2)
+    check("進行中上限", [cap.try_acquire(), cap.try_acquire(), cap.try_acquire()], [True, True, False])
+    cap.release()
+    check("釋放後可再佔用", (cap.try_acquire(), cap.stats()), (True, {"limit": 2, "in_flight": 2, "peak": 2,
+                                                                  "rejected": 1}))
+    check("不設上限", all(ConcurrencyLimiter(0).try_acquire() for _ in range(100)), True)
+
     print(f"通過 {len(PASSED)} 項")
     if FAILED:
         print(f"失敗 {len(FAILED)} 項：")
@@ -175,5 +656,21 @@ def main():
     print("全部測試通過 ✅")
 
 
+def _raises_type(func, error):
+    try:
+        func()
+    except error:
+        return True
+    return False
+
+
+def _raises(func):
+    try:
+        func()
+    except ValueError:
+        return True
+    return False
+
+
 if __name__ == "__main__":
     main()